@@ -1,7 +1,60 @@
-from openai import OpenAI
+import atexit
+import threading
+import httpx
+from openai import OpenAI, DefaultHttpxClient
 
 GPT_MODEL = "gpt-4-1106-preview"
 
+# Pooled HTTP transport settings of this investigation tool. These are its own defaults, not shared
+# with (nor kept in sync with) the clients of 2-Experiments, which is a separate package.
+CLIENT_SETTINGS = {
+    "max_connections": 64,
+    "max_keepalive_connections": 32,
+    "keepalive_expiry": 60.0,
+    "timeout": 600.0,
+    "connect_timeout": 10.0,
+}
+
+_client = None
+_lock_client = threading.Lock()
+
+
+def get_client():
+    """
+    Returns the OpenAI client shared by all chat completion requests,
+    so that HTTP keep-alive and TLS sessions are reused between requests.
+    There is a single client: this tool only calls the OpenAI API (OPENAI_API_KEY / OPENAI_BASE_URL),
+    and the model is chosen per request.
+    """
+    global _client
+    with _lock_client:
+        if _client is None:
+            timeout = httpx.Timeout(
+                timeout=CLIENT_SETTINGS["timeout"],
+                connect=CLIENT_SETTINGS["connect_timeout"],
+            )
+            limits = httpx.Limits(
+                max_connections=CLIENT_SETTINGS["max_connections"],
+                max_keepalive_connections=CLIENT_SETTINGS["max_keepalive_connections"],
+                keepalive_expiry=CLIENT_SETTINGS["keepalive_expiry"],
+            )
+            _client = OpenAI(
+                timeout=timeout,
+                http_client=DefaultHttpxClient(limits=limits, timeout=timeout),
+            )
+        return _client
+
+
+def close_client():
+    global _client
+    with _lock_client:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+atexit.register(close_client)
+
 
 def chat_completion_request(
     messages, functions=None, function_call=None, model=GPT_MODEL
@@ -9,7 +62,7 @@ def chat_completion_request(
     """
     Wraps client.chat.completions.create() and returns the response text content.
     """
-    client = OpenAI()
+    client = get_client()
     print(f"-> Talking to {GPT_MODEL}...")
     response = client.chat.completions.create(
         model=model,
@@ -16,27 +16,8 @@
 
 MODEL_API="openai:gpt-4o-2024-08-06"
 
-# to be extra safe, filter out these app names from the analysis
-# (shouldn't be in ../Data/1d-Collecting_Screenshots/screenshots anyways)
-APP_NAMES_FILTER_REMOVE_EXTRANEOUS=(
-    "__asgaardlab-caber-catch__"
-    "_codegen"
-)
-APP_NAMES_FILTER_KEEP_ABLATION=(
-    "chase-manning-react-photo-studio"
-    "ha-shine-wasm-tetris"
-    "higlass-higlass"
-    "p5aholic-playground"
-    "starwards-starwards"
-    "VoiceSpaceUnder5-VoiceSpace"
-)
-SNAPSHOT_NAMES=(
-    "clean"
-    "bug_layout"
-    "bug_state"
-    "bug_rendering"
-    "bug_appearance"
-)
+# Apps and snapshots are filtered inside `python3 -m vlm_analysis batch`
+# (extraneous apps are skipped, ablation strategies only run on the ablation apps)
 
 # Map short strategy name (e.g., 'v0', 'v1') to the full string
 case "$1" in
@@ -70,7 +51,7 @@ case "$1" in
         ;;
 
     "v5")
-        prompt_strategy ="v5_describe_task_and_provide_readme_plus_mock_verified_sample_plus_assets"
+        prompt_strategy="v5_describe_task_and_provide_readme_plus_mock_verified_sample_plus_assets"
         ;;
 
     "vX2a1")
@@ -118,46 +99,11 @@ else
     pip install -r ../requirements.txt
 fi
 
-# Now run the analysis for each subfolder in ../Data/1d-Collecting_Screenshots/screenshots
-for path_to_app_snapshots in ../Data/1d-Collecting_Screenshots/screenshots/*; do
+# Now run the analysis for every app in ../Data/1d-Collecting_Screenshots/screenshots in a single process
+echo -e "Prompt Strategy: '$prompt_strategy', Model: '$MODEL_API'\n"
 
-    app_name=$(basename "$path_to_app_snapshots")
-
-    # Skip if app_name matches filtering rules
-    if [[ " ${APP_NAMES_FILTER_REMOVE_EXTRANEOUS[@]} " =~ " ${app_name} " ]]; then
-        echo "Skipping '$app_name' because it is in the list of extraneous apps (not part of the study)."
-        continue
-    fi
-
-    # If the prompting strategy is an ablation study, skip if app_name is not in the list of apps to keep
-    if [[ "$prompt_strategy" == "vX2a1_ablation_study_readme_has_the_good_part" ]] && [[ ! " ${APP_NAMES_FILTER_KEEP_ABLATION[@]} " =~ " ${app_name} " ]]; then
-        echo "Skipping '$app_name' because it is not in the list of apps to keep for the ablation study."
-        continue
-    fi
-
-    if [[ "$prompt_strategy" == "vX2a2_ablation_study_readme_has_the_bad_part" ]] && [[ ! " ${APP_NAMES_FILTER_KEEP_ABLATION[@]} " =~ " ${app_name} " ]]; then
-        echo "Skipping '$app_name' because it is not in the list of apps to keep for the ablation study."
-        continue
-    fi
-
-    echo "Running VLM analysis for '$app_name'"
-    echo -e "Prompt Strategy: '$prompt_strategy', Model: '$MODEL_API'\n"
-
-    for snapshot_name in "${SNAPSHOT_NAMES[@]}"; do
-
-        echo "Running analysis for snapshot '$snapshot_name'"
-
-        if [ "$bool_poetry_is_installed" = true ]; then
-            poetry run python3 -m vlm_analysis "$MODEL_API" "$prompt_strategy" "$app_name" "$snapshot_name"
-        else
-            python3 -m vlm_analysis "$MODEL_API" "$prompt_strategy" "$app_name" "$snapshot_name"
-        fi
-
-        echo -e "\nSleeping for 1 second...\n"
-        sleep 1
-    done
-
-    echo -e "\nSleeping for 9 more seconds...\n"
-    sleep 9
-
-done
+if [ "$bool_poetry_is_installed" = true ]; then
+    poetry run python3 -m vlm_analysis batch --model-apis "$MODEL_API" --prompt-strategies "$prompt_strategy"
+else
+    python3 -m vlm_analysis batch --model-apis "$MODEL_API" --prompt-strategies "$prompt_strategy"
+fi
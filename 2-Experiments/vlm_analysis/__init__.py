@@ -41,6 +41,15 @@ class ModelAPI(Enum):
 	# gpt-4o-2024-05-13 - Original GPT-4o
 	# OPENAI_GPT4O_2024_05_13 = "openai:gpt-4o-2024-05-13"
 
+	# Self-hosted OpenAI-compatible servers (see backends.py)
+	# https://docs.vllm.ai/en/latest/serving/openai_compatible_server.html
+
+	# Qwen2-VL-7B-Instruct served by vLLM
+	VLLM_QWEN2_VL_7B_INSTRUCT = "vllm:Qwen/Qwen2-VL-7B-Instruct"
+
+	# LLaVA 1.6 (Mistral 7B) served by llama.cpp's llama-server (which serves whichever model it was started with)
+	LLAMACPP_LLAVA_1_POINT_6_MISTRAL_7B = "llamacpp:llava-v1.6-mistral-7b"
+
 	# Google Gemini Models
 	# https://ai.google.dev/gemini-api/docs/models/gemini
 
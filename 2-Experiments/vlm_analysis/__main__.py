@@ -1,10 +1,23 @@
 import argparse
+import sys
 from . import PromptStrategy, ModelAPI  # defined in __init__.py
 from .run import run
 
 
 if __name__ == "__main__":
 
+    # python3 -m vlm_analysis batch ...
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        from .batch import main as main_batch
+        main_batch(sys.argv[2:])
+        exit(0)
+
+    # python3 -m vlm_analysis trace-summary [path/to/trace.jsonl]
+    if len(sys.argv) > 1 and sys.argv[1] == "trace-summary":
+        from .tracing import main as main_trace_summary
+        main_trace_summary(sys.argv[2:])
+        exit(0)
+
     parser = argparse.ArgumentParser(
         prog='python3 -m vlm_analysis',
         description='Leverage visual-language models to analyse data collected from a PixiJS application',
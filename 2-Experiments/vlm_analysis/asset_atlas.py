@@ -0,0 +1,242 @@
+import base64
+import hashlib
+import io
+import os
+import threading
+from pathlib import Path
+from typing import NamedTuple, Optional
+from PIL import Image, ImageDraw, ImageFont
+
+
+PATH_TO_ATLAS_CACHE_DEFAULT = Path("../Data/2-Experiments/cache/atlases")
+
+# gpt-4o scales the shortest side of an image down to 768 px, so larger sheets would only make the labels smaller
+INT_SHEET_SIZE_DEFAULT = 768
+INT_PADDING = 6
+INT_LABEL_HEIGHT = 12
+# sprites are scaled up to at least this size so that tiny sprites stay legible
+INT_MIN_SPRITE_SIDE = 24
+COLOUR_BACKGROUND = (224, 224, 224, 255)
+COLOUR_CELL_BORDER = (160, 160, 160, 255)
+COLOUR_LABEL = (0, 0, 0, 255)
+
+# added after the prompt in atlas mode, as the prompts describe the assets as separate images
+STRING_PROMPT_ATLAS = (
+	"The image assets are packed into labelled sheets: each asset is drawn in its own box, below its number (#1, #2, ...). "
+	"The grey background and the boxes are not part of the assets."
+)
+
+
+class AtlasPlacement(NamedTuple):
+	int_index: int
+	string_label: str
+	int_x: int
+	int_y: int
+	int_width: int
+	int_height: int
+
+
+def pack_sprites(list_sizes: list[tuple[int, int]], int_sheet_size: int) -> list[list[tuple[int, int, int]]]:
+	"""
+	Shelf packing: place sprites (tallest first) left to right in rows, starting a new row when one is full
+	and a new sheet when a sheet is full. Returns, per sheet, a list of (index of sprite, x, y).
+	The sizes given must already include padding & label, and fit in a sheet.
+	"""
+	list_indices_by_height = sorted(range(len(list_sizes)), key=lambda i: (-list_sizes[i][1], -list_sizes[i][0]))
+
+	list_sheets: list[list[tuple[int, int, int]]] = [[]]
+	int_x, int_y, int_height_of_row = 0, 0, 0
+
+	for int_index in list_indices_by_height:
+		int_width, int_height = list_sizes[int_index]
+
+		# start a new row
+		if int_x + int_width > int_sheet_size:
+			int_x, int_y, int_height_of_row = 0, int_y + int_height_of_row, 0
+
+		# start a new sheet
+		if int_y + int_height > int_sheet_size:
+			list_sheets.append([])
+			int_x, int_y, int_height_of_row = 0, 0, 0
+
+		list_sheets[-1].append((int_index, int_x, int_y))
+		int_x += int_width
+		int_height_of_row = max(int_height_of_row, int_height)
+
+	return [sheet for sheet in list_sheets if len(sheet) > 0]
+
+
+def fit_sprite(image_sprite: Image.Image, int_max_side: int) -> Image.Image:
+
+	int_width, int_height = image_sprite.size
+	float_scale = 1.0
+
+	if max(int_width, int_height) > int_max_side:
+		float_scale = int_max_side / max(int_width, int_height)
+
+	elif max(int_width, int_height) < INT_MIN_SPRITE_SIDE:
+		float_scale = INT_MIN_SPRITE_SIDE / max(int_width, int_height)
+
+	if float_scale == 1.0:
+		return image_sprite
+
+	size_new = (max(1, round(int_width * float_scale)), max(1, round(int_height * float_scale)))
+	# keep pixel art crisp when scaling up
+	resample = Image.Resampling.NEAREST if float_scale > 1.0 else Image.Resampling.LANCZOS
+
+	return image_sprite.resize(size_new, resample)
+
+
+def make_atlas_sheets(list_paths_to_assets: list[Path], int_sheet_size: int = INT_SHEET_SIZE_DEFAULT) -> tuple[list[bytes], list[list[AtlasPlacement]]]:
+	"""Pack the assets of an app into a few PNG sheets, with every sprite labelled by its number"""
+
+	font = ImageFont.load_default()
+	int_max_side_of_sprite = int_sheet_size - 2 * INT_PADDING - INT_LABEL_HEIGHT
+
+	list_sprites = []
+
+	for path_to_asset in list_paths_to_assets:
+		try:
+			with Image.open(path_to_asset) as image_sprite:
+				list_sprites.append(fit_sprite(image_sprite.convert("RGBA"), int_max_side_of_sprite))
+
+		except Exception:
+			print(f"ERROR: Failed to load image asset for atlas at: \"{path_to_asset}\"")
+			list_sprites.append(None)
+
+	list_indices_loaded = [i for i, image_sprite in enumerate(list_sprites) if image_sprite is not None]
+	list_sizes = [
+		(
+			max(list_sprites[i].size[0], INT_MIN_SPRITE_SIDE) + 2 * INT_PADDING,
+			list_sprites[i].size[1] + INT_LABEL_HEIGHT + 2 * INT_PADDING
+		)
+		for i in list_indices_loaded
+	]
+
+	list_bytes_sheets = []
+	list_placements_per_sheet = []
+
+	for list_sheet in pack_sprites(list_sizes, int_sheet_size):
+
+		# crop the last sheet to its content
+		int_width_of_sheet = max(int_x + list_sizes[i][0] for i, int_x, _ in list_sheet)
+		int_height_of_sheet = max(int_y + list_sizes[i][1] for i, _, int_y in list_sheet)
+
+		image_sheet = Image.new("RGBA", (int_width_of_sheet, int_height_of_sheet), COLOUR_BACKGROUND)
+		draw = ImageDraw.Draw(image_sheet)
+		list_placements = []
+
+		for int_index_of_size, int_x, int_y in list_sheet:
+			int_index = list_indices_loaded[int_index_of_size]
+			image_sprite = list_sprites[int_index]
+			int_width_of_cell, int_height_of_cell = list_sizes[int_index_of_size]
+			string_label = f"#{int_index + 1}"
+
+			draw.rectangle([int_x, int_y, int_x + int_width_of_cell - 1, int_y + int_height_of_cell - 1], outline=COLOUR_CELL_BORDER)
+			draw.text((int_x + INT_PADDING, int_y + INT_PADDING // 2), string_label, fill=COLOUR_LABEL, font=font)
+
+			int_x_of_sprite = int_x + INT_PADDING
+			int_y_of_sprite = int_y + INT_PADDING + INT_LABEL_HEIGHT
+			image_sheet.alpha_composite(image_sprite, (int_x_of_sprite, int_y_of_sprite))
+
+			list_placements.append(AtlasPlacement(int_index, string_label, int_x_of_sprite, int_y_of_sprite, image_sprite.size[0], image_sprite.size[1]))
+
+		buffer = io.BytesIO()
+		image_sheet.save(buffer, format="PNG", optimize=True)
+		list_bytes_sheets.append(buffer.getvalue())
+		list_placements_per_sheet.append(list_placements)
+
+	return list_bytes_sheets, list_placements_per_sheet
+
+
+def make_fingerprint_of_assets(list_paths_to_assets: list[Path], int_sheet_size: int) -> str:
+	"""Changes whenever an asset is added, removed or modified (or the sheet size changes)"""
+
+	hash_assets = hashlib.sha256(str(int_sheet_size).encode("utf-8"))
+
+	for path_to_asset in list_paths_to_assets:
+		stat = os.stat(path_to_asset)
+		hash_assets.update(f"{path_to_asset}|{stat.st_mtime_ns}|{stat.st_size}\n".encode("utf-8"))
+
+	return hash_assets.hexdigest()[:16]
+
+
+class AssetAtlasCache:
+	"""Atlas sheets of each app (base64 PNG), cached in memory and as PNG files on disk"""
+
+	def __init__(self, int_sheet_size: int = INT_SHEET_SIZE_DEFAULT, path_to_cache: Optional[Path] = PATH_TO_ATLAS_CACHE_DEFAULT):
+		self.int_sheet_size = int_sheet_size
+		self.path_to_cache = path_to_cache
+		self.dict_sheets: dict[tuple[str, str], list[str]] = dict()
+		self.lock = threading.Lock()
+
+	def load_encoded_sheets(self, string_name_of_app: str, list_paths_to_assets: list[Path]) -> list[str]:
+
+		string_fingerprint = make_fingerprint_of_assets(list_paths_to_assets, self.int_sheet_size)
+		key = (string_name_of_app, string_fingerprint)
+
+		# hold the lock while building, so that the sheets of an app are only built once
+		with self.lock:
+
+			if key in self.dict_sheets:
+				return self.dict_sheets[key]
+
+			list_encoded_sheets = self.load_from_disk(string_name_of_app, string_fingerprint)
+
+			if list_encoded_sheets is None:
+				list_bytes_sheets, _ = make_atlas_sheets(list_paths_to_assets, self.int_sheet_size)
+				self.save_to_disk(string_name_of_app, string_fingerprint, list_bytes_sheets)
+				list_encoded_sheets = [base64.b64encode(bytes_sheet).decode("utf-8") for bytes_sheet in list_bytes_sheets]
+				print(f"Packed {len(list_paths_to_assets)} image assets of app {string_name_of_app} into {len(list_encoded_sheets)} atlas sheet(s)")
+
+			self.dict_sheets[key] = list_encoded_sheets
+
+			return list_encoded_sheets
+
+	def make_path_to_sheets(self, string_name_of_app: str, string_fingerprint: str) -> Optional[Path]:
+
+		if self.path_to_cache is None:
+			return None
+
+		return self.path_to_cache / string_name_of_app / string_fingerprint
+
+	def load_from_disk(self, string_name_of_app: str, string_fingerprint: str) -> Optional[list[str]]:
+
+		path_to_sheets = self.make_path_to_sheets(string_name_of_app, string_fingerprint)
+
+		if path_to_sheets is None or not path_to_sheets.is_dir():
+			return None
+
+		list_paths_to_sheets = sorted(path_to_sheets.glob("sheet_*.png"), key=lambda path: int(path.stem.split("_")[1]))
+
+		if len(list_paths_to_sheets) == 0:
+			return None
+
+		return [base64.b64encode(path_to_sheet.read_bytes()).decode("utf-8") for path_to_sheet in list_paths_to_sheets]
+
+	def save_to_disk(self, string_name_of_app: str, string_fingerprint: str, list_bytes_sheets: list[bytes]):
+
+		path_to_sheets = self.make_path_to_sheets(string_name_of_app, string_fingerprint)
+
+		if path_to_sheets is None:
+			return
+
+		path_to_sheets.mkdir(parents=True, exist_ok=True)
+
+		for int_index, bytes_sheet in enumerate(list_bytes_sheets):
+			(path_to_sheets / f"sheet_{int_index}.png").write_bytes(bytes_sheet)
+
+
+# Atlas mode for the asset strategies (v4/v5); off by default (every asset is sent as its own image, as in the paper)
+asset_atlas_cache: Optional[AssetAtlasCache] = None
+
+
+def configure_asset_atlas(bool_enabled: bool, int_sheet_size: int = INT_SHEET_SIZE_DEFAULT, path_to_cache: Optional[Path] = PATH_TO_ATLAS_CACHE_DEFAULT):
+
+	global asset_atlas_cache
+
+	asset_atlas_cache = AssetAtlasCache(int_sheet_size, path_to_cache) if bool_enabled else None
+
+
+def get_asset_atlas_cache() -> Optional[AssetAtlasCache]:
+	return asset_atlas_cache
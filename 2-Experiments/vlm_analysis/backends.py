@@ -0,0 +1,193 @@
+import asyncio
+import copy
+import json
+import os
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Iterator, Optional, Union
+from . import ModelAPI
+
+
+class OpenAIAdapter:
+	"""Requests of the OpenAI API, sent as they are built"""
+
+	def adapt_request(self, list_of_message_dicts: list[dict], dict_response_format: Optional[dict]) -> tuple[list[dict], Optional[dict]]:
+		return list_of_message_dicts, dict_response_format
+
+
+class OpenAICompatibleAdapter(OpenAIAdapter):
+	"""
+	Self-hosted OpenAI-compatible servers (vLLM, llama.cpp server):
+	the `detail` of images and `strict` schemas are OpenAI settings they may reject, and if a server cannot constrain
+	its output to a JSON schema, the schema is given in a system message with a JSON object response format instead.
+	"""
+
+	def __init__(self, bool_supports_json_schema: bool = True):
+		self.bool_supports_json_schema = bool_supports_json_schema
+
+	def adapt_request(self, list_of_message_dicts: list[dict], dict_response_format: Optional[dict]) -> tuple[list[dict], Optional[dict]]:
+
+		# copied, the messages of a job may be sent again (e.g. to another model)
+		list_of_message_dicts = [
+			{**message_dict, "content": [remove_detail_of_image(part) for part in message_dict["content"]]} if isinstance(message_dict.get("content"), list) else message_dict
+			for message_dict in list_of_message_dicts
+		]
+
+		if dict_response_format is None or dict_response_format.get("type") != "json_schema":
+			return list_of_message_dicts, dict_response_format
+
+		if not self.bool_supports_json_schema:
+			string_instructions = f"Answer with a single JSON object matching this JSON schema, and nothing else:\n{json.dumps(dict_response_format['json_schema']['schema'])}"
+			return list_of_message_dicts + [{"role": "system", "content": string_instructions}], {"type": "json_object"}
+
+		# the schema itself is enforced by the server's guided decoding
+		dict_response_format = copy.deepcopy(dict_response_format)
+		dict_response_format["json_schema"].pop("strict", None)
+
+		return list_of_message_dicts, dict_response_format
+
+
+def remove_detail_of_image(part: Union[dict, str]) -> Union[dict, str]:
+
+	if isinstance(part, dict) and part.get("type") == "image_url" and "detail" in part["image_url"]:
+		return {**part, "image_url": {string_key: value for string_key, value in part["image_url"].items() if string_key != "detail"}}
+
+	return part
+
+
+@dataclass(frozen=True)
+class Backend:
+	"""Where & how the models of a ModelAPI prefix (e.g. "openai" in "openai:gpt-4o-2024-08-06") are called"""
+	string_name: str
+	# None: the OpenAI API (or OPENAI_BASE_URL); read from string_name_of_base_url_env_var first, if it is set
+	string_base_url: Optional[str] = None
+	string_name_of_base_url_env_var: Optional[str] = None
+	# None: no authentication (self-hosted servers usually accept any key)
+	string_name_of_api_key_env_var: Optional[str] = "OPENAI_API_KEY"
+	# requests in flight to this backend, across all workers; None: only limited by the workers (and the --async rate limiter)
+	int_max_concurrency: Optional[int] = None
+	adapter: OpenAIAdapter = OpenAIAdapter()
+	# whether the backend has the OpenAI Batch API (files & batches endpoints)
+	bool_supports_batch_api: bool = True
+
+	def get_base_url(self) -> Optional[str]:
+
+		if self.string_name_of_base_url_env_var is not None and os.environ.get(self.string_name_of_base_url_env_var):
+			return os.environ[self.string_name_of_base_url_env_var]
+
+		return self.string_base_url
+
+	def get_api_key(self) -> Optional[str]:
+
+		string_api_key = None if self.string_name_of_api_key_env_var is None else os.environ.get(self.string_name_of_api_key_env_var)
+
+		# self-hosted servers usually accept any key; for the OpenAI API, the client raises its own error if it is missing
+		if string_api_key is None and self.string_base_url is not None:
+			return "EMPTY"
+
+		return string_api_key
+
+
+# Backends by ModelAPI prefix
+DICT_BACKENDS: dict[str, Backend] = {
+	"openai": Backend("openai"),
+	# vllm serve Qwen/Qwen2-VL-7B-Instruct --port 8000
+	"vllm": Backend(
+		"vllm",
+		string_base_url="http://127.0.0.1:8000/v1",
+		string_name_of_base_url_env_var="VLLM_BASE_URL",
+		string_name_of_api_key_env_var="VLLM_API_KEY",
+		int_max_concurrency=32,
+		adapter=OpenAICompatibleAdapter(bool_supports_json_schema=True),
+		bool_supports_batch_api=False,
+	),
+	# llama-server -m <model>.gguf --mmproj <mmproj>.gguf --port 8080 --parallel 4
+	"llamacpp": Backend(
+		"llamacpp",
+		string_base_url="http://127.0.0.1:8080/v1",
+		string_name_of_base_url_env_var="LLAMACPP_BASE_URL",
+		string_name_of_api_key_env_var="LLAMACPP_API_KEY",
+		# one per slot of the server (--parallel)
+		int_max_concurrency=4,
+		adapter=OpenAICompatibleAdapter(bool_supports_json_schema=False),
+		bool_supports_batch_api=False,
+	),
+	# google: needs an adapter for the Gemini API (see the Gemini entries of ModelAPI)
+}
+
+dict_semaphores: dict[str, threading.BoundedSemaphore] = dict()
+# asyncio semaphores are bound to the event loop they were first used in
+dict_semaphores_async: dict[tuple[str, int], asyncio.Semaphore] = dict()
+lock_backends = threading.Lock()
+
+
+def get_name_of_backend(model_api_or_backend: Union[ModelAPI, str]) -> str:
+	# e.g. ModelAPI.OPENAI_GPT4O_2024_08_06 ("openai:gpt-4o-2024-08-06") -> "openai"
+	if isinstance(model_api_or_backend, ModelAPI):
+		return model_api_or_backend.value.split(":")[0]
+
+	return model_api_or_backend
+
+
+def get_name_of_model(model_api: ModelAPI) -> str:
+	# e.g. "vllm:Qwen/Qwen2-VL-7B-Instruct" -> "Qwen/Qwen2-VL-7B-Instruct"
+	return model_api.value.split(":", 1)[1]
+
+
+def get_backend(model_api_or_backend: Union[ModelAPI, str]) -> Optional[Backend]:
+	return DICT_BACKENDS.get(get_name_of_backend(model_api_or_backend))
+
+
+def register_backend(backend: Backend):
+	"""Add or replace a backend (e.g. another self-hosted server); clients created before keep the old settings"""
+
+	with lock_backends:
+		DICT_BACKENDS[backend.string_name] = backend
+		dict_semaphores.pop(backend.string_name, None)
+
+
+def get_semaphore(backend: Backend) -> Optional[threading.BoundedSemaphore]:
+
+	if backend.int_max_concurrency is None:
+		return None
+
+	with lock_backends:
+
+		if backend.string_name not in dict_semaphores:
+			dict_semaphores[backend.string_name] = threading.BoundedSemaphore(backend.int_max_concurrency)
+
+		return dict_semaphores[backend.string_name]
+
+
+@contextmanager
+def limit_concurrency(backend: Backend) -> Iterator[None]:
+
+	semaphore = get_semaphore(backend)
+
+	if semaphore is None:
+		yield
+		return
+
+	with semaphore:
+		yield
+
+
+@asynccontextmanager
+async def limit_concurrency_async(backend: Backend) -> AsyncIterator[None]:
+
+	if backend.int_max_concurrency is None:
+		yield
+		return
+
+	key = (backend.string_name, id(asyncio.get_running_loop()))
+
+	with lock_backends:
+
+		if key not in dict_semaphores_async:
+			dict_semaphores_async[key] = asyncio.Semaphore(backend.int_max_concurrency)
+
+		semaphore = dict_semaphores_async[key]
+
+	async with semaphore:
+		yield
@@ -0,0 +1,873 @@
+import argparse
+import asyncio
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import NamedTuple, Optional
+from . import PromptStrategy, ModelAPI
+from .clients import configure_clients, close_clients_async
+from .backends import get_backend, get_name_of_backend
+from .response_cache import configure_response_cache, get_response_cache
+from .image_cache import configure_encoded_image_cache, get_encoded_image_cache
+from .image_preparation import ImagePreparationPolicy, ImageRole, configure_image_preparation, image_preparation_stats
+from .pixel_diff import PixelDiffPolicy, configure_pixel_diff
+from .asset_atlas import configure_asset_atlas, INT_SHEET_SIZE_DEFAULT, PATH_TO_ATLAS_CACHE_DEFAULT
+from .rate_limiting import AdaptiveRateLimiter
+from .call_policy import CallPolicy, configure_call_policy
+from .streaming import configure_streaming
+from .readme_context import configure_readme_context, INT_MAX_TOKENS_PER_CHUNK_DEFAULT
+from .results_store import configure_results_store, get_results_store, ResultsStoreWriteError, PATH_TO_RESULTS_STORE_DEFAULT
+from .screenshot_index import ScreenshotIndex, configure_screenshot_index, get_screenshot_index, format_near_duplicates, INT_MAX_DISTANCE_OF_NEAR_DUPLICATES_DEFAULT, PATH_TO_SCREENSHOT_INDEX_DEFAULT
+from .job_manifest import configure_job_manifest, get_job_manifest, make_digest_of_output, INT_MAX_ATTEMPTS_DEFAULT, PATH_TO_JOB_MANIFEST_DEFAULT
+from .cost_estimation import JobEstimate, FLOAT_PRICE_FACTOR_BATCH_API, estimate_job, schedule_jobs_longest_first, make_report_of_estimates
+from .batch_api import BatchRequest, BatchTransport, LIST_NAMES_OF_BATCH_TRANSPORTS, PATH_TO_BATCH_FILES_DEFAULT, make_batch_transport, run_stage
+from .tracing import configure_tracing, trace_job, PATH_TO_TRACE_DEFAULT
+from .run import make_list_of_messages_traced, run_with_messages, run_with_messages_async, APPS_INCLUDED_IN_ABLATION_STUDY, PROMPT_STRATEGIES_WITH_README
+from .utilities import (
+	warm_up_readme_index,
+	make_list_of_message_dicts_for_structured_answer,
+	save_results,
+	load_results,
+	configure_single_call,
+	get_bool_single_call_is_enabled,
+	split_response_with_structured_answer,
+	DICT_RESPONSE_FORMAT_STRUCTURED_ANSWER,
+	DICT_RESPONSE_FORMAT_RESPONSE_WITH_ANSWER,
+)
+
+
+SNAPSHOT_NAMES = [
+	"clean",
+	"bug_layout",
+	"bug_state",
+	"bug_rendering",
+	"bug_appearance"
+]
+
+# to be extra safe, filter out these app names from the analysis
+# (shouldn't be in ../Data/1d-Collecting_Screenshots/screenshots anyways)
+APP_NAMES_FILTER_REMOVE_EXTRANEOUS = [
+	"__asgaardlab-caber-catch__",
+	"_codegen"
+]
+
+# results store (and job manifest) of runs against another server (--base-url), kept apart from the results of the model APIs
+PATH_TO_RESULTS_OF_BASE_URL = Path("../Data/2-Experiments/base_url")
+
+PROMPT_STRATEGIES_OF_ABLATION_STUDY = [
+	PromptStrategy.ABLATION_STUDY_README_HAS_THE_GOOD_PART,
+	PromptStrategy.ABLATION_STUDY_README_HAS_THE_BAD_PART
+]
+
+
+class Job(NamedTuple):
+	"""One sample of the experiment matrix: a model analysing one snapshot of an app with one prompting strategy"""
+	model_api: ModelAPI
+	prompt_strategy: PromptStrategy
+	string_name_of_app: str
+	string_name_of_snapshot: str
+
+
+class JobOutcome(NamedTuple):
+	job: Job
+	bool_succeeded: bool
+	string_error: str = ""
+	# digest of the saved .txt & .json (see make_digest_of_output)
+	string_digest_of_output: str = ""
+
+
+def list_names_of_apps() -> list[str]:
+
+	path_to_screenshots = Path("../Data/1d-Collecting_Screenshots/screenshots")
+
+	list_names = sorted(
+		path_to_app.name for path_to_app in path_to_screenshots.iterdir()
+		if path_to_app.is_dir() and path_to_app.name not in APP_NAMES_FILTER_REMOVE_EXTRANEOUS
+	)
+
+	return list_names
+
+
+def make_list_of_jobs(
+	list_model_apis: list[ModelAPI],
+	list_prompt_strategies: list[PromptStrategy],
+	list_names_of_apps_selected: Optional[list[str]] = None,
+	list_names_of_snapshots: Optional[list[str]] = None
+) -> list[Job]:
+	"""Expand ModelAPI x PromptStrategy x app x snapshot into the list of jobs to run"""
+
+	if list_names_of_apps_selected is None:
+		list_names_of_apps_selected = list_names_of_apps()
+
+	if list_names_of_snapshots is None:
+		list_names_of_snapshots = SNAPSHOT_NAMES
+
+	list_of_jobs = []
+
+	for model_api in list_model_apis:
+
+		for prompt_strategy in list_prompt_strategies:
+
+			for string_name_of_app in list_names_of_apps_selected:
+
+				if string_name_of_app in APP_NAMES_FILTER_REMOVE_EXTRANEOUS:
+					continue
+
+				# the ablation study only covers a subset of the apps
+				if prompt_strategy in PROMPT_STRATEGIES_OF_ABLATION_STUDY and string_name_of_app not in APPS_INCLUDED_IN_ABLATION_STUDY:
+					continue
+
+				for string_name_of_snapshot in list_names_of_snapshots:
+					list_of_jobs.append(Job(model_api, prompt_strategy, string_name_of_app, string_name_of_snapshot))
+
+	return list_of_jobs
+
+
+def run_batch(
+	list_of_jobs: list[Job],
+	int_number_of_workers: int = 4,
+	int_number_of_preparers: int = 2,
+	int_number_of_prepared_jobs: int = 8
+) -> list[JobOutcome]:
+	"""
+	Run all jobs in this process with a producer/consumer pipeline:
+	preparers load & encode images and build the messages for upcoming jobs,
+	while a bounded pool of workers waits on the model API calls in flight.
+	"""
+	queue_of_jobs: queue.Queue = queue.Queue()
+	# bounded, so that preparers only run a few jobs ahead of the workers
+	queue_of_prepared_jobs: queue.Queue = queue.Queue(maxsize=max(1, int_number_of_prepared_jobs))
+	list_of_outcomes: list[JobOutcome] = []
+	lock_outcomes = threading.Lock()
+
+	for job in list_of_jobs:
+		queue_of_jobs.put(job)
+
+	def record_outcome(outcome: JobOutcome):
+		record_outcome_in_job_manifest(outcome)
+
+		with lock_outcomes:
+			list_of_outcomes.append(outcome)
+			print_outcome(outcome, len(list_of_outcomes), len(list_of_jobs))
+
+	def prepare():
+		while True:
+			try:
+				job = queue_of_jobs.get_nowait()
+			except queue.Empty:
+				return
+
+			list_of_message_dicts, outcome_failed = prepare_job(job)
+
+			if outcome_failed is not None:
+				record_outcome(outcome_failed)
+				continue
+
+			queue_of_prepared_jobs.put((job, list_of_message_dicts))
+
+	def work():
+		while True:
+			item = queue_of_prepared_jobs.get()
+
+			# sentinel: all preparers are done
+			if item is None:
+				return
+
+			job, list_of_message_dicts = item
+
+			mark_job_in_flight(job)
+
+			try:
+				with trace_job(job):
+					string_response_content, json_response_results = run_with_messages(*job, list_of_message_dicts)
+				record_outcome(JobOutcome(job, True, string_digest_of_output=make_digest_of_output(string_response_content, json_response_results)))
+
+			except Exception as err:
+				record_outcome(JobOutcome(job, False, repr(err)))
+
+	list_preparers = [threading.Thread(target=prepare, daemon=True) for _ in range(max(1, int_number_of_preparers))]
+	list_workers = [threading.Thread(target=work, daemon=True) for _ in range(max(1, int_number_of_workers))]
+
+	for thread in list_preparers + list_workers:
+		thread.start()
+
+	for thread in list_preparers:
+		thread.join()
+
+	for _ in list_workers:
+		queue_of_prepared_jobs.put(None)
+
+	for thread in list_workers:
+		thread.join()
+
+	print_summary(list_of_outcomes)
+
+	return list_of_outcomes
+
+
+def run_batch_async(
+	list_of_jobs: list[Job],
+	rate_limiter: AdaptiveRateLimiter,
+	int_number_of_preparers: int = 2,
+	int_number_of_prepared_jobs: int = 8
+) -> list[JobOutcome]:
+	"""
+	Same pipeline as run_batch, but the model API calls are made with AsyncOpenAI on one event loop.
+	The number of calls in flight is decided by the shared rate limiter (up to its max concurrency).
+	"""
+	return asyncio.run(run_batch_in_event_loop(list_of_jobs, rate_limiter, int_number_of_preparers, int_number_of_prepared_jobs))
+
+
+async def run_batch_in_event_loop(
+	list_of_jobs: list[Job],
+	rate_limiter: AdaptiveRateLimiter,
+	int_number_of_preparers: int,
+	int_number_of_prepared_jobs: int
+) -> list[JobOutcome]:
+
+	queue_of_jobs: asyncio.Queue = asyncio.Queue()
+	queue_of_prepared_jobs: asyncio.Queue = asyncio.Queue(maxsize=max(1, int_number_of_prepared_jobs))
+	list_of_outcomes: list[JobOutcome] = []
+
+	for job in list_of_jobs:
+		queue_of_jobs.put_nowait(job)
+
+	def record_outcome(outcome: JobOutcome):
+		record_outcome_in_job_manifest(outcome)
+		list_of_outcomes.append(outcome)
+		print_outcome(outcome, len(list_of_outcomes), len(list_of_jobs))
+
+	async def prepare():
+		while not queue_of_jobs.empty():
+			job = queue_of_jobs.get_nowait()
+
+			# loading & encoding images is blocking, keep it off the event loop
+			list_of_message_dicts, outcome_failed = await asyncio.to_thread(prepare_job, job)
+
+			if outcome_failed is not None:
+				record_outcome(outcome_failed)
+				continue
+
+			await queue_of_prepared_jobs.put((job, list_of_message_dicts))
+
+	async def work():
+		while True:
+			item = await queue_of_prepared_jobs.get()
+
+			# sentinel: all preparers are done
+			if item is None:
+				return
+
+			job, list_of_message_dicts = item
+
+			mark_job_in_flight(job)
+
+			try:
+				with trace_job(job):
+					string_response_content, json_response_results = await run_with_messages_async(*job, list_of_message_dicts, rate_limiter)
+				record_outcome(JobOutcome(job, True, string_digest_of_output=make_digest_of_output(string_response_content, json_response_results)))
+
+			except Exception as err:
+				record_outcome(JobOutcome(job, False, repr(err)))
+
+	list_preparers = [asyncio.create_task(prepare()) for _ in range(max(1, int_number_of_preparers))]
+	list_workers = [asyncio.create_task(work()) for _ in range(max(1, rate_limiter.int_max_concurrency))]
+
+	await asyncio.gather(*list_preparers)
+
+	for _ in list_workers:
+		await queue_of_prepared_jobs.put(None)
+
+	await asyncio.gather(*list_workers)
+	await close_clients_async()
+
+	print_summary(list_of_outcomes)
+	print(f"Rate limiter: concurrency={rate_limiter.int_concurrency}, rate-limited responses={rate_limiter.int_number_of_rate_limited_responses}")
+
+	return list_of_outcomes
+
+
+def run_batch_with_batch_api(
+	list_of_jobs: list[Job],
+	transport: BatchTransport,
+	int_number_of_preparers: int = 2,
+	int_number_of_prepared_jobs: int = 8,
+	path_to_batch_files: Path = PATH_TO_BATCH_FILES_DEFAULT,
+	float_poll_interval_seconds: float = 30.0
+) -> list[JobOutcome]:
+	"""
+	Run all jobs through batch files instead of one request at a time: higher throughput and lower cost, but no interactive latency.
+	The vision requests are submitted as a first stage, the answer extraction requests of their responses as a second one
+	(unless in single-call mode, where the vision requests return the answer too).
+	"""
+	bool_single_call = get_bool_single_call_is_enabled()
+	list_of_outcomes: list[JobOutcome] = []
+
+	def record_outcome(outcome: JobOutcome):
+		record_outcome_in_job_manifest(outcome)
+		list_of_outcomes.append(outcome)
+		print_outcome(outcome, len(list_of_outcomes), len(list_of_jobs))
+
+	def make_custom_id(int_index_of_job: int) -> str:
+		return f"job-{int_index_of_job}"
+
+	def iterate_requests_for_responses():
+		# messages are built (and written to the batch files) a few jobs at a time, so the images of all jobs are never held at once
+		int_number_per_chunk = max(1, int_number_of_prepared_jobs)
+
+		with ThreadPoolExecutor(max_workers=max(1, int_number_of_preparers)) as executor:
+
+			for int_index_of_chunk in range(0, len(list_of_jobs), int_number_per_chunk):
+				list_of_jobs_in_chunk = list_of_jobs[int_index_of_chunk:int_index_of_chunk + int_number_per_chunk]
+
+				for int_index_of_job, job, (list_of_message_dicts, outcome_failed) in zip(
+					range(int_index_of_chunk, int_index_of_chunk + len(list_of_jobs_in_chunk)),
+					list_of_jobs_in_chunk,
+					executor.map(prepare_job, list_of_jobs_in_chunk)
+				):
+					if outcome_failed is not None:
+						record_outcome(outcome_failed)
+						continue
+
+					mark_job_in_flight(job)
+
+					yield BatchRequest(
+						make_custom_id(int_index_of_job),
+						job.model_api,
+						list_of_message_dicts,
+						DICT_RESPONSE_FORMAT_RESPONSE_WITH_ANSWER if bool_single_call else None
+					)
+
+	dict_results_of_responses = run_stage(iterate_requests_for_responses(), transport, "responses", path_to_batch_files, float_poll_interval_seconds)
+
+	if bool_single_call:
+
+		for string_custom_id, batch_result in sorted(dict_results_of_responses.items(), key=lambda item: int(item[0].split("-")[1])):
+
+			job = list_of_jobs[int(string_custom_id.split("-")[1])]
+
+			if batch_result.string_error or not batch_result.response_content:
+				record_outcome(JobOutcome(job, False, batch_result.string_error or "Empty response"))
+				continue
+
+			try:
+				string_response_content, json_response_results = split_response_with_structured_answer(batch_result.response_content)  # type: ignore
+
+			except ValueError as err:
+				record_outcome(JobOutcome(job, False, repr(err)))
+				continue
+
+			record_outcome(save_job(job, string_response_content, json_response_results))
+
+		print_summary(list_of_outcomes)
+
+		return list_of_outcomes
+
+	list_of_requests_for_answers = []
+
+	for string_custom_id, batch_result in dict_results_of_responses.items():
+
+		job = list_of_jobs[int(string_custom_id.split("-")[1])]
+
+		if batch_result.string_error or not batch_result.response_content:
+			record_outcome(JobOutcome(job, False, batch_result.string_error or "Empty response"))
+			continue
+
+		list_of_requests_for_answers.append(BatchRequest(
+			string_custom_id,
+			job.model_api,
+			make_list_of_message_dicts_for_structured_answer(batch_result.response_content),  # type: ignore
+			DICT_RESPONSE_FORMAT_STRUCTURED_ANSWER
+		))
+
+	dict_results_of_answers = run_stage(list_of_requests_for_answers, transport, "answers", path_to_batch_files, float_poll_interval_seconds)
+
+	for string_custom_id, batch_result in sorted(dict_results_of_answers.items(), key=lambda item: int(item[0].split("-")[1])):
+
+		job = list_of_jobs[int(string_custom_id.split("-")[1])]
+
+		if batch_result.string_error or not batch_result.response_content:
+			record_outcome(JobOutcome(job, False, f"Answer extraction failed: {batch_result.string_error or 'Empty response'}"))
+			continue
+
+		record_outcome(save_job(job, dict_results_of_responses[string_custom_id].response_content, batch_result.response_content))  # type: ignore
+
+	print_summary(list_of_outcomes)
+
+	return list_of_outcomes
+
+
+def save_job(job: Job, string_response_content: str, json_response_results: str) -> JobOutcome:
+
+	try:
+		with trace_job(job):
+			save_results(*job, string_response_content, json_response_results)  # type: ignore
+
+	except Exception as err:
+		return JobOutcome(job, False, repr(err))
+
+	return JobOutcome(job, True, string_digest_of_output=make_digest_of_output(string_response_content, json_response_results))
+
+
+def split_jobs_with_duplicate_screenshots(list_of_jobs: list[Job], screenshot_index: ScreenshotIndex) -> tuple[list[Job], list[tuple[Job, Job]]]:
+	"""
+	Jobs to run, and jobs whose screenshot is pixel-identical to an earlier snapshot of the same app (e.g. a bug that did not show),
+	each with the job of that snapshot: the request would only differ by how the PNG was encoded, so its verdict is reused
+	"""
+	list_of_jobs_to_run = []
+	list_of_duplicates = []
+
+	for job in list_of_jobs:
+		string_name_of_snapshot_source = screenshot_index.find_source_of_duplicate(job.string_name_of_app, job.string_name_of_snapshot, SNAPSHOT_NAMES)
+
+		if string_name_of_snapshot_source is None:
+			list_of_jobs_to_run.append(job)
+
+		else:
+			list_of_duplicates.append((job, job._replace(string_name_of_snapshot=string_name_of_snapshot_source)))
+
+	return list_of_jobs_to_run, list_of_duplicates
+
+
+def reuse_results_of_duplicates(list_of_duplicates: list[tuple[Job, Job]], list_of_outcomes: list[JobOutcome]) -> tuple[list[JobOutcome], list[Job]]:
+	"""Save the results of the source job of each duplicate for it too; returns their outcomes, and the duplicates to run since their source has no results"""
+
+	set_jobs_failed = {outcome.job for outcome in list_of_outcomes if not outcome.bool_succeeded}
+	list_of_outcomes_reused = []
+	list_of_jobs_to_run = []
+
+	for job, job_source in list_of_duplicates:
+
+		# the source may have been run by an earlier run (see --job-manifest) or in this one
+		string_response_content, dict_response_results = ("", dict()) if job_source in set_jobs_failed else load_results(*job_source)
+
+		if not string_response_content or not dict_response_results:
+			list_of_jobs_to_run.append(job)
+			continue
+
+		# the same double-encoded JSON as the source's .json
+		outcome = save_job(job, string_response_content, json.dumps(dict_response_results))
+		record_outcome_in_job_manifest(outcome)
+		list_of_outcomes_reused.append(outcome)
+
+		string_status = f"REUSED (pixel-identical to {job_source.string_name_of_snapshot})" if outcome.bool_succeeded else f"FAILED ({outcome.string_error})"
+		print(f"{format_job(job)}: {string_status}")
+
+	return list_of_outcomes_reused, list_of_jobs_to_run
+
+
+def make_path_away_from_default(string_path: Optional[str], path_default: Path, string_name_of_file: str) -> Path:
+	"""The given path, unless it is missing or the default one (of the real results): then, the file of that name in PATH_TO_RESULTS_OF_BASE_URL"""
+
+	if string_path is None or Path(string_path).resolve() == path_default.resolve():
+		return PATH_TO_RESULTS_OF_BASE_URL / string_name_of_file
+
+	return Path(string_path)
+
+
+def fail_jobs_not_written_to_results_store(list_of_outcomes: list[JobOutcome]) -> list[JobOutcome]:
+	"""The outcomes, where jobs whose results the results store could not write (after their save returned) failed"""
+
+	results_store = get_results_store()
+
+	if results_store is None:
+		return list_of_outcomes
+
+	try:
+		results_store.flush()
+
+	except ResultsStoreWriteError as err:
+		print(f"ERROR: {err}")
+		list_of_outcomes_written = []
+
+		for outcome in list_of_outcomes:
+			string_error = err.dict_errors_of_keys.get((outcome.job.model_api.value, outcome.job.prompt_strategy.value, outcome.job.string_name_of_app, outcome.job.string_name_of_snapshot))
+
+			if outcome.bool_succeeded and string_error is not None:
+				# so that the job manifest does not skip it on the next run
+				outcome = JobOutcome(outcome.job, False, f"Results not written to the results store: {string_error}")
+				record_outcome_in_job_manifest(outcome)
+				print(f"{format_job(outcome.job)}: FAILED ({outcome.string_error})")
+
+			list_of_outcomes_written.append(outcome)
+
+		return list_of_outcomes_written
+
+	return list_of_outcomes
+
+
+def mark_job_in_flight(job: Job):
+
+	job_manifest = get_job_manifest()
+
+	if job_manifest is not None:
+		job_manifest.mark_in_flight(job)
+
+
+def record_outcome_in_job_manifest(outcome: JobOutcome):
+
+	job_manifest = get_job_manifest()
+
+	if job_manifest is None:
+		return
+
+	if outcome.bool_succeeded:
+		job_manifest.mark_completed(outcome.job, outcome.string_digest_of_output)
+
+	else:
+		job_manifest.mark_failed(outcome.job, outcome.string_error)
+
+
+def prepare_job(job: Job) -> tuple[Optional[list[dict]], Optional[JobOutcome]]:
+	"""Build the messages of a job, or return the outcome of a job that failed before calling the model API"""
+
+	try:
+		with trace_job(job):
+			list_of_message_dicts = make_list_of_messages_traced(*job)
+
+	# loaders exit() when data is missing, which must not take down the whole batch
+	except (Exception, SystemExit) as err:
+		return None, JobOutcome(job, False, f"Failed to build messages: {err!r}")
+
+	if list_of_message_dicts is None:
+		return None, JobOutcome(job, False, "Experiment cannot be performed for this app")
+
+	return list_of_message_dicts, None
+
+
+def estimate_jobs(list_of_jobs: list[Job], int_number_of_preparers: int = 2, float_price_factor: float = 1.0) -> list[JobEstimate]:
+	"""Build the messages of every job (without calling the model API) to estimate its tokens & cost"""
+
+	bool_single_call = get_bool_single_call_is_enabled()
+
+	def estimate(job: Job) -> JobEstimate:
+		list_of_message_dicts, outcome_failed = prepare_job(job)
+
+		# counted as free: the job fails before calling the model API
+		if outcome_failed is not None:
+			return JobEstimate(job, 0, 0, 0.0, outcome_failed.string_error)
+
+		return estimate_job(job, list_of_message_dicts, bool_single_call, float_price_factor)
+
+	with ThreadPoolExecutor(max_workers=max(1, int_number_of_preparers)) as executor:
+		return list(executor.map(estimate, list_of_jobs))
+
+
+def schedule_jobs(args: argparse.Namespace, list_of_jobs: list[Job]) -> list[Job]:
+	"""Estimate the jobs, then order them longest-first and stop at the token or dollar budget (or only print the estimate)"""
+
+	float_price_factor = FLOAT_PRICE_FACTOR_BATCH_API if args.batch_api == "openai" else 1.0
+	list_of_estimates = estimate_jobs(list_of_jobs, args.preparers, float_price_factor)
+
+	print(make_report_of_estimates(
+		list_of_estimates,
+		int_requests_per_job=1 if get_bool_single_call_is_enabled() else 2,
+		int_requests_per_minute=args.requests_per_minute if args.bool_async else None,
+		int_tokens_per_minute=args.tokens_per_minute if args.bool_async else None
+	))
+
+	if args.estimate_only:
+		exit(0)
+
+	list_of_estimates_scheduled, list_of_estimates_deferred = schedule_jobs_longest_first(list_of_estimates, args.budget_tokens, args.budget_usd)
+
+	if len(list_of_estimates_deferred) > 0:
+		print(f"Budget reached: running {len(list_of_estimates_scheduled)} jobs (${sum(estimate.float_cost_usd for estimate in list_of_estimates_scheduled):.2f}), deferring {len(list_of_estimates_deferred)} jobs (${sum(estimate.float_cost_usd for estimate in list_of_estimates_deferred):.2f})")
+
+	return [estimate.job for estimate in list_of_estimates_scheduled]
+
+
+def print_outcome(outcome: JobOutcome, int_number_done: int, int_number_total: int):
+	string_status = "OK" if outcome.bool_succeeded else f"FAILED ({outcome.string_error})"
+	print(f"[{int_number_done}/{int_number_total}] {format_job(outcome.job)}: {string_status}")
+
+
+def print_summary(list_of_outcomes: list[JobOutcome]):
+	int_number_failed = sum(1 for outcome in list_of_outcomes if not outcome.bool_succeeded)
+	print(f"Finished batch of {len(list_of_outcomes)} jobs ({int_number_failed} failed)")
+
+
+def format_job(job: Job) -> str:
+	return f"{job.model_api.value} / {job.prompt_strategy.value} / {job.string_name_of_app} / {job.string_name_of_snapshot}"
+
+
+def make_argument_parser() -> argparse.ArgumentParser:
+
+	parser = argparse.ArgumentParser(
+		prog='python3 -m vlm_analysis batch',
+		description='Run the experiment matrix (model x prompt strategy x app x snapshot) in a single process',
+	)
+	# the self-hosted models only run when asked for (their servers must be started first, see backends.py)
+	parser.add_argument("--model-apis", type=ModelAPI, choices=list(ModelAPI), nargs="+", default=[model_api for model_api in ModelAPI if get_name_of_backend(model_api) == "openai"])
+	parser.add_argument("--prompt-strategies", type=PromptStrategy, choices=list(PromptStrategy), nargs="+", required=True)
+	parser.add_argument("--apps", type=str, nargs="+", default=None, help="Defaults to every app in ../Data/1d-Collecting_Screenshots/screenshots")
+	parser.add_argument("--snapshots", type=str, nargs="+", default=None, help=f"Defaults to: {' '.join(SNAPSHOT_NAMES)}")
+	parser.add_argument("--workers", type=int, default=4, help="Number of model API calls in flight")
+	parser.add_argument("--preparers", type=int, default=2, help="Number of threads loading images and building messages")
+	parser.add_argument("--prefetch", type=int, default=8, help="Number of prepared jobs waiting for a worker")
+	parser.add_argument("--max-connections", type=int, default=None, help="Size of the pooled HTTP connections per backend")
+	parser.add_argument("--timeout", type=float, default=None, help="Timeout in seconds of a model API call")
+	parser.add_argument("--deadline", type=float, default=CallPolicy.float_deadline_seconds, help="Seconds a model API call may take, retries included")
+	parser.add_argument("--call-attempts", type=int, default=CallPolicy.int_max_attempts, help="Attempts of a model API call on timeouts, connection errors, rate limits, 5xx and empty answers")
+	parser.add_argument("--backoff-base", type=float, default=CallPolicy.float_backoff_base_seconds, help="Seconds of the exponential backoff (with jitter) between attempts")
+	parser.add_argument("--backoff-max", type=float, default=CallPolicy.float_backoff_max_seconds)
+	parser.add_argument("--circuit-breaker-failures", type=int, default=CallPolicy.int_circuit_breaker_failures, help="Consecutive failures of a backend after which its calls are suspended")
+	parser.add_argument("--circuit-breaker-reset", type=float, default=CallPolicy.float_circuit_breaker_reset_seconds, help="Seconds calls are suspended before a trial call")
+	parser.add_argument("--hedge", action="store_true", help="Send a duplicate request when a call takes longer than the --hedge-percentile of its stage & strategy (costs the duplicate's tokens)")
+	parser.add_argument("--hedge-percentile", type=float, default=CallPolicy.float_hedging_percentile)
+	parser.add_argument("--base-url", type=str, default=None, help="Send the model API calls to this OpenAI-compatible server instead, e.g. the replay server (python3 -m vlm_analysis.replay_server); its results are saved to a results store in ../Data/2-Experiments/base_url, unless --results-store gives another one than the default")
+	parser.add_argument("--screenshot-index", type=str, default=None, nargs="?", const=str(PATH_TO_SCREENSHOT_INDEX_DEFAULT), help="Hash the screenshots into this SQLite index, reuse the verdict of a pixel-identical earlier snapshot of the app instead of calling the model API, and report near-duplicates")
+	parser.add_argument("--near-duplicate-distance", type=int, default=INT_MAX_DISTANCE_OF_NEAR_DUPLICATES_DEFAULT, help="(--screenshot-index) Report screenshots whose pHash & dHash differ by at most this many bits (of 64)")
+	parser.add_argument("--response-cache", type=str, default=None, nargs="?", const="../Data/2-Experiments/cache/responses.sqlite", help="Answer requests sent before from this SQLite response cache")
+	parser.add_argument("--response-cache-read-only", action="store_true", help="Only read from the response cache, do not add new responses")
+	parser.add_argument("--response-cache-max-entries", type=int, default=None)
+	parser.add_argument("--response-cache-max-mb", type=float, default=None)
+	parser.add_argument("--response-cache-max-age-days", type=float, default=None)
+	parser.add_argument("--image-cache", type=str, default=None, nargs="?", const="../Data/2-Experiments/cache/encoded_images.sqlite", help="Also keep base64-encoded images in this SQLite store between runs")
+	parser.add_argument("--image-cache-max-mb", type=float, default=256, help="Memory budget of the encoded image cache")
+	parser.add_argument("--prepare-images", action="store_true", help="Resize, transcode & set the detail level of images before upload (see the --image-* options)")
+	parser.add_argument("--image-format", type=str, choices=["png", "jpeg", "webp"], default="jpeg")
+	parser.add_argument("--image-quality", type=int, default=85)
+	parser.add_argument("--no-image-resize", dest="bool_image_resize", action="store_false", help="Keep the original resolution of images")
+	parser.add_argument("--image-detail-screenshot", type=str, choices=["low", "high", "auto"], default="high")
+	parser.add_argument("--image-detail-baseline", type=str, choices=["low", "high", "auto"], default="high")
+	parser.add_argument("--image-detail-asset", type=str, choices=["low", "high", "auto"], default="low")
+	parser.add_argument("--asset-atlas", action="store_true", help="Pack the image assets of an app into a few labelled sheets (v4 & v5)")
+	parser.add_argument("--asset-atlas-sheet-size", type=int, default=INT_SHEET_SIZE_DEFAULT, help="Width & height of an atlas sheet in pixels")
+	parser.add_argument("--asset-atlas-cache", type=str, default=str(PATH_TO_ATLAS_CACHE_DEFAULT), help="Folder where the atlas sheets of each app are kept between runs")
+	parser.add_argument("--pixel-diff", action="store_true", help="Diff each snapshot against the clean.png of its app and add the statistics to its results (.json)")
+	parser.add_argument("--regions-of-interest", action="store_true", help="(implies --pixel-diff) Send enlarged crops of the changed regions instead of the screenshot")
+	parser.add_argument("--diff-threshold", type=float, default=0.05, help="(--pixel-diff) A pixel changed if a channel differs by more than this fraction of 255")
+	parser.add_argument("--roi-margin", type=int, default=32, help="(--regions-of-interest) Pixels of context around each changed region")
+	parser.add_argument("--roi-max-regions", type=int, default=3, help="(--regions-of-interest) Above this many regions, crop one region around all of them")
+	parser.add_argument("--roi-side", type=int, default=512, help="(--regions-of-interest) Longest side of a crop after enlarging it (up to 4x)")
+	parser.add_argument("--roi-full-frame-side", type=int, default=0, help="(--regions-of-interest) Also send the screenshot downscaled to this longest side (0: do not)")
+	parser.add_argument("--readme-token-budget", type=int, default=None, help="Only send the README chunks most relevant to the prompt, up to this many tokens (README strategies)")
+	parser.add_argument("--readme-chunk-tokens", type=int, default=INT_MAX_TOKENS_PER_CHUNK_DEFAULT, help="With --readme-token-budget, maximum tokens of a README chunk")
+	parser.add_argument("--single-call", action="store_true", help="Get the response and the structured answer in one call, instead of a second call extracting the answer")
+	parser.add_argument("--stream", action="store_true", help="Stream responses, appending them to <snapshot>.txt.partial as they arrive (not with --single-call or --batch-api)")
+	parser.add_argument("--results-store", type=str, default=None, nargs="?", const=str(PATH_TO_RESULTS_STORE_DEFAULT), help="Save results to this SQLite results store instead of a .txt & .json file per sample")
+	parser.add_argument("--job-manifest", type=str, default=None, nargs="?", const=str(PATH_TO_JOB_MANIFEST_DEFAULT), help="Record the status of every job in this SQLite manifest, and skip the jobs completed by earlier runs")
+	parser.add_argument("--max-attempts", type=int, default=INT_MAX_ATTEMPTS_DEFAULT, help="With --job-manifest, stop retrying jobs that failed this many times")
+	parser.add_argument("--batch-api", type=str, choices=LIST_NAMES_OF_BATCH_TRANSPORTS, default=None, help="Submit the jobs as batch files (openai: Batch API, in-process: send the batch files' requests from this process)")
+	parser.add_argument("--batch-files", type=str, default=str(PATH_TO_BATCH_FILES_DEFAULT), help="Folder where the batch files are written")
+	parser.add_argument("--batch-poll-interval", type=float, default=30.0, help="Seconds between checks of the status of submitted batches")
+	parser.add_argument("--trace", type=str, default=None, nargs="?", const=str(PATH_TO_TRACE_DEFAULT), help="Append a span per stage of every job (with sizes, token usage & retries) to this JSONL trace file (see trace-summary)")
+	parser.add_argument("--estimate-only", action="store_true", help="Print the estimated tokens & cost of the jobs (per prompt strategy) without running them")
+	parser.add_argument("--longest-first", action="store_true", help="Estimate the jobs and run the ones with the most tokens first")
+	parser.add_argument("--budget-tokens", type=int, default=None, help="Run the jobs longest-first until their estimated tokens reach this budget")
+	parser.add_argument("--budget-usd", type=float, default=None, help="Run the jobs longest-first until their estimated cost reaches this budget")
+	parser.add_argument("--async", dest="bool_async", action="store_true", help="Use AsyncOpenAI with an adaptive rate limiter instead of a thread pool")
+	parser.add_argument("--requests-per-minute", type=int, default=500, help="(--async) Requests-per-minute budget")
+	parser.add_argument("--tokens-per-minute", type=int, default=30000, help="(--async) Tokens-per-minute budget")
+	parser.add_argument("--max-concurrency", type=int, default=16, help="(--async) Upper bound on the adaptive number of calls in flight")
+
+	return parser
+
+
+def run_jobs(args: argparse.Namespace, list_of_jobs: list[Job]) -> list[JobOutcome]:
+
+	if args.batch_api is not None:
+		list_of_outcomes = run_batch_with_batch_api(
+			list_of_jobs,
+			make_batch_transport(args.batch_api, args.workers),
+			int_number_of_preparers=args.preparers,
+			int_number_of_prepared_jobs=args.prefetch,
+			path_to_batch_files=Path(args.batch_files),
+			float_poll_interval_seconds=args.batch_poll_interval
+		)
+
+	elif args.bool_async:
+		rate_limiter = AdaptiveRateLimiter(
+			int_requests_per_minute=args.requests_per_minute,
+			int_tokens_per_minute=args.tokens_per_minute,
+			int_max_concurrency=args.max_concurrency
+		)
+		list_of_outcomes = run_batch_async(
+			list_of_jobs,
+			rate_limiter,
+			int_number_of_preparers=args.preparers,
+			int_number_of_prepared_jobs=args.prefetch
+		)
+
+	else:
+		list_of_outcomes = run_batch(
+			list_of_jobs,
+			int_number_of_workers=args.workers,
+			int_number_of_preparers=args.preparers,
+			int_number_of_prepared_jobs=args.prefetch
+		)
+
+	return list_of_outcomes
+
+
+def main(list_of_arguments: Optional[list[str]] = None):
+
+	parser = make_argument_parser()
+	args = parser.parse_args(list_of_arguments)
+
+	# self-hosted servers have no /v1/files & /v1/batches (use --batch-api in-process)
+	list_model_apis_without_batch_api = [model_api.value for model_api in args.model_apis if not get_backend(model_api).bool_supports_batch_api]
+
+	if args.batch_api == "openai" and list_model_apis_without_batch_api:
+		parser.error(f"--batch-api openai is not supported by the backends of {list_model_apis_without_batch_api}")
+
+	# a structured output (of --single-call) is never streamed, and batches are answered whole
+	if args.stream and (args.single_call or args.batch_api is not None):
+		parser.error("--stream cannot be combined with --single-call or --batch-api")
+
+	configure_clients(int_max_connections=args.max_connections, float_timeout_seconds=args.timeout, string_base_url=args.base_url)
+	configure_call_policy(CallPolicy(
+		float_deadline_seconds=args.deadline,
+		int_max_attempts=args.call_attempts,
+		float_backoff_base_seconds=args.backoff_base,
+		float_backoff_max_seconds=args.backoff_max,
+		int_circuit_breaker_failures=args.circuit_breaker_failures,
+		float_circuit_breaker_reset_seconds=args.circuit_breaker_reset,
+		bool_hedging=args.hedge,
+		float_hedging_percentile=args.hedge_percentile,
+	))
+
+	if args.trace is not None:
+		configure_tracing(args.trace)
+
+	configure_encoded_image_cache(int(args.image_cache_max_mb * 1024 * 1024), args.image_cache)
+
+	if args.prepare_images:
+		configure_image_preparation(ImagePreparationPolicy(
+			string_format=args.image_format,
+			int_quality=args.image_quality,
+			bool_resize_to_tile_grid=args.bool_image_resize,
+			dict_detail_per_role={
+				ImageRole.SCREENSHOT: args.image_detail_screenshot,
+				ImageRole.BASELINE: args.image_detail_baseline,
+				ImageRole.ASSET: args.image_detail_asset,
+				ImageRole.ASSET_ATLAS: "high",
+			}
+		))
+
+	if args.pixel_diff or args.regions_of_interest:
+		configure_pixel_diff(PixelDiffPolicy(
+			float_threshold=args.diff_threshold,
+			int_margin=args.roi_margin,
+			int_max_regions=args.roi_max_regions,
+			bool_send_regions_of_interest=args.regions_of_interest,
+			int_side_of_region=args.roi_side,
+			int_side_of_full_frame=args.roi_full_frame_side,
+		))
+
+	if args.single_call:
+		configure_single_call(True)
+
+	if args.stream:
+		configure_streaming(True)
+
+	if args.readme_token_budget is not None:
+		configure_readme_context(args.readme_token_budget, args.readme_chunk_tokens)
+
+	if args.asset_atlas:
+		configure_asset_atlas(True, int_sheet_size=args.asset_atlas_sheet_size, path_to_cache=Path(args.asset_atlas_cache))
+
+	if args.screenshot_index is not None:
+		configure_screenshot_index(args.screenshot_index)
+
+	if args.response_cache is not None:
+		configure_response_cache(
+			args.response_cache,
+			bool_read_only=args.response_cache_read_only,
+			int_max_entries=args.response_cache_max_entries,
+			int_max_bytes=None if args.response_cache_max_mb is None else int(args.response_cache_max_mb * 1024 * 1024),
+			float_max_age_seconds=None if args.response_cache_max_age_days is None else args.response_cache_max_age_days * 24 * 60 * 60
+		)
+
+	if args.base_url is not None:
+		# answers of another server (e.g. the replay server) must not overwrite or complete the results of the model APIs
+		configure_results_store(make_path_away_from_default(args.results_store, PATH_TO_RESULTS_STORE_DEFAULT, "results.sqlite"))
+		configure_job_manifest(None if args.job_manifest is None else make_path_away_from_default(args.job_manifest, PATH_TO_JOB_MANIFEST_DEFAULT, "jobs.sqlite"))
+		print(f"Results of --base-url {args.base_url} are saved to: \"{get_results_store().path_to_store}\"")  # type: ignore
+
+	elif args.results_store is not None:
+		configure_results_store(args.results_store)
+
+	list_of_jobs = make_list_of_jobs(args.model_apis, args.prompt_strategies, args.apps, args.snapshots)
+
+	if args.job_manifest is not None and args.base_url is None:
+		configure_job_manifest(args.job_manifest)
+
+	job_manifest = get_job_manifest()
+
+	if job_manifest is not None:
+		# jobs left in flight by a run that crashed
+		int_number_reset = job_manifest.reset_in_flight()
+
+		if int_number_reset > 0:
+			print(f"Job manifest: {int_number_reset} jobs in flight when the last run stopped are pending again")
+
+		list_of_jobs = job_manifest.filter_jobs_to_run(list_of_jobs, args.max_attempts)
+
+	# walk the app repositories for README.md files once, up front
+	list_names_of_apps_with_readme = sorted({job.string_name_of_app for job in list_of_jobs if job.prompt_strategy in PROMPT_STRATEGIES_WITH_README})
+
+	if len(list_names_of_apps_with_readme) > 0:
+		warm_up_readme_index(list_names_of_apps_with_readme)
+
+	list_of_duplicates: list[tuple[Job, Job]] = []
+	screenshot_index = get_screenshot_index()
+
+	if screenshot_index is not None:
+		list_names_of_apps_of_jobs = sorted({job.string_name_of_app for job in list_of_jobs})
+		int_number_hashed = screenshot_index.update(list_names_of_apps_of_jobs)
+		list_of_jobs, list_of_duplicates = split_jobs_with_duplicate_screenshots(list_of_jobs, screenshot_index)
+		print(f"Screenshot index: {int_number_hashed} screenshots hashed, {len(list_of_duplicates)} jobs on pixel-identical screenshots will reuse a verdict")
+
+		list_near_duplicates = screenshot_index.find_near_duplicates(args.near_duplicate_distance, list_names_of_apps_of_jobs)
+
+		if len(list_near_duplicates) > 0:
+			print(f"WARNING: Screenshots that may not show their bug:\n{format_near_duplicates(list_near_duplicates)}")
+
+	if args.estimate_only or args.longest_first or args.budget_tokens is not None or args.budget_usd is not None:
+		list_of_jobs = schedule_jobs(args, list_of_jobs)
+
+	try:
+		list_of_outcomes = run_jobs(args, list_of_jobs)
+
+		if len(list_of_duplicates) > 0:
+			list_of_outcomes_reused, list_of_jobs_without_source = reuse_results_of_duplicates(list_of_duplicates, list_of_outcomes)
+			list_of_outcomes += list_of_outcomes_reused
+
+			if len(list_of_jobs_without_source) > 0:
+				list_of_outcomes += run_jobs(args, list_of_jobs_without_source)
+
+		list_of_outcomes = fail_jobs_not_written_to_results_store(list_of_outcomes)
+
+	except KeyboardInterrupt:
+
+		if job_manifest is not None:
+			print(f"Interrupted: {job_manifest.reset_in_flight()} jobs in flight are pending again in the job manifest")
+			job_manifest.close()
+
+		exit(130)
+
+	if job_manifest is not None:
+		dict_counts = job_manifest.get_counts()
+		print(f"Job manifest: {', '.join(f'{int_count} {string_status}' for string_status, int_count in dict_counts.items())}")
+		job_manifest.close()
+
+	response_cache = get_response_cache()
+
+	if response_cache is not None:
+		dict_stats = response_cache.get_stats()
+		print(f"Response cache: {dict_stats['int_number_of_hits']} hits, {dict_stats['int_number_of_misses']} misses, {dict_stats['int_number_of_entries']} entries")
+		response_cache.close()
+
+	if args.prepare_images:
+		print(image_preparation_stats.make_report())
+
+	dict_stats = get_encoded_image_cache().get_stats()
+	print(f"Encoded image cache: {dict_stats['int_number_of_hits_in_memory']} hits in memory, {dict_stats['int_number_of_hits_on_disk']} hits on disk, {dict_stats['int_number_of_misses']} misses")
+	get_encoded_image_cache().close()
+
+	if any(not outcome.bool_succeeded for outcome in list_of_outcomes):
+		exit(1)
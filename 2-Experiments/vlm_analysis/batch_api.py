@@ -0,0 +1,387 @@
+from abc import ABC, abstractmethod
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, NamedTuple, Optional, Union
+from openai import OpenAI
+from . import ModelAPI
+from .clients import get_client
+from .backends import get_backend, get_name_of_backend, get_name_of_model, limit_concurrency
+from .results_store import make_name_of_model_dir
+from .call_policy import call_with_policy, InvalidResponseError
+from .response_cache import get_response_cache, make_key_of_request
+from .tracing import span, STAGE_BATCH
+from .utilities import get_timeout_of_attempt, verify_structured_output
+
+
+PATH_TO_BATCH_FILES_DEFAULT = Path("../Data/2-Experiments/batches")
+
+# https://platform.openai.com/docs/guides/batch
+STRING_ENDPOINT_CHAT_COMPLETIONS = "/v1/chat/completions"
+STRING_COMPLETION_WINDOW = "24h"
+INT_MAX_REQUESTS_PER_FILE = 50000
+INT_MAX_BYTES_PER_FILE = 190 * 1024 * 1024  # the limit is 200 MB
+LIST_STATUSES_TERMINAL = ["completed", "failed", "expired", "cancelled"]
+
+
+class BatchRequest(NamedTuple):
+	string_custom_id: str
+	model_api: ModelAPI
+	list_of_message_dicts: list[dict]
+	dict_response_format: Optional[dict] = None
+
+
+class BatchResult(NamedTuple):
+	string_custom_id: str
+	# the message content, as get_response would return it ("" if the request failed)
+	response_content: Union[str, dict]
+	string_error: str = ""
+
+
+class BatchFile(NamedTuple):
+	model_api: ModelAPI
+	path_to_file: Path
+	list_custom_ids: list[str]
+
+
+class BatchTransport(ABC):
+	"""Where batch files are submitted to; see OpenAIBatchTransport & InProcessBatchTransport"""
+
+	@abstractmethod
+	def submit(self, batch_file: BatchFile) -> str:
+		"""Submit a batch file and return the id of the batch"""
+
+	@abstractmethod
+	def get_status(self, string_id_of_batch: str) -> str:
+		pass
+
+	@abstractmethod
+	def download_results(self, string_id_of_batch: str) -> list[dict]:
+		"""Lines of the output (and error) files of a finished batch"""
+
+
+class OpenAIBatchTransport(BatchTransport):
+	"""Batch API of OpenAI (or of any server implementing /v1/files & /v1/batches, see OPENAI_BASE_URL)"""
+
+	def __init__(self):
+		self.dict_clients_of_batches: dict[str, OpenAI] = dict()
+
+	def submit(self, batch_file: BatchFile) -> str:
+
+		# the files & batches endpoints are not model calls: the client retries them itself (the stored client is used for polling too)
+		client = get_client(batch_file.model_api)
+
+		with open(batch_file.path_to_file, "rb") as f:
+			file_object = client.files.create(file=f, purpose="batch")
+
+		batch = client.batches.create(
+			input_file_id=file_object.id,
+			endpoint=STRING_ENDPOINT_CHAT_COMPLETIONS,
+			completion_window=STRING_COMPLETION_WINDOW,
+			metadata={"description": batch_file.path_to_file.name}
+		)
+		self.dict_clients_of_batches[batch.id] = client
+
+		return batch.id
+
+	def get_status(self, string_id_of_batch: str) -> str:
+
+		batch = self.dict_clients_of_batches[string_id_of_batch].batches.retrieve(string_id_of_batch)
+
+		if batch.request_counts is not None:
+			print(f"Batch {string_id_of_batch}: {batch.status} ({batch.request_counts.completed} completed, {batch.request_counts.failed} failed, {batch.request_counts.total} total)")
+
+		return batch.status
+
+	def download_results(self, string_id_of_batch: str) -> list[dict]:
+
+		client = self.dict_clients_of_batches[string_id_of_batch]
+		batch = client.batches.retrieve(string_id_of_batch)
+
+		list_of_lines = []
+
+		# expired & cancelled batches still have the results of the requests that finished
+		for string_id_of_file in (batch.output_file_id, batch.error_file_id):
+
+			if string_id_of_file is None:
+				continue
+
+			string_content = client.files.content(string_id_of_file).text
+			list_of_lines.extend(json.loads(string_line) for string_line in string_content.splitlines() if string_line.strip())
+
+		return list_of_lines
+
+
+class InProcessBatchTransport(BatchTransport):
+	"""
+	Sends the requests of a batch file one by one to the chat completions endpoint and answers in the Batch API format.
+	For backends without a Batch API, and to run the batch mode without waiting for one.
+	"""
+
+	def __init__(self, int_number_of_workers: int = 4):
+		self.int_number_of_workers = int_number_of_workers
+		self.dict_results_of_batches: dict[str, list[dict]] = dict()
+
+	def submit(self, batch_file: BatchFile) -> str:
+
+		client = get_client(batch_file.model_api)
+		string_name_of_backend = get_name_of_backend(batch_file.model_api)
+
+		with open(batch_file.path_to_file, "r") as f:
+			list_of_requests = [json.loads(string_line) for string_line in f if string_line.strip()]
+
+		with ThreadPoolExecutor(max_workers=self.int_number_of_workers) as executor:
+			list_of_lines = list(executor.map(lambda dict_request: self.send_request(client, string_name_of_backend, dict_request), list_of_requests))
+
+		string_id_of_batch = f"in_process_{len(self.dict_results_of_batches)}_{batch_file.path_to_file.stem}"
+		self.dict_results_of_batches[string_id_of_batch] = list_of_lines
+
+		return string_id_of_batch
+
+	def send_request(self, client: OpenAI, string_name_of_backend: str, dict_request: dict) -> dict:
+
+		try:
+			with limit_concurrency(get_backend(string_name_of_backend)):
+				# the call policy retries, instead of the client, and each attempt stops at the deadline of the call
+				chat_completion = call_with_policy(
+					string_name_of_backend,
+					STAGE_BATCH,
+					lambda float_seconds_remaining: client.with_options(timeout=get_timeout_of_attempt(float_seconds_remaining), max_retries=0).chat.completions.create(**dict_request["body"])
+				)
+
+		except Exception as err:
+			return {"custom_id": dict_request["custom_id"], "response": None, "error": {"message": repr(err)}}
+
+		return {
+			"custom_id": dict_request["custom_id"],
+			"response": {"status_code": 200, "body": chat_completion.model_dump()},
+			"error": None
+		}
+
+	def get_status(self, string_id_of_batch: str) -> str:
+		return "completed"
+
+	def download_results(self, string_id_of_batch: str) -> list[dict]:
+		return self.dict_results_of_batches.pop(string_id_of_batch)
+
+
+def make_batch_transport(string_name_of_transport: str, int_number_of_workers: int = 4) -> BatchTransport:
+
+	if string_name_of_transport == "in-process":
+		return InProcessBatchTransport(int_number_of_workers)
+
+	return OpenAIBatchTransport()
+
+
+LIST_NAMES_OF_BATCH_TRANSPORTS = ["openai", "in-process"]
+
+
+class BatchFileWriter:
+	"""Writes requests to JSONL batch files, one model per file, starting a new file when one is full"""
+
+	def __init__(
+		self,
+		path_to_batch_files: Path,
+		string_name_of_stage: str,
+		int_max_requests_per_file: int = INT_MAX_REQUESTS_PER_FILE,
+		int_max_bytes_per_file: int = INT_MAX_BYTES_PER_FILE
+	):
+		self.path_to_batch_files = path_to_batch_files
+		self.string_prefix = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}_{string_name_of_stage}"
+		self.int_max_requests_per_file = int_max_requests_per_file
+		self.int_max_bytes_per_file = int_max_bytes_per_file
+
+		self.list_of_batch_files: list[BatchFile] = []
+		# open file, number of bytes written & custom ids, per model
+		self.dict_open_files: dict[ModelAPI, tuple] = dict()
+
+		self.path_to_batch_files.mkdir(parents=True, exist_ok=True)
+
+	def add(self, batch_request: BatchRequest):
+
+		# the request as the backend of the model accepts it
+		list_of_message_dicts, dict_response_format = get_backend(batch_request.model_api).adapter.adapt_request(batch_request.list_of_message_dicts, batch_request.dict_response_format)
+
+		dict_body = {
+			"model": get_name_of_model(batch_request.model_api),
+			"messages": list_of_message_dicts,
+		}
+
+		if dict_response_format is not None:
+			dict_body["response_format"] = dict_response_format
+
+		dict_line = {
+			"custom_id": batch_request.string_custom_id,
+			"method": "POST",
+			"url": STRING_ENDPOINT_CHAT_COMPLETIONS,
+			"body": dict_body,
+		}
+		bytes_line = (json.dumps(dict_line) + "\n").encode("utf-8")
+
+		if batch_request.model_api in self.dict_open_files:
+			f, _, int_number_of_bytes, list_custom_ids = self.dict_open_files[batch_request.model_api]
+
+			if len(list_custom_ids) >= self.int_max_requests_per_file or int_number_of_bytes + len(bytes_line) > self.int_max_bytes_per_file:
+				self.close_file(batch_request.model_api)
+
+		if batch_request.model_api not in self.dict_open_files:
+			self.open_file(batch_request.model_api)
+
+		f, path_to_file, int_number_of_bytes, list_custom_ids = self.dict_open_files[batch_request.model_api]
+		f.write(bytes_line)
+		list_custom_ids.append(batch_request.string_custom_id)
+		self.dict_open_files[batch_request.model_api] = (f, path_to_file, int_number_of_bytes + len(bytes_line), list_custom_ids)
+
+	def open_file(self, model_api: ModelAPI):
+		string_name_of_model = make_name_of_model_dir(model_api.value)
+		path_to_file = self.path_to_batch_files / f"{self.string_prefix}_{string_name_of_model}_{len(self.list_of_batch_files)}.jsonl"
+		self.dict_open_files[model_api] = (open(path_to_file, "wb"), path_to_file, 0, [])
+
+	def close_file(self, model_api: ModelAPI):
+		f, path_to_file, _, list_custom_ids = self.dict_open_files.pop(model_api)
+		f.close()
+		self.list_of_batch_files.append(BatchFile(model_api, path_to_file, list_custom_ids))
+
+	def close(self) -> list[BatchFile]:
+
+		for model_api in list(self.dict_open_files):
+			self.close_file(model_api)
+
+		return self.list_of_batch_files
+
+
+def submit_and_wait(list_of_batch_files: list[BatchFile], transport: BatchTransport, float_poll_interval_seconds: float = 30.0) -> dict[str, BatchResult]:
+	"""Submit every batch file, poll until all batches are finished and collect the results by custom id"""
+
+	dict_ids_of_batches = dict()
+
+	for batch_file in list_of_batch_files:
+		string_id_of_batch = transport.submit(batch_file)
+		dict_ids_of_batches[string_id_of_batch] = batch_file
+		print(f"Submitted batch {string_id_of_batch} ({len(batch_file.list_custom_ids)} requests) from: \"{batch_file.path_to_file}\"")
+
+	dict_results: dict[str, BatchResult] = dict()
+	set_ids_of_batches_pending = set(dict_ids_of_batches)
+
+	while len(set_ids_of_batches_pending) > 0:
+
+		for string_id_of_batch in sorted(set_ids_of_batches_pending):
+
+			string_status = transport.get_status(string_id_of_batch)
+
+			if string_status not in LIST_STATUSES_TERMINAL:
+				continue
+
+			set_ids_of_batches_pending.remove(string_id_of_batch)
+
+			if string_status != "completed":
+				print(f"WARNING: Batch {string_id_of_batch} finished with status: {string_status}")
+
+			for dict_line in transport.download_results(string_id_of_batch):
+				batch_result = parse_line_of_results(dict_line)
+				dict_results[batch_result.string_custom_id] = batch_result
+
+		if len(set_ids_of_batches_pending) > 0:
+			time.sleep(float_poll_interval_seconds)
+
+	# requests of failed/expired batches have no line at all
+	for string_id_of_batch, batch_file in dict_ids_of_batches.items():
+
+		for string_custom_id in batch_file.list_custom_ids:
+
+			if string_custom_id not in dict_results:
+				dict_results[string_custom_id] = BatchResult(string_custom_id, "", f"No result in batch {string_id_of_batch}")
+
+	return dict_results
+
+
+def parse_line_of_results(dict_line: dict) -> BatchResult:
+
+	string_custom_id = dict_line["custom_id"]
+	dict_response = dict_line.get("response")
+
+	if dict_line.get("error") is not None:
+		return BatchResult(string_custom_id, "", str(dict_line["error"].get("message", dict_line["error"])))
+
+	if dict_response is None or dict_response.get("status_code") != 200:
+		return BatchResult(string_custom_id, "", f"Request failed: {dict_response}")
+
+	try:
+		# the content of a structured output is its JSON string, just like extract_response_structured_output_openai returns
+		return BatchResult(string_custom_id, dict_response["body"]["choices"][0]["message"]["content"])
+
+	except (KeyError, IndexError, TypeError) as err:
+		return BatchResult(string_custom_id, "", f"Caught error while grabbing response message content: {err!r}")
+
+
+def verify_batch_result(batch_result: BatchResult, dict_response_format: Optional[dict]) -> BatchResult:
+	"""The result, or a failed result if its structured output is not JSON or misses a required field of its schema"""
+
+	if dict_response_format is None or batch_result.string_error or not batch_result.response_content:
+		return batch_result
+
+	try:
+		verify_structured_output(batch_result.response_content, dict_response_format)  # type: ignore
+
+	except InvalidResponseError as err:
+		return BatchResult(batch_result.string_custom_id, "", str(err))
+
+	return batch_result
+
+
+def run_stage(
+	iterable_of_requests: Iterable[BatchRequest],
+	transport: BatchTransport,
+	string_name_of_stage: str,
+	path_to_batch_files: Path = PATH_TO_BATCH_FILES_DEFAULT,
+	float_poll_interval_seconds: float = 30.0
+) -> dict[str, BatchResult]:
+	"""
+	Answer a set of requests through batch files.
+	Requests answered before are taken from the response cache (if enabled) and not submitted again,
+	and new answers are added to it, so a stage that failed half-way only resubmits what is missing.
+	"""
+
+	response_cache = get_response_cache()
+	writer = BatchFileWriter(path_to_batch_files, string_name_of_stage)
+
+	dict_results: dict[str, BatchResult] = dict()
+	dict_keys_of_requests: dict[str, str] = dict()
+	dict_response_formats: dict[str, Optional[dict]] = dict()
+
+	for batch_request in iterable_of_requests:
+
+		dict_response_formats[batch_request.string_custom_id] = batch_request.dict_response_format
+
+		if response_cache is not None:
+			string_key = make_key_of_request(batch_request.model_api, batch_request.list_of_message_dicts, batch_request.dict_response_format)
+			batch_result_cached = verify_batch_result(BatchResult(batch_request.string_custom_id, response_cache.get(string_key) or ""), batch_request.dict_response_format)
+
+			# an answer cached before it was checked (or none) is asked again
+			if not batch_result_cached.string_error and batch_result_cached.response_content:
+				dict_results[batch_request.string_custom_id] = batch_result_cached
+				continue
+
+			dict_keys_of_requests[batch_request.string_custom_id] = string_key
+
+		writer.add(batch_request)
+
+	list_of_batch_files = writer.close()
+
+	print(f"Stage {string_name_of_stage}: {len(dict_results)} requests answered from the response cache, {sum(len(batch_file.list_custom_ids) for batch_file in list_of_batch_files)} submitted in {len(list_of_batch_files)} batch file(s)")
+
+	with span(STAGE_BATCH, string_name_of_stage=string_name_of_stage, int_number_of_requests=sum(len(batch_file.list_custom_ids) for batch_file in list_of_batch_files)):
+		dict_results_submitted = submit_and_wait(list_of_batch_files, transport, float_poll_interval_seconds)
+
+	for string_custom_id, batch_result in dict_results_submitted.items():
+
+		# the same check as the structured outputs of get_response, before the answer is cached (a batch is not retried, the job fails instead)
+		batch_result = verify_batch_result(batch_result, dict_response_formats.get(string_custom_id))
+		dict_results[string_custom_id] = batch_result
+
+		if response_cache is not None and not batch_result.string_error and batch_result.response_content and string_custom_id in dict_keys_of_requests:
+			response_cache.set(dict_keys_of_requests[string_custom_id], batch_result.response_content)
+
+	return dict_results
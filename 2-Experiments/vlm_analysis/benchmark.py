@@ -0,0 +1,406 @@
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, NamedTuple, Optional
+import numpy as np
+from PIL import Image
+from . import PromptStrategy, ModelAPI
+from .image_cache import configure_encoded_image_cache, get_encoded_image_cache
+from .image_preparation import ImagePreparationPolicy, configure_image_preparation
+from .asset_atlas import configure_asset_atlas
+from .readme_index import configure_readme_index
+from .readme_context import configure_readme_context
+from .results_store import configure_results_store, make_name_of_model_dir
+from .tracing import configure_tracing
+from .utilities import (
+	load_and_encode_image,
+	load_encoded_image,
+	load_bugfree_baseline_image,
+	load_assets,
+	load_original_application_README,
+	load_results,
+	make_list_of_message_dicts_with_images_and_assets,
+)
+from .script_compile_results import compile_results_for_model_with_strategy
+
+
+PATH_TO_BASELINE_DEFAULT = Path("../Data/2-Experiments/benchmarks/baseline.json")
+
+SNAPSHOT_NAMES = ["clean", "bug_layout", "bug_state", "bug_rendering", "bug_appearance"]
+
+# shaped like the real data: 1280x720 screenshots, a few dozen sprites per app, monorepos with many READMEs
+INT_WIDTH_OF_SCREENSHOT = 1280
+INT_HEIGHT_OF_SCREENSHOT = 720
+INT_NUMBER_OF_APPS_DEFAULT = 4
+INT_NUMBER_OF_ASSETS_DEFAULT = 40
+INT_NUMBER_OF_PACKAGES_WITH_README = 6
+INT_NUMBER_OF_DEPENDENCIES = 40
+FLOAT_TOLERANCE_DEFAULT = 0.25
+# sub-millisecond benchmarks are looped, so that timer resolution and scheduling noise average out
+FLOAT_MIN_SECONDS_PER_REPEAT = 0.05
+INT_MAX_LOOPS_PER_REPEAT = 1000
+
+
+class Benchmark(NamedTuple):
+	string_name: str
+	# untimed, before each repeat; its return value is passed to function_run
+	function_setup: Callable[[], Any]
+	function_run: Callable[[Any], Any]
+	function_teardown: Optional[Callable[[], Any]] = None
+
+
+class BenchmarkResult(NamedTuple):
+	string_name: str
+	int_repeats: int
+	float_median_seconds: float
+	float_min_seconds: float
+	float_max_seconds: float
+
+
+def make_screenshot(rng: np.random.Generator, path_to_png: Path):
+	"""A gradient background with flat-coloured shapes: compresses like a canvas screenshot, unlike noise"""
+
+	array_x = np.linspace(0, 255, INT_WIDTH_OF_SCREENSHOT, dtype=np.float32)
+	array_y = np.linspace(0, 255, INT_HEIGHT_OF_SCREENSHOT, dtype=np.float32)[:, None]
+	array_image = np.empty((INT_HEIGHT_OF_SCREENSHOT, INT_WIDTH_OF_SCREENSHOT, 3), dtype=np.uint8)
+	array_image[..., 0] = (array_x * 0.5 + array_y * 0.2).astype(np.uint8)
+	array_image[..., 1] = (array_y * 0.6).astype(np.uint8)
+	array_image[..., 2] = 128
+
+	for _ in range(60):
+		int_x, int_y = int(rng.integers(0, INT_WIDTH_OF_SCREENSHOT - 40)), int(rng.integers(0, INT_HEIGHT_OF_SCREENSHOT - 40))
+		int_width, int_height = int(rng.integers(8, 200)), int(rng.integers(8, 120))
+		array_image[int_y:int_y + int_height, int_x:int_x + int_width] = rng.integers(0, 256, 3, dtype=np.uint8)
+
+	Image.fromarray(array_image).save(path_to_png, format="PNG")
+
+
+def make_sprite(rng: np.random.Generator, path_to_png: Path):
+
+	int_width, int_height = int(rng.integers(16, 129)), int(rng.integers(16, 129))
+	array_image = np.zeros((int_height, int_width, 4), dtype=np.uint8)
+	array_image[int_height // 4:3 * int_height // 4, int_width // 4:3 * int_width // 4] = [*rng.integers(0, 256, 3), 255]
+	array_image[..., :3] |= rng.integers(0, 32, (int_height, int_width, 3), dtype=np.uint8)
+
+	Image.fromarray(array_image, mode="RGBA").save(path_to_png, format="PNG")
+
+
+def make_readme(rng: np.random.Generator, string_title: str, int_number_of_sections: int) -> str:
+
+	list_words = ["canvas", "render", "sprite", "layer", "scene", "player", "install", "build", "option", "plugin", "event", "texture", "zoom", "track", "panel"]
+	list_parts = [
+		f"# {string_title}",
+		"[![Build](https://img.shields.io/badge/build-passing-green.svg)](https://ci.example.com) [![npm](https://img.shields.io/npm/v/x.svg)](https://npmjs.com)",
+		'<p align="center"><img src="docs/logo.png" width="200"></p>',
+	]
+
+	for int_section in range(int_number_of_sections):
+		list_parts.append(f"## Section {int_section}")
+		list_parts.append(" ".join(rng.choice(list_words, 120)))
+		list_parts.append("```js\nconst app = new Application({ width: 800, height: 600 });\n```")
+
+	list_parts.append("## License\n\nMIT")
+
+	return "\n\n".join(list_parts) + "\n"
+
+
+def make_fixtures(path_to_root: Path, int_number_of_apps: int = INT_NUMBER_OF_APPS_DEFAULT, int_number_of_assets: int = INT_NUMBER_OF_ASSETS_DEFAULT, int_seed: int = 0) -> list[str]:
+	"""
+	Write a synthetic copy of the data layout under path_to_root (with 2-Experiments/ as the working directory):
+	screenshots, asset folders, app repositories with README trees, and a results folder for every prompt strategy.
+	Returns the names of the apps.
+	"""
+	rng = np.random.default_rng(int_seed)
+	list_names_of_apps = [f"bench-app-{int_index}" for int_index in range(int_number_of_apps)]
+
+	(path_to_root / "2-Experiments").mkdir(parents=True, exist_ok=True)
+
+	with open(path_to_root / ".env", "w") as f:
+		f.write("VLM_CANVAS_BUGS_EXTERNAL_REPOS_PATH=repos\n")
+
+	for string_name_of_app in list_names_of_apps:
+
+		path_to_screenshots = path_to_root / "Data/1d-Collecting_Screenshots/screenshots" / string_name_of_app
+		path_to_screenshots.mkdir(parents=True, exist_ok=True)
+
+		for string_name_of_snapshot in SNAPSHOT_NAMES:
+			make_screenshot(rng, path_to_screenshots / f"{string_name_of_snapshot}.png")
+
+		for int_index in range(int_number_of_assets):
+			path_to_asset = path_to_root / "Data/1d-Collecting_Screenshots/assets" / string_name_of_app / f"group_{int_index % 4}" / f"sprite_{int_index}.png"
+			path_to_asset.parent.mkdir(parents=True, exist_ok=True)
+			make_sprite(rng, path_to_asset)
+
+		path_to_repo = path_to_root / "repos" / string_name_of_app
+		path_to_repo.mkdir(parents=True, exist_ok=True)
+		(path_to_repo / "README.md").write_text(make_readme(rng, string_name_of_app, 12))
+
+		for int_index in range(INT_NUMBER_OF_PACKAGES_WITH_README):
+			path_to_package = path_to_repo / "packages" / f"package_{int_index}"
+			(path_to_package / "src").mkdir(parents=True, exist_ok=True)
+			(path_to_package / "README.md").write_text(make_readme(rng, f"package_{int_index}", 3))
+			(path_to_package / "src" / "index.js").write_text("export default {};\n")
+
+		# pruned by the README walk, but there in the real repositories
+		for int_index in range(INT_NUMBER_OF_DEPENDENCIES):
+			path_to_dependency = path_to_repo / "node_modules" / f"dependency_{int_index}"
+			path_to_dependency.mkdir(parents=True, exist_ok=True)
+			(path_to_dependency / "README.md").write_text(make_readme(rng, f"dependency_{int_index}", 2))
+
+		# the model the benchmarks load results of
+		for model_api in [list(ModelAPI)[0]]:
+
+			for prompt_strategy in PromptStrategy:
+
+				path_to_results = path_to_root / "Data/2-Experiments/results" / make_name_of_model_dir(model_api.value) / prompt_strategy.value / string_name_of_app
+				path_to_results.mkdir(parents=True, exist_ok=True)
+
+				for string_name_of_snapshot in SNAPSHOT_NAMES:
+					(path_to_results / f"{string_name_of_snapshot}.txt").write_text(" ".join(rng.choice(["the", "canvas", "shows", "a", "bug", "sprite"], 300)))
+					# encoded twice, as save_results does
+					string_answer = json.dumps({"bool_did_detect_visual_bug": string_name_of_snapshot != "clean", "string_description_of_visual_bug": "A sprite is misplaced"})
+					(path_to_results / f"{string_name_of_snapshot}.json").write_text(json.dumps(string_answer))
+
+	return list_names_of_apps
+
+
+def make_benchmarks(list_names_of_apps: list[str]) -> list[Benchmark]:
+
+	string_name_of_app = list_names_of_apps[0]
+	model_api = list(ModelAPI)[0]
+	path_to_screenshots = Path("../Data/1d-Collecting_Screenshots/screenshots") / string_name_of_app
+
+	def encode_screenshots(_):
+		for string_name_of_snapshot in SNAPSHOT_NAMES:
+			load_and_encode_image(path_to_screenshots / f"{string_name_of_snapshot}.png")
+
+	def load_messages_inputs():
+		list_of_tuples = [
+			("user", "Here is a bug-free screenshot.", load_bugfree_baseline_image(string_name_of_app)),
+			("user", "Does this screenshot display any visual bugs?", load_encoded_image(string_name_of_app, "bug_layout")),
+		]
+		return list_of_tuples, load_assets(string_name_of_app)
+
+	def prepare_images():
+		configure_image_preparation(ImagePreparationPolicy())
+		get_encoded_image_cache().clear_prepared_images()
+		return load_messages_inputs()
+
+	def load_readmes(_):
+		for string_name in list_names_of_apps:
+			load_original_application_README(string_name)
+
+	def load_all_results(_):
+		for string_name in list_names_of_apps:
+			for string_name_of_snapshot in SNAPSHOT_NAMES:
+				load_results(model_api, PromptStrategy.BASELINE, string_name, string_name_of_snapshot)
+
+	def compile_all_results(_):
+		for prompt_strategy in PromptStrategy:
+			compile_results_for_model_with_strategy(model_api, prompt_strategy)
+
+	return [
+		Benchmark("load_and_encode_image/cold", lambda: configure_encoded_image_cache(), encode_screenshots),
+		Benchmark("load_and_encode_image/warm", lambda: None, encode_screenshots),
+		Benchmark("load_assets/cold", lambda: configure_encoded_image_cache(), lambda _: load_assets(string_name_of_app)),
+		Benchmark("load_assets/warm", lambda: None, lambda _: load_assets(string_name_of_app)),
+		Benchmark("make_list_of_message_dicts_with_images_and_assets", load_messages_inputs, lambda args: make_list_of_message_dicts_with_images_and_assets(*args)),
+		Benchmark("make_list_of_message_dicts_with_images_and_assets/prepared", prepare_images, lambda args: make_list_of_message_dicts_with_images_and_assets(*args), lambda: configure_image_preparation(None)),
+		Benchmark("load_original_application_README/cold", lambda: configure_readme_index(None), load_readmes),
+		Benchmark("load_original_application_README/warm", lambda: None, load_readmes),
+		Benchmark("load_results", lambda: None, load_all_results),
+		Benchmark("compile_results_for_model_with_strategy", lambda: None, compile_all_results),
+	]
+
+
+def time_benchmark_once(benchmark: Benchmark) -> float:
+
+	# the functions print a line per file, which would drown the report
+	with contextlib.redirect_stdout(io.StringIO()):
+		argument = benchmark.function_setup()
+		float_time_start = time.perf_counter()
+		benchmark.function_run(argument)
+		float_duration_seconds = time.perf_counter() - float_time_start
+
+		if benchmark.function_teardown is not None:
+			benchmark.function_teardown()
+
+	return float_duration_seconds
+
+
+def run_benchmark(benchmark: Benchmark, int_repeats: int) -> BenchmarkResult:
+	"""Median of int_repeats timings, each averaged over enough loops to last FLOAT_MIN_SECONDS_PER_REPEAT (as timeit does)"""
+
+	# the first run is a warm-up (imports, page cache, warm caches for the /warm benchmarks)
+	float_duration_of_warm_up = time_benchmark_once(benchmark)
+	int_number_of_loops = min(INT_MAX_LOOPS_PER_REPEAT, max(1, math.ceil(FLOAT_MIN_SECONDS_PER_REPEAT / max(float_duration_of_warm_up, 1e-9))))
+
+	list_durations = [
+		sum(time_benchmark_once(benchmark) for _ in range(int_number_of_loops)) / int_number_of_loops
+		for _ in range(int_repeats)
+	]
+
+	return BenchmarkResult(benchmark.string_name, int_repeats, statistics.median(list_durations), min(list_durations), max(list_durations))
+
+
+def run_benchmarks(
+	int_number_of_apps: int = INT_NUMBER_OF_APPS_DEFAULT,
+	int_number_of_assets: int = INT_NUMBER_OF_ASSETS_DEFAULT,
+	int_repeats: int = 10,
+	list_names_selected: Optional[list[str]] = None
+) -> list[BenchmarkResult]:
+	"""Run the benchmarks on fresh synthetic fixtures in a temporary folder (the real data is never touched)"""
+
+	string_cwd = os.getcwd()
+	string_repos_path = os.environ.get("VLM_CANVAS_BUGS_EXTERNAL_REPOS_PATH")
+
+	with tempfile.TemporaryDirectory(prefix="vlm_analysis_benchmark_") as string_path_to_root:
+
+		list_names_of_apps = make_fixtures(Path(string_path_to_root), int_number_of_apps, int_number_of_assets)
+
+		# the loaders use paths relative to 2-Experiments/, and load_dotenv does not override a variable already set
+		os.chdir(Path(string_path_to_root) / "2-Experiments")
+		os.environ["VLM_CANVAS_BUGS_EXTERNAL_REPOS_PATH"] = "repos"
+
+		# the code paths as in the paper: no optional stores or transformations
+		configure_results_store(None)
+		configure_asset_atlas(False)
+		configure_image_preparation(None)
+		configure_readme_context(None)
+		configure_tracing(None)
+		configure_readme_index(None)
+		configure_encoded_image_cache()
+
+		list_results = []
+
+		try:
+			for benchmark in make_benchmarks(list_names_of_apps):
+
+				if list_names_selected is not None and not any(string_name in benchmark.string_name for string_name in list_names_selected):
+					continue
+
+				benchmark_result = run_benchmark(benchmark, int_repeats)
+				list_results.append(benchmark_result)
+				print(f"{benchmark_result.string_name:<60} median {benchmark_result.float_median_seconds * 1000:9.2f} ms  (min {benchmark_result.float_min_seconds * 1000:.2f}, max {benchmark_result.float_max_seconds * 1000:.2f})")
+
+		finally:
+			os.chdir(string_cwd)
+
+			if string_repos_path is None:
+				os.environ.pop("VLM_CANVAS_BUGS_EXTERNAL_REPOS_PATH", None)
+
+			else:
+				os.environ["VLM_CANVAS_BUGS_EXTERNAL_REPOS_PATH"] = string_repos_path
+
+	return list_results
+
+
+def make_metadata(int_number_of_apps: int, int_number_of_assets: int) -> dict:
+	# baselines are only comparable on the same machine and fixtures
+	return {
+		"string_platform": platform.platform(),
+		"string_python": platform.python_version(),
+		"string_processor": platform.processor(),
+		"int_number_of_apps": int_number_of_apps,
+		"int_number_of_assets": int_number_of_assets,
+	}
+
+
+def save_baseline(path_to_baseline: Path, list_results: list[BenchmarkResult], dict_metadata: dict):
+
+	path_to_baseline.parent.mkdir(parents=True, exist_ok=True)
+
+	with open(path_to_baseline, "w") as f:
+		json.dump({
+			"dict_metadata": dict_metadata,
+			"float_time_saved": time.time(),
+			"dict_benchmarks": {benchmark_result.string_name: benchmark_result._asdict() for benchmark_result in list_results},
+		}, f, indent=2)
+
+	print(f"Saved baseline of {len(list_results)} benchmarks to \"{path_to_baseline}\"")
+
+
+def compare_to_baseline(path_to_baseline: Path, list_results: list[BenchmarkResult], dict_metadata: dict, float_tolerance: float) -> list[str]:
+	"""Print how each benchmark compares to the baseline; returns the names of the regressions"""
+
+	with open(path_to_baseline, "r") as f:
+		dict_baseline = json.load(f)
+
+	if dict_baseline.get("dict_metadata") != dict_metadata:
+		print(f"WARNING: The baseline was recorded on another machine or with other fixtures: {dict_baseline.get('dict_metadata')}")
+
+	list_names_of_regressions = []
+
+	for benchmark_result in list_results:
+
+		dict_result_of_baseline = dict_baseline["dict_benchmarks"].get(benchmark_result.string_name)
+
+		if dict_result_of_baseline is None:
+			print(f"{benchmark_result.string_name:<60} (not in baseline)")
+			continue
+
+		# the fastest repeat is the least disturbed by other processes (as timeit recommends)
+		float_ratio = benchmark_result.float_min_seconds / max(dict_result_of_baseline["float_min_seconds"], 1e-9)
+
+		if float_ratio > 1 + float_tolerance:
+			string_verdict = "REGRESSION"
+			list_names_of_regressions.append(benchmark_result.string_name)
+
+		elif float_ratio < 1 - float_tolerance:
+			string_verdict = "faster"
+
+		else:
+			string_verdict = "ok"
+
+		print(f"{benchmark_result.string_name:<60} {float_ratio:6.2f}x baseline  {string_verdict}")
+
+	return list_names_of_regressions
+
+
+def main(list_of_arguments: Optional[list[str]] = None):
+
+	parser = argparse.ArgumentParser(
+		prog='python3 -m vlm_analysis.benchmark',
+		description='Micro-benchmarks of the local data path (image encoding, assets, messages, READMEs, results) on synthetic fixtures',
+	)
+	parser.add_argument("--apps", type=int, default=INT_NUMBER_OF_APPS_DEFAULT, help="Number of synthetic apps")
+	parser.add_argument("--assets", type=int, default=INT_NUMBER_OF_ASSETS_DEFAULT, help="Number of sprites per app")
+	parser.add_argument("--repeats", type=int, default=10)
+	parser.add_argument("--only", type=str, nargs="+", default=None, help="Only run the benchmarks whose name contains one of these")
+	parser.add_argument("--baseline", type=str, default=str(PATH_TO_BASELINE_DEFAULT))
+	parser.add_argument("--save-baseline", action="store_true", help="Save the results as the new baseline instead of comparing to it")
+	parser.add_argument("--tolerance", type=float, default=FLOAT_TOLERANCE_DEFAULT, help="Flag a regression when the fastest repeat is this fraction slower than in the baseline")
+	args = parser.parse_args(list_of_arguments)
+
+	# resolved before the benchmarks change the working directory
+	path_to_baseline = Path(args.baseline).resolve()
+	dict_metadata = make_metadata(args.apps, args.assets)
+
+	list_results = run_benchmarks(args.apps, args.assets, args.repeats, args.only)
+
+	if args.save_baseline:
+		save_baseline(path_to_baseline, list_results, dict_metadata)
+		return
+
+	if not path_to_baseline.is_file():
+		print(f"No baseline at \"{path_to_baseline}\" (run with --save-baseline to record one)")
+		return
+
+	list_names_of_regressions = compare_to_baseline(path_to_baseline, list_results, dict_metadata, args.tolerance)
+
+	if len(list_names_of_regressions) > 0:
+		print(f"{len(list_names_of_regressions)} regressions: {', '.join(list_names_of_regressions)}")
+		exit(1)
+
+
+if __name__ == "__main__":
+
+	main()
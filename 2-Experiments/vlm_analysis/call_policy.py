@@ -0,0 +1,426 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional, TypeVar
+import numpy as np
+from openai import APIConnectionError, APIStatusError, APITimeoutError, RateLimitError
+from .rate_limiting import parse_retry_after
+from .tracing import add_to_current_span, contextvar_labels_of_job
+
+
+T = TypeVar("T")
+
+# status codes worth retrying: request timeout, conflict, rate limited, and server errors
+SET_RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+INT_NUMBER_OF_LATENCIES_KEPT = 200
+
+
+class InvalidResponseError(ValueError):
+	"""The model API answered, but without usable content (no choices, empty content, or a structured output not matching its schema)"""
+
+
+class CircuitOpenError(RuntimeError):
+	"""Calls to a backend are suspended after too many consecutive failures"""
+
+
+class DeadlineExceededError(TimeoutError):
+	"""A call did not succeed before its deadline, retries included"""
+
+
+@dataclass(frozen=True)
+class CallPolicy:
+	"""How model API calls are retried, timed out, suspended (circuit breaker) and hedged"""
+	# total seconds for a call, retries included (each attempt also stops at the timeout of the clients)
+	float_deadline_seconds: Optional[float] = 900.0
+	int_max_attempts: int = 5
+	# exponential backoff with full jitter: a random wait of up to base * 2^(attempt - 1), capped
+	float_backoff_base_seconds: float = 1.0
+	float_backoff_max_seconds: float = 60.0
+	# consecutive failures of a backend (not counting rate limits) that open its circuit, and seconds until a call may try again
+	int_circuit_breaker_failures: int = 5
+	float_circuit_breaker_reset_seconds: float = 30.0
+	# send a duplicate request when a call takes longer than this percentile of the latencies of its stage
+	bool_hedging: bool = False
+	float_hedging_percentile: float = 95.0
+	int_min_latencies_for_hedging: int = 20
+
+
+class CircuitBreaker:
+	"""
+	Closed: calls go through. Open (after int_circuit_breaker_failures consecutive failures): calls wait, or fail if their deadline is too close.
+	Half-open (float_circuit_breaker_reset_seconds later): one trial call goes through, and closes the circuit if it succeeds.
+	"""
+
+	def __init__(self, string_name_of_backend: str, int_failures_to_open: int, float_reset_seconds: float):
+		self.string_name_of_backend = string_name_of_backend
+		self.int_failures_to_open = int_failures_to_open
+		self.float_reset_seconds = float_reset_seconds
+		self.int_number_of_consecutive_failures = 0
+		self.float_time_opened: Optional[float] = None
+		self.bool_trial_in_flight = False
+		self.lock = threading.Lock()
+
+	def get_seconds_until_allowed(self) -> float:
+		"""0 if a call may go through now (and it becomes the trial call of a half-open circuit)"""
+
+		with self.lock:
+
+			if self.float_time_opened is None:
+				return 0.0
+
+			float_seconds_until_half_open = self.float_time_opened + self.float_reset_seconds - time.monotonic()
+
+			if float_seconds_until_half_open > 0:
+				return float_seconds_until_half_open
+
+			if self.bool_trial_in_flight:
+				return min(1.0, self.float_reset_seconds)
+
+			self.bool_trial_in_flight = True
+			return 0.0
+
+	def record_success(self):
+
+		with self.lock:
+
+			if self.float_time_opened is not None:
+				print(f"Circuit breaker of {self.string_name_of_backend}: closed again")
+
+			self.int_number_of_consecutive_failures = 0
+			self.float_time_opened = None
+			self.bool_trial_in_flight = False
+
+	def record_failure(self):
+
+		with self.lock:
+			self.int_number_of_consecutive_failures += 1
+
+			# a failed trial opens the circuit again for another float_reset_seconds
+			if self.bool_trial_in_flight or (self.float_time_opened is None and self.int_number_of_consecutive_failures >= self.int_failures_to_open):
+				print(f"WARNING: Circuit breaker of {self.string_name_of_backend}: open for {self.float_reset_seconds}s after {self.int_number_of_consecutive_failures} consecutive failures")
+				self.float_time_opened = time.monotonic()
+
+			self.bool_trial_in_flight = False
+
+
+class LatencyTracker:
+	"""Latencies of the latest successful calls of each stage, for the hedging threshold"""
+
+	def __init__(self):
+		self.dict_latencies: dict[str, collections.deque] = dict()
+		self.lock = threading.Lock()
+
+	def add(self, string_key: str, float_seconds: float):
+		with self.lock:
+			self.dict_latencies.setdefault(string_key, collections.deque(maxlen=INT_NUMBER_OF_LATENCIES_KEPT)).append(float_seconds)
+
+	def get_percentile(self, string_key: str, float_percentile: float, int_min_latencies: int) -> Optional[float]:
+
+		with self.lock:
+			list_latencies = list(self.dict_latencies.get(string_key, ()))
+
+		if len(list_latencies) < int_min_latencies:
+			return None
+
+		return float(np.percentile(list_latencies, float_percentile))
+
+
+def is_retryable(err: BaseException) -> bool:
+
+	if isinstance(err, (APITimeoutError, APIConnectionError, RateLimitError, InvalidResponseError, TimeoutError)):
+		return True
+
+	if isinstance(err, APIStatusError):
+		return err.status_code in SET_RETRYABLE_STATUS_CODES or err.status_code >= 500
+
+	return False
+
+
+def counts_as_failure_of_backend(err: BaseException) -> bool:
+	# rate limits & unusable answers do not mean the backend is down
+	return is_retryable(err) and not isinstance(err, (RateLimitError, InvalidResponseError))
+
+
+def describe_error(err: BaseException) -> str:
+	# the message of an API error repeats its whole body
+	if isinstance(err, APIStatusError):
+		return f"{type(err).__name__}, status {err.status_code}"
+
+	return repr(err)
+
+
+def get_seconds_of_backoff(policy: CallPolicy, int_attempt: int, err: BaseException) -> float:
+
+	float_seconds = random.uniform(0.0, min(policy.float_backoff_max_seconds, policy.float_backoff_base_seconds * 2 ** (int_attempt - 1)))
+
+	# never retry before the server says so
+	if isinstance(err, APIStatusError):
+		float_seconds_retry_after = parse_retry_after(err.response.headers)
+
+		if float_seconds_retry_after is not None:
+			float_seconds = max(float_seconds, float_seconds_retry_after)
+
+	return float_seconds
+
+
+def make_key_of_latencies(string_name_of_backend: str, string_stage: str) -> str:
+	# the README strategies are much slower than the others, so each strategy has its own threshold
+	dict_labels = contextvar_labels_of_job.get() or dict()
+	return f"{string_name_of_backend}/{string_stage}/{dict_labels.get('string_prompt_strategy', '')}"
+
+
+def get_seconds_remaining(float_time_of_deadline: Optional[float]) -> Optional[float]:
+	return None if float_time_of_deadline is None else float_time_of_deadline - time.monotonic()
+
+
+def call_with_policy(string_name_of_backend: str, string_stage: str, function: Callable[[Optional[float]], T], bool_hedging_allowed: bool = True) -> T:
+	"""
+	Call function(float_timeout_seconds) (a single attempt of a model API call) with the call policy:
+	retries with backoff, a deadline, the circuit breaker of the backend, and hedging (if enabled and allowed,
+	i.e. not for calls with side effects, such as a stream written to a file).
+	"""
+	policy = get_call_policy()
+	circuit_breaker = get_circuit_breaker(string_name_of_backend)
+	string_key_of_latencies = make_key_of_latencies(string_name_of_backend, string_stage)
+	float_time_of_deadline = None if policy.float_deadline_seconds is None else time.monotonic() + policy.float_deadline_seconds
+
+	for int_attempt in range(1, policy.int_max_attempts + 1):
+
+		while True:
+			float_seconds_to_wait = circuit_breaker.get_seconds_until_allowed()
+
+			if float_seconds_to_wait <= 0:
+				break
+
+			check_deadline_allows_wait(float_time_of_deadline, float_seconds_to_wait, string_name_of_backend)
+			time.sleep(float_seconds_to_wait)
+
+		float_time_start = time.monotonic()
+
+		try:
+			float_seconds_of_hedging = get_seconds_of_hedging(policy, string_key_of_latencies) if bool_hedging_allowed else None
+
+			if float_seconds_of_hedging is None:
+				result = function(get_seconds_remaining(float_time_of_deadline))
+
+			else:
+				result = call_hedged(function, float_seconds_of_hedging, get_seconds_remaining(float_time_of_deadline))
+
+		except Exception as err:
+			time.sleep(handle_failure(policy, circuit_breaker, err, int_attempt, float_time_of_deadline, string_name_of_backend))
+			continue
+
+		circuit_breaker.record_success()
+		latency_tracker.add(string_key_of_latencies, time.monotonic() - float_time_start)
+
+		return result
+
+	# unreachable: handle_failure raises on the last attempt
+	raise DeadlineExceededError(f"No attempt left for a call to {string_name_of_backend}")
+
+
+async def call_with_policy_async(string_name_of_backend: str, string_stage: str, function: Callable[[Optional[float]], Awaitable[T]], bool_hedging_allowed: bool = True) -> T:
+	"""asyncio variant of call_with_policy; a hedged duplicate that loses is cancelled"""
+
+	policy = get_call_policy()
+	circuit_breaker = get_circuit_breaker(string_name_of_backend)
+	string_key_of_latencies = make_key_of_latencies(string_name_of_backend, string_stage)
+	float_time_of_deadline = None if policy.float_deadline_seconds is None else time.monotonic() + policy.float_deadline_seconds
+
+	for int_attempt in range(1, policy.int_max_attempts + 1):
+
+		while True:
+			float_seconds_to_wait = circuit_breaker.get_seconds_until_allowed()
+
+			if float_seconds_to_wait <= 0:
+				break
+
+			check_deadline_allows_wait(float_time_of_deadline, float_seconds_to_wait, string_name_of_backend)
+			await asyncio.sleep(float_seconds_to_wait)
+
+		float_time_start = time.monotonic()
+
+		try:
+			float_seconds_of_hedging = get_seconds_of_hedging(policy, string_key_of_latencies) if bool_hedging_allowed else None
+
+			if float_seconds_of_hedging is None:
+				result = await function(get_seconds_remaining(float_time_of_deadline))
+
+			else:
+				result = await call_hedged_async(function, float_seconds_of_hedging, get_seconds_remaining(float_time_of_deadline))
+
+		except Exception as err:
+			await asyncio.sleep(handle_failure(policy, circuit_breaker, err, int_attempt, float_time_of_deadline, string_name_of_backend))
+			continue
+
+		circuit_breaker.record_success()
+		latency_tracker.add(string_key_of_latencies, time.monotonic() - float_time_start)
+
+		return result
+
+	raise DeadlineExceededError(f"No attempt left for a call to {string_name_of_backend}")
+
+
+def check_deadline_allows_wait(float_time_of_deadline: Optional[float], float_seconds_to_wait: float, string_name_of_backend: str):
+
+	float_seconds_remaining = get_seconds_remaining(float_time_of_deadline)
+
+	if float_seconds_remaining is not None and float_seconds_remaining < float_seconds_to_wait:
+		raise CircuitOpenError(f"Calls to {string_name_of_backend} are suspended for another {float_seconds_to_wait:.1f}s, past the deadline of this call")
+
+
+def handle_failure(
+	policy: CallPolicy,
+	circuit_breaker: CircuitBreaker,
+	err: Exception,
+	int_attempt: int,
+	float_time_of_deadline: Optional[float],
+	string_name_of_backend: str
+) -> float:
+	"""Raise err if the call should not be retried, otherwise return the seconds to wait before the next attempt"""
+
+	if counts_as_failure_of_backend(err):
+		circuit_breaker.record_failure()
+
+	else:
+		# the backend answered (e.g. a rate limit or a bad request), so it is up
+		circuit_breaker.record_success()
+
+	if not is_retryable(err) or int_attempt == policy.int_max_attempts:
+		raise err
+
+	float_seconds_of_backoff = get_seconds_of_backoff(policy, int_attempt, err)
+	float_seconds_remaining = get_seconds_remaining(float_time_of_deadline)
+
+	if float_seconds_remaining is not None and float_seconds_remaining <= float_seconds_of_backoff:
+		raise DeadlineExceededError(f"Deadline of a call to {string_name_of_backend} exceeded after {int_attempt} attempts") from err
+
+	add_to_current_span(int_number_of_retries=int_attempt)
+	print(f"WARNING: Call to {string_name_of_backend} failed ({describe_error(err)}), retrying in {float_seconds_of_backoff:.1f}s (attempt {int_attempt}/{policy.int_max_attempts})")
+
+	return float_seconds_of_backoff
+
+
+def get_seconds_of_hedging(policy: CallPolicy, string_key_of_latencies: str) -> Optional[float]:
+
+	if not policy.bool_hedging:
+		return None
+
+	return latency_tracker.get_percentile(string_key_of_latencies, policy.float_hedging_percentile, policy.int_min_latencies_for_hedging)
+
+
+def call_hedged(function: Callable[[Optional[float]], T], float_seconds_of_hedging: float, float_timeout_seconds: Optional[float]) -> T:
+	"""
+	Start the call, and a duplicate of it if it has not returned after float_seconds_of_hedging: the first to succeed wins.
+	The requests of the sync client cannot be cancelled, so the other one finishes in the background (and its answer is dropped).
+	"""
+	executor = get_executor_of_hedged_calls()
+	# the duplicate's spans belong to the same job
+	future_first = executor.submit(contextvars.copy_context().run, function, float_timeout_seconds)
+
+	try:
+		return future_first.result(timeout=float_seconds_of_hedging)
+
+	except concurrent.futures.TimeoutError:
+		pass
+
+	add_to_current_span(bool_hedged=True)
+	float_timeout_seconds_of_duplicate = None if float_timeout_seconds is None else max(0.0, float_timeout_seconds - float_seconds_of_hedging)
+	set_futures = {future_first, executor.submit(contextvars.copy_context().run, function, float_timeout_seconds_of_duplicate)}
+	err_first: Optional[BaseException] = None
+
+	while len(set_futures) > 0:
+		set_done, set_futures = concurrent.futures.wait(set_futures, return_when=concurrent.futures.FIRST_COMPLETED)
+
+		for future in set_done:
+
+			if future.exception() is None:
+				return future.result()
+
+			err_first = err_first or future.exception()
+
+	raise err_first  # type: ignore
+
+
+async def call_hedged_async(function: Callable[[Optional[float]], Awaitable[T]], float_seconds_of_hedging: float, float_timeout_seconds: Optional[float]) -> T:
+
+	task_first = asyncio.ensure_future(function(float_timeout_seconds))
+	set_done, _ = await asyncio.wait({task_first}, timeout=float_seconds_of_hedging)
+
+	if task_first in set_done:
+		return task_first.result()
+
+	add_to_current_span(bool_hedged=True)
+	float_timeout_seconds_of_duplicate = None if float_timeout_seconds is None else max(0.0, float_timeout_seconds - float_seconds_of_hedging)
+	set_tasks = {task_first, asyncio.ensure_future(function(float_timeout_seconds_of_duplicate))}
+	err_first: Optional[BaseException] = None
+
+	try:
+		while len(set_tasks) > 0:
+			set_done, set_tasks = await asyncio.wait(set_tasks, return_when=asyncio.FIRST_COMPLETED)
+
+			for task in set_done:
+
+				if task.exception() is None:
+					return task.result()
+
+				err_first = err_first or task.exception()
+
+	finally:
+		for task in set_tasks:
+			task.cancel()
+
+	raise err_first  # type: ignore
+
+
+# Policy used by every model API call (the clients themselves do not retry)
+call_policy = CallPolicy()
+latency_tracker = LatencyTracker()
+dict_circuit_breakers: dict[str, CircuitBreaker] = dict()
+executor_of_hedged_calls: Optional[concurrent.futures.ThreadPoolExecutor] = None
+lock_call_policy = threading.Lock()
+
+
+def configure_call_policy(policy: CallPolicy):
+
+	global call_policy
+
+	with lock_call_policy:
+		call_policy = policy
+		# the circuit breakers are made again with the new thresholds
+		dict_circuit_breakers.clear()
+
+
+def get_call_policy() -> CallPolicy:
+	return call_policy
+
+
+def get_circuit_breaker(string_name_of_backend: str) -> CircuitBreaker:
+
+	with lock_call_policy:
+
+		if string_name_of_backend not in dict_circuit_breakers:
+			dict_circuit_breakers[string_name_of_backend] = CircuitBreaker(
+				string_name_of_backend,
+				call_policy.int_circuit_breaker_failures,
+				call_policy.float_circuit_breaker_reset_seconds
+			)
+
+		return dict_circuit_breakers[string_name_of_backend]
+
+
+def get_executor_of_hedged_calls() -> concurrent.futures.ThreadPoolExecutor:
+
+	global executor_of_hedged_calls
+
+	with lock_call_policy:
+
+		if executor_of_hedged_calls is None:
+			executor_of_hedged_calls = concurrent.futures.ThreadPoolExecutor(max_workers=64, thread_name_prefix="hedged_call")
+
+		return executor_of_hedged_calls
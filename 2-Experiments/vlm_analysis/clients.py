@@ -0,0 +1,145 @@
+import asyncio
+import atexit
+import threading
+from typing import Optional, Union
+import httpx
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+from . import ModelAPI
+from .backends import get_backend, get_name_of_backend
+
+
+# Settings of the pooled HTTP transports (see configure_clients)
+dict_client_settings = {
+	"int_max_connections": 64,
+	"int_max_keepalive_connections": 32,
+	"float_keepalive_expiry_seconds": 60.0,
+	"float_timeout_seconds": 600.0,
+	"float_connect_timeout_seconds": 10.0,
+	"int_max_retries": 2,
+	# None: the base URL of each backend (see backends.py), e.g. "http://127.0.0.1:8765/v1" for the replay server overrides them all
+	"string_base_url": None,
+}
+
+# One client per backend (e.g. "openai"), reused by every call so that HTTP keep-alive & TLS sessions are kept
+dict_clients: dict[str, OpenAI] = dict()
+# Async clients are bound to the event loop they were first used in
+dict_clients_async: dict[tuple[str, int], AsyncOpenAI] = dict()
+lock_clients = threading.Lock()
+
+
+def configure_clients(
+	int_max_connections: Optional[int] = None,
+	int_max_keepalive_connections: Optional[int] = None,
+	float_keepalive_expiry_seconds: Optional[float] = None,
+	float_timeout_seconds: Optional[float] = None,
+	float_connect_timeout_seconds: Optional[float] = None,
+	int_max_retries: Optional[int] = None,
+	string_base_url: Optional[str] = None
+):
+	"""Change the settings used for clients created from now on (existing clients are closed)"""
+
+	dict_new_settings = {
+		"int_max_connections": int_max_connections,
+		"int_max_keepalive_connections": int_max_keepalive_connections,
+		"float_keepalive_expiry_seconds": float_keepalive_expiry_seconds,
+		"float_timeout_seconds": float_timeout_seconds,
+		"float_connect_timeout_seconds": float_connect_timeout_seconds,
+		"int_max_retries": int_max_retries,
+		"string_base_url": string_base_url,
+	}
+
+	close_clients()
+
+	for string_name, value in dict_new_settings.items():
+		if value is not None:
+			dict_client_settings[string_name] = value
+
+
+def get_base_url(model_api_or_backend: Union[ModelAPI, str]) -> Optional[str]:
+	# None: the OpenAI API (or OPENAI_BASE_URL, read by the client)
+	return dict_client_settings["string_base_url"] or get_backend(model_api_or_backend).get_base_url()
+
+
+def make_httpx_limits() -> httpx.Limits:
+	return httpx.Limits(
+		max_connections=dict_client_settings["int_max_connections"],
+		max_keepalive_connections=dict_client_settings["int_max_keepalive_connections"],
+		keepalive_expiry=dict_client_settings["float_keepalive_expiry_seconds"],
+	)
+
+
+def make_httpx_timeout() -> httpx.Timeout:
+	return httpx.Timeout(
+		timeout=dict_client_settings["float_timeout_seconds"],
+		connect=dict_client_settings["float_connect_timeout_seconds"],
+	)
+
+
+def get_client(model_api_or_backend: Union[ModelAPI, str]) -> OpenAI:
+
+	string_name_of_backend = get_name_of_backend(model_api_or_backend)
+	backend = get_backend(string_name_of_backend)
+
+	with lock_clients:
+
+		if string_name_of_backend not in dict_clients:
+			dict_clients[string_name_of_backend] = OpenAI(
+				api_key=backend.get_api_key(),
+				base_url=get_base_url(string_name_of_backend),
+				max_retries=dict_client_settings["int_max_retries"],
+				timeout=make_httpx_timeout(),
+				http_client=DefaultHttpxClient(limits=make_httpx_limits(), timeout=make_httpx_timeout()),
+			)
+
+		return dict_clients[string_name_of_backend]
+
+
+def get_client_async(model_api_or_backend: Union[ModelAPI, str]) -> AsyncOpenAI:
+	"""
+	Async clients never retry by themselves: retries of the async path go through
+	the rate limiter (see get_response_openai_async), so that it sees every 429.
+	"""
+	string_name_of_backend = get_name_of_backend(model_api_or_backend)
+	backend = get_backend(string_name_of_backend)
+	key = (string_name_of_backend, id(asyncio.get_running_loop()))
+
+	with lock_clients:
+
+		if key not in dict_clients_async:
+			dict_clients_async[key] = AsyncOpenAI(
+				api_key=backend.get_api_key(),
+				base_url=get_base_url(string_name_of_backend),
+				max_retries=0,
+				timeout=make_httpx_timeout(),
+				http_client=DefaultAsyncHttpxClient(limits=make_httpx_limits(), timeout=make_httpx_timeout()),
+			)
+
+		return dict_clients_async[key]
+
+
+async def close_clients_async():
+	"""Close the async clients of the running event loop (call before the loop ends)"""
+
+	int_id_of_loop = id(asyncio.get_running_loop())
+
+	with lock_clients:
+		list_keys = [key for key in dict_clients_async if key[1] == int_id_of_loop]
+		list_clients = [dict_clients_async.pop(key) for key in list_keys]
+
+	for client_async in list_clients:
+		await client_async.close()
+
+
+def close_clients():
+
+	with lock_clients:
+		list_clients = list(dict_clients.values())
+		dict_clients.clear()
+		# the event loops of any remaining async clients are gone, just drop them
+		dict_clients_async.clear()
+
+	for client in list_clients:
+		client.close()
+
+
+atexit.register(close_clients)
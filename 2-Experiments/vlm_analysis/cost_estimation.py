@@ -0,0 +1,271 @@
+import base64
+import hashlib
+import io
+import json
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, NamedTuple, Optional
+from PIL import Image
+from . import PromptStrategy, ModelAPI
+from .image_preparation import estimate_number_of_image_tokens
+from .tokenization import count_tokens_of_text
+from .results_store import make_name_of_model_dir
+from .utilities import (
+	make_list_of_message_dicts_for_structured_answer,
+	DICT_RESPONSE_FORMAT_STRUCTURED_ANSWER,
+	DICT_RESPONSE_FORMAT_RESPONSE_WITH_ANSWER,
+)
+
+
+# USD per million tokens: (input, output)
+# https://openai.com/api/pricing/
+DICT_PRICES_PER_MILLION_TOKENS = {
+	ModelAPI.OPENAI_GPT4O_2024_08_06: (2.50, 10.00),
+	# self-hosted: no per-token price
+	ModelAPI.VLLM_QWEN2_VL_7B_INSTRUCT: (0.0, 0.0),
+	ModelAPI.LLAMACPP_LLAVA_1_POINT_6_MISTRAL_7B: (0.0, 0.0),
+}
+# the Batch API bills half the price
+FLOAT_PRICE_FACTOR_BATCH_API = 0.5
+
+# chat format overhead: every message is wrapped in a few special tokens, and the reply is primed with a few more
+INT_TOKENS_PER_MESSAGE = 3
+INT_TOKENS_OF_REPLY_PRIMING = 3
+
+# used when there are no earlier results of a model & strategy to calibrate from
+INT_OUTPUT_TOKENS_OF_RESPONSE_DEFAULT = 500
+INT_OUTPUT_TOKENS_OF_ANSWER = 60
+INT_NUMBER_OF_RESULTS_TO_CALIBRATE_FROM = 50
+
+PATH_TO_RESULTS_DIR = Path("../Data/2-Experiments/results")
+
+
+class RequestEstimate(NamedTuple):
+	int_input_tokens_of_text: int
+	int_input_tokens_of_images: int
+	int_output_tokens: int
+
+	@property
+	def int_input_tokens(self) -> int:
+		return self.int_input_tokens_of_text + self.int_input_tokens_of_images
+
+
+class JobEstimate(NamedTuple):
+	"""Tokens & cost of every request of a job (the response, plus the answer extraction unless in single-call mode)"""
+	job: Any
+	int_input_tokens: int
+	int_output_tokens: int
+	float_cost_usd: float
+	string_error: str = ""
+
+	@property
+	def int_total_tokens(self) -> int:
+		return self.int_input_tokens + self.int_output_tokens
+
+
+# (sha256 of the data URL, detail) -> tokens: the images themselves are not kept
+dict_tokens_of_images: dict[tuple[str, str], int] = dict()
+
+
+def count_tokens_of_image(string_url: str, string_detail: str) -> int:
+	"""Tokens of a data URL image, from its dimensions (see image_preparation.estimate_number_of_image_tokens)"""
+
+	if string_detail == "low":
+		return estimate_number_of_image_tokens(1, 1, "low")
+
+	key = (hashlib.sha256(string_url.encode("utf-8")).hexdigest(), string_detail)
+
+	if key not in dict_tokens_of_images:
+		dict_tokens_of_images[key] = count_tokens_of_image_uncached(string_url)
+
+	return dict_tokens_of_images[key]
+
+
+def count_tokens_of_image_uncached(string_url: str) -> int:
+
+	try:
+		bytes_image = base64.b64decode(string_url.split(",", 1)[1])
+
+		# only reads the header
+		with Image.open(io.BytesIO(bytes_image)) as image:
+			int_width, int_height = image.size
+
+	except Exception as err:
+		print(f"WARNING: Failed to read the size of an image, counting it as 2048x2048: {err!r}")
+		int_width, int_height = 2048, 2048
+
+	# "auto" lets the model API decide; count it as "high" as that is the worst case
+	return estimate_number_of_image_tokens(int_width, int_height, "high")
+
+
+def estimate_request(list_of_message_dicts: list[dict], int_output_tokens: int, dict_response_format: Optional[dict] = None) -> RequestEstimate:
+
+	int_tokens_of_text = INT_TOKENS_OF_REPLY_PRIMING
+	int_tokens_of_images = 0
+
+	for message_dict in list_of_message_dicts:
+
+		int_tokens_of_text += INT_TOKENS_PER_MESSAGE + count_tokens_of_text(message_dict.get("role", ""))
+		content = message_dict.get("content")
+		list_of_parts = content if isinstance(content, list) else [content]
+
+		for part in list_of_parts:
+
+			if isinstance(part, dict) and part.get("type") == "image_url":
+				int_tokens_of_images += count_tokens_of_image(part["image_url"]["url"], part["image_url"].get("detail", "auto"))
+
+			elif isinstance(part, dict):
+				int_tokens_of_text += count_tokens_of_text(part.get("text", ""))
+
+			elif isinstance(part, str):
+				int_tokens_of_text += count_tokens_of_text(part)
+
+	# the JSON schema of structured outputs is part of the prompt too
+	if dict_response_format is not None:
+		int_tokens_of_text += count_tokens_of_text(json.dumps(dict_response_format))
+
+	return RequestEstimate(int_tokens_of_text, int_tokens_of_images, int_output_tokens)
+
+
+@lru_cache(maxsize=None)
+def estimate_output_tokens_of_response(model_api: ModelAPI, prompt_strategy: PromptStrategy) -> int:
+	"""Mean length of the responses already saved for this model & strategy, or a default if there are none"""
+
+	path_to_results = PATH_TO_RESULTS_DIR / make_name_of_model_dir(model_api.value) / prompt_strategy.value
+	list_number_of_tokens = []
+
+	for path_to_txt in path_to_results.glob("*/*.txt"):
+
+		if len(list_number_of_tokens) >= INT_NUMBER_OF_RESULTS_TO_CALIBRATE_FROM:
+			break
+
+		try:
+			with open(path_to_txt, "r", encoding="utf-8", errors="replace") as f:
+				list_number_of_tokens.append(count_tokens_of_text(f.read()))
+
+		except OSError:
+			continue
+
+	if len(list_number_of_tokens) == 0:
+		return INT_OUTPUT_TOKENS_OF_RESPONSE_DEFAULT
+
+	return round(sum(list_number_of_tokens) / len(list_number_of_tokens))
+
+
+def estimate_cost(model_api: ModelAPI, int_input_tokens: int, int_output_tokens: int, float_price_factor: float = 1.0) -> float:
+
+	tuple_prices = DICT_PRICES_PER_MILLION_TOKENS.get(model_api)
+
+	if tuple_prices is None:
+		print(f"WARNING: No prices known for {model_api.value}, counting its cost as 0")
+		return 0.0
+
+	float_price_input, float_price_output = tuple_prices
+
+	return float_price_factor * (int_input_tokens * float_price_input + int_output_tokens * float_price_output) / 1e6
+
+
+def estimate_job(
+	job: tuple[ModelAPI, PromptStrategy, str, str],
+	list_of_message_dicts: list[dict],
+	bool_single_call: bool = False,
+	float_price_factor: float = 1.0
+) -> JobEstimate:
+
+	model_api, prompt_strategy, _, _ = job
+	int_output_tokens_of_response = estimate_output_tokens_of_response(model_api, prompt_strategy)
+
+	if bool_single_call:
+		list_of_estimates = [estimate_request(list_of_message_dicts, int_output_tokens_of_response + INT_OUTPUT_TOKENS_OF_ANSWER, DICT_RESPONSE_FORMAT_RESPONSE_WITH_ANSWER)]
+
+	else:
+		estimate_of_response = estimate_request(list_of_message_dicts, int_output_tokens_of_response)
+		# the response is the user message of the answer extraction
+		estimate_of_answer = estimate_request(make_list_of_message_dicts_for_structured_answer(""), INT_OUTPUT_TOKENS_OF_ANSWER, DICT_RESPONSE_FORMAT_STRUCTURED_ANSWER)
+		estimate_of_answer = estimate_of_answer._replace(int_input_tokens_of_text=estimate_of_answer.int_input_tokens_of_text + int_output_tokens_of_response)
+		list_of_estimates = [estimate_of_response, estimate_of_answer]
+
+	int_input_tokens = sum(estimate.int_input_tokens for estimate in list_of_estimates)
+	int_output_tokens = sum(estimate.int_output_tokens for estimate in list_of_estimates)
+
+	return JobEstimate(job, int_input_tokens, int_output_tokens, estimate_cost(model_api, int_input_tokens, int_output_tokens, float_price_factor))
+
+
+def make_key_of_shared_prefix(job) -> tuple:
+	# model, prompt strategy & app: the requests for the snapshots of an app only differ after their shared prefix
+	return tuple(job[:3])
+
+
+def schedule_jobs_longest_first(
+	list_of_estimates: list[JobEstimate],
+	int_budget_tokens: Optional[int] = None,
+	float_budget_usd: Optional[float] = None
+) -> tuple[list[JobEstimate], list[JobEstimate]]:
+	"""
+	Order jobs by estimated tokens, largest first, so that the longest requests do not end up alone at the end of a run.
+	The jobs of an app (with the same model & strategy) stay back-to-back, in their order, since their requests share a prefix
+	that the provider may cache: the apps are ordered by the tokens of their largest job.
+	Stops at the first job that would exceed a budget: returns the jobs to run, and the jobs deferred to a later run.
+	"""
+	dict_estimates_by_app: dict[tuple, list[JobEstimate]] = dict()
+
+	for estimate in list_of_estimates:
+		dict_estimates_by_app.setdefault(make_key_of_shared_prefix(estimate.job), []).append(estimate)
+
+	list_of_estimates_sorted = [
+		estimate
+		for list_of_estimates_of_app in sorted(dict_estimates_by_app.values(), key=lambda list_of_estimates_of_app: max(estimate.int_total_tokens for estimate in list_of_estimates_of_app), reverse=True)
+		for estimate in list_of_estimates_of_app
+	]
+
+	int_tokens_scheduled = 0
+	float_cost_scheduled = 0.0
+
+	for int_index, estimate in enumerate(list_of_estimates_sorted):
+
+		int_tokens_scheduled += estimate.int_total_tokens
+		float_cost_scheduled += estimate.float_cost_usd
+
+		if (int_budget_tokens is not None and int_tokens_scheduled > int_budget_tokens) or (float_budget_usd is not None and float_cost_scheduled > float_budget_usd):
+			return list_of_estimates_sorted[:int_index], list_of_estimates_sorted[int_index:]
+
+	return list_of_estimates_sorted, []
+
+
+def make_report_of_estimates(
+	list_of_estimates: list[JobEstimate],
+	int_requests_per_job: int = 2,
+	int_requests_per_minute: Optional[int] = None,
+	int_tokens_per_minute: Optional[int] = None
+) -> str:
+
+	dict_totals_per_strategy: dict[str, list] = dict()
+
+	for estimate in list_of_estimates:
+		list_totals = dict_totals_per_strategy.setdefault(estimate.job[1].value, [0, 0, 0, 0.0])
+		list_totals[0] += 1
+		list_totals[1] += estimate.int_input_tokens
+		list_totals[2] += estimate.int_output_tokens
+		list_totals[3] += estimate.float_cost_usd
+
+	list_lines = [f"Estimated {len(list_of_estimates)} jobs:"]
+
+	for string_prompt_strategy, (int_number_of_jobs, int_input_tokens, int_output_tokens, float_cost_usd) in sorted(dict_totals_per_strategy.items()):
+		list_lines.append(f"  {string_prompt_strategy}: {int_number_of_jobs} jobs, {int_input_tokens} input + {int_output_tokens} output tokens, ${float_cost_usd:.2f}")
+
+	int_input_tokens = sum(estimate.int_input_tokens for estimate in list_of_estimates)
+	int_output_tokens = sum(estimate.int_output_tokens for estimate in list_of_estimates)
+	float_cost_usd = sum(estimate.float_cost_usd for estimate in list_of_estimates)
+	list_lines.append(f"  Total: {int_input_tokens} input + {int_output_tokens} output tokens, ${float_cost_usd:.2f}")
+
+	list_of_estimates_failed = [estimate for estimate in list_of_estimates if estimate.string_error]
+
+	if len(list_of_estimates_failed) > 0:
+		list_lines.append(f"  {len(list_of_estimates_failed)} jobs could not be estimated (their messages could not be built)")
+
+	# the rate limits bound how fast the run can go, however many workers there are
+	if int_requests_per_minute is not None and int_tokens_per_minute is not None and len(list_of_estimates) > 0:
+		float_minutes = max(len(list_of_estimates) * int_requests_per_job / int_requests_per_minute, (int_input_tokens + int_output_tokens) / int_tokens_per_minute)
+		list_lines.append(f"  At {int_requests_per_minute} requests/min and {int_tokens_per_minute} tokens/min, the run takes at least {float_minutes:.1f} minutes")
+
+	return "\n".join(list_lines)
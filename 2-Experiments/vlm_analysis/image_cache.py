@@ -0,0 +1,197 @@
+import base64
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Optional, Union
+from sqlitedict import SqliteDict
+
+
+PATH_TO_IMAGE_CACHE_DEFAULT = Path("../Data/2-Experiments/cache/encoded_images.sqlite")
+INT_MAX_BYTES_IN_MEMORY_DEFAULT = 256 * 1024 * 1024
+# first element of the keys of prepared images in memory (the keys of files start with their path)
+STRING_KIND_PREPARED = "prepared"
+
+
+class EncodedImageCache:
+	"""
+	Cache of base64-encoded images (screenshots, baselines & assets).
+
+	In memory: an LRU cache with a byte budget, keyed by (path, mtime, size),
+	which also holds the prepared payloads of image_preparation (keyed by the digest of the image they were prepared from).
+	On disk (optional): pre-encoded payloads keyed by the sha256 of the file content,
+	with an index from (path, mtime, size) to that digest, so unchanged files are neither re-read nor re-encoded.
+	"""
+
+	def __init__(self, int_max_bytes_in_memory: int = INT_MAX_BYTES_IN_MEMORY_DEFAULT, path_to_disk_store: Optional[Union[str, Path]] = None):
+		self.int_max_bytes_in_memory = int_max_bytes_in_memory
+		self.int_number_of_bytes_in_memory = 0
+		# key -> (value, number of bytes); keys of prepared images start with STRING_KIND_PREPARED
+		self.dict_encoded_images: OrderedDict[tuple, tuple[Any, int]] = OrderedDict()
+		self.lock = threading.Lock()
+
+		self.int_number_of_hits_in_memory = 0
+		self.int_number_of_hits_on_disk = 0
+		self.int_number_of_misses = 0
+
+		self.dict_disk_index: Optional[SqliteDict] = None
+		self.dict_disk_payloads: Optional[SqliteDict] = None
+
+		if path_to_disk_store is not None:
+			Path(path_to_disk_store).parent.mkdir(parents=True, exist_ok=True)
+			self.dict_disk_index = SqliteDict(str(path_to_disk_store), tablename="index", autocommit=True)
+			self.dict_disk_payloads = SqliteDict(str(path_to_disk_store), tablename="payloads", autocommit=True)
+
+	def load_and_encode_image(self, path_to_image: Union[str, Path]) -> str:
+
+		stat = os.stat(path_to_image)
+		key = (str(Path(path_to_image).resolve()), stat.st_mtime_ns, stat.st_size)
+
+		with self.lock:
+			tuple_entry = self.dict_encoded_images.get(key)
+
+			if tuple_entry is not None:
+				self.dict_encoded_images.move_to_end(key)
+				self.int_number_of_hits_in_memory += 1
+				return tuple_entry[0]
+
+		base64_image = self.load_from_disk_store(key)
+
+		if base64_image is None:
+
+			with open(path_to_image, "rb") as image_file:
+				bytes_image = image_file.read()
+
+			base64_image = base64.b64encode(bytes_image).decode('utf-8')
+			self.save_to_disk_store(key, hashlib.sha256(bytes_image).hexdigest(), base64_image)
+
+			with self.lock:
+				self.int_number_of_misses += 1
+
+		self.add_to_memory(key, base64_image, len(base64_image))
+
+		return base64_image
+
+	def get_prepared_image(self, key: tuple) -> Optional[Any]:
+
+		with self.lock:
+			tuple_entry = self.dict_encoded_images.get((STRING_KIND_PREPARED, *key))
+
+			if tuple_entry is None:
+				return None
+
+			self.dict_encoded_images.move_to_end((STRING_KIND_PREPARED, *key))
+			return tuple_entry[0]
+
+	def add_prepared_image(self, key: tuple, prepared_image: Any, int_number_of_bytes: int):
+		self.add_to_memory((STRING_KIND_PREPARED, *key), prepared_image, int_number_of_bytes)
+
+	def clear_prepared_images(self):
+
+		with self.lock:
+			for key in [key for key in self.dict_encoded_images if key[0] == STRING_KIND_PREPARED]:
+				_, int_number_of_bytes = self.dict_encoded_images.pop(key)
+				self.int_number_of_bytes_in_memory -= int_number_of_bytes
+
+	def add_to_memory(self, key: tuple, value: Any, int_number_of_bytes: int):
+
+		# too large to ever fit in the budget
+		if int_number_of_bytes > self.int_max_bytes_in_memory:
+			return
+
+		with self.lock:
+
+			if key in self.dict_encoded_images:
+				return
+
+			self.dict_encoded_images[key] = (value, int_number_of_bytes)
+			self.int_number_of_bytes_in_memory += int_number_of_bytes
+
+			# evict the least recently used images
+			while self.int_number_of_bytes_in_memory > self.int_max_bytes_in_memory:
+				_, (_, int_number_of_bytes_evicted) = self.dict_encoded_images.popitem(last=False)
+				self.int_number_of_bytes_in_memory -= int_number_of_bytes_evicted
+
+	def load_from_disk_store(self, key: tuple[str, int, int]) -> Optional[str]:
+
+		if self.dict_disk_index is None or self.dict_disk_payloads is None:
+			return None
+
+		string_digest = self.dict_disk_index.get(make_string_key_of_file(key))
+
+		if string_digest is None:
+			return None
+
+		base64_image = self.dict_disk_payloads.get(string_digest)
+
+		if base64_image is not None:
+			with self.lock:
+				self.int_number_of_hits_on_disk += 1
+
+		return base64_image
+
+	def save_to_disk_store(self, key: tuple[str, int, int], string_digest: str, base64_image: str):
+
+		if self.dict_disk_index is None or self.dict_disk_payloads is None:
+			return
+
+		# identical files (e.g. the same sprite in two folders) share one payload
+		if string_digest not in self.dict_disk_payloads:
+			self.dict_disk_payloads[string_digest] = base64_image
+
+		self.dict_disk_index[make_string_key_of_file(key)] = string_digest
+
+	def get_stats(self) -> dict[str, int]:
+		with self.lock:
+			return {
+				"int_number_of_hits_in_memory": self.int_number_of_hits_in_memory,
+				"int_number_of_hits_on_disk": self.int_number_of_hits_on_disk,
+				"int_number_of_misses": self.int_number_of_misses,
+				"int_number_of_bytes_in_memory": self.int_number_of_bytes_in_memory,
+			}
+
+	def close(self):
+
+		if self.dict_disk_index is not None:
+			self.dict_disk_index.close()
+
+		if self.dict_disk_payloads is not None:
+			self.dict_disk_payloads.close()
+
+
+def make_string_key_of_file(key: tuple[str, int, int]) -> str:
+	string_path, int_mtime_ns, int_size = key
+	return f"{string_path}|{int_mtime_ns}|{int_size}"
+
+
+# Cache used by load_and_encode_image; in memory only unless configured (or VLM_CANVAS_BUGS_IMAGE_CACHE_PATH is set)
+encoded_image_cache: Optional[EncodedImageCache] = None
+lock_encoded_image_cache = threading.RLock()
+
+
+def configure_encoded_image_cache(
+	int_max_bytes_in_memory: int = INT_MAX_BYTES_IN_MEMORY_DEFAULT,
+	path_to_disk_store: Optional[Union[str, Path]] = None
+) -> EncodedImageCache:
+
+	global encoded_image_cache
+
+	with lock_encoded_image_cache:
+
+		if encoded_image_cache is not None:
+			encoded_image_cache.close()
+
+		encoded_image_cache = EncodedImageCache(int_max_bytes_in_memory, path_to_disk_store)
+
+		return encoded_image_cache
+
+
+def get_encoded_image_cache() -> EncodedImageCache:
+
+	with lock_encoded_image_cache:
+
+		if encoded_image_cache is None:
+			return configure_encoded_image_cache(path_to_disk_store=os.getenv("VLM_CANVAS_BUGS_IMAGE_CACHE_PATH", None))
+
+		return encoded_image_cache
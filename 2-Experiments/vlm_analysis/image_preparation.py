@@ -0,0 +1,217 @@
+import base64
+import hashlib
+import io
+import math
+import threading
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import NamedTuple, Optional
+from PIL import Image
+from .image_cache import get_encoded_image_cache
+
+
+class ImageRole(Enum):
+	"""What an image is used for in a request"""
+	SCREENSHOT = "screenshot"
+	BASELINE = "baseline"
+	ASSET = "asset"
+	# a sheet packing many assets (see asset_atlas.py); its labels must stay legible
+	ASSET_ATLAS = "asset_atlas"
+
+
+# gpt-4o vision token accounting
+# https://platform.openai.com/docs/guides/vision/calculating-costs
+INT_TILE_SIZE = 512
+INT_MAX_SIDE = 2048
+INT_MAX_SHORTEST_SIDE = 768
+INT_TOKENS_BASE = 85
+INT_TOKENS_PER_TILE = 170
+
+DICT_MIME_TYPES = {
+	"png": "image/png",
+	"jpeg": "image/jpeg",
+	"webp": "image/webp",
+}
+
+
+@dataclass(frozen=True)
+class ImagePreparationPolicy:
+	"""How images are resized, transcoded & labelled before upload"""
+	# one of DICT_MIME_TYPES
+	string_format: str = "jpeg"
+	int_quality: int = 85
+	# resize to the size the model would downscale to anyway (and drop a nearly empty row/column of tiles)
+	bool_resize_to_tile_grid: bool = True
+	# fraction of a tile that may be cropped away by scaling down to save a whole row/column of tiles
+	float_max_fraction_of_tile_to_drop: float = 0.1
+	dict_detail_per_role: dict = field(default_factory=lambda: {
+		ImageRole.SCREENSHOT: "high",
+		ImageRole.BASELINE: "high",
+		ImageRole.ASSET: "low",
+		ImageRole.ASSET_ATLAS: "high",
+	})
+
+	def __hash__(self):
+		return hash((self.string_format, self.int_quality, self.bool_resize_to_tile_grid, self.float_max_fraction_of_tile_to_drop, tuple(sorted((role.value, detail) for role, detail in self.dict_detail_per_role.items()))))
+
+
+class PreparedImage(NamedTuple):
+	base64_image: str
+	string_mime_type: str
+	string_detail: str
+	int_number_of_bytes_before: int
+	int_number_of_bytes_after: int
+	int_number_of_tokens_before: int
+	int_number_of_tokens_after: int
+
+
+class ImagePreparationStats:
+	"""Running totals of bytes & estimated image tokens saved by preparing images"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.int_number_of_images = 0
+		self.int_number_of_bytes_before = 0
+		self.int_number_of_bytes_after = 0
+		self.int_number_of_tokens_before = 0
+		self.int_number_of_tokens_after = 0
+
+	def add(self, prepared_image: PreparedImage):
+		with self.lock:
+			self.int_number_of_images += 1
+			self.int_number_of_bytes_before += prepared_image.int_number_of_bytes_before
+			self.int_number_of_bytes_after += prepared_image.int_number_of_bytes_after
+			self.int_number_of_tokens_before += prepared_image.int_number_of_tokens_before
+			self.int_number_of_tokens_after += prepared_image.int_number_of_tokens_after
+
+	def make_report(self) -> str:
+		with self.lock:
+			return (
+				f"Prepared {self.int_number_of_images} images: "
+				f"{self.int_number_of_bytes_before / 1e6:.1f} MB -> {self.int_number_of_bytes_after / 1e6:.1f} MB, "
+				f"~{self.int_number_of_tokens_before} -> ~{self.int_number_of_tokens_after} image tokens "
+				f"(saved {self.int_number_of_bytes_before - self.int_number_of_bytes_after} bytes and ~{self.int_number_of_tokens_before - self.int_number_of_tokens_after} tokens)"
+			)
+
+
+def get_size_after_downscaling(int_width: int, int_height: int, string_detail: str = "high") -> tuple[int, int]:
+	"""Size the model API scales an image to before tiling it"""
+
+	if string_detail == "low":
+		float_scale = min(1.0, INT_TILE_SIZE / max(int_width, int_height))
+		return max(1, round(int_width * float_scale)), max(1, round(int_height * float_scale))
+
+	float_scale = min(1.0, INT_MAX_SIDE / max(int_width, int_height))
+	int_width, int_height = max(1, round(int_width * float_scale)), max(1, round(int_height * float_scale))
+
+	float_scale = min(1.0, INT_MAX_SHORTEST_SIDE / min(int_width, int_height))
+	return max(1, round(int_width * float_scale)), max(1, round(int_height * float_scale))
+
+
+def estimate_number_of_image_tokens(int_width: int, int_height: int, string_detail: str = "high") -> int:
+
+	if string_detail == "low":
+		return INT_TOKENS_BASE
+
+	int_width, int_height = get_size_after_downscaling(int_width, int_height, "high")
+	int_number_of_tiles = math.ceil(int_width / INT_TILE_SIZE) * math.ceil(int_height / INT_TILE_SIZE)
+
+	return INT_TOKENS_BASE + INT_TOKENS_PER_TILE * int_number_of_tiles
+
+
+def get_size_on_tile_grid(int_width: int, int_height: int, string_detail: str, float_max_fraction_of_tile_to_drop: float) -> tuple[int, int]:
+
+	int_width, int_height = get_size_after_downscaling(int_width, int_height, string_detail)
+
+	if string_detail == "low":
+		return int_width, int_height
+
+	# e.g. 1040 px wide needs 3 tiles, but 1024 px only needs 2
+	float_scale = 1.0
+
+	for int_side in (int_width, int_height):
+		int_pixels_in_last_tile = int_side % INT_TILE_SIZE
+
+		if 0 < int_pixels_in_last_tile <= float_max_fraction_of_tile_to_drop * INT_TILE_SIZE and int_side > INT_TILE_SIZE:
+			float_scale = min(float_scale, (int_side - int_pixels_in_last_tile) / int_side)
+
+	return max(1, math.floor(int_width * float_scale)), max(1, math.floor(int_height * float_scale))
+
+
+def prepare_image(base64_image: str, image_role: ImageRole, policy: ImagePreparationPolicy) -> PreparedImage:
+
+	# prepared payloads are kept within the byte budget of the encoded image cache, keyed by the digest of the image (not the image itself)
+	encoded_image_cache = get_encoded_image_cache()
+	key = (hashlib.sha256(base64_image.encode("ascii")).hexdigest(), image_role.value, policy)
+	prepared_image = encoded_image_cache.get_prepared_image(key)
+
+	if prepared_image is None:
+		prepared_image = prepare_image_uncached(base64_image, image_role, policy)
+		encoded_image_cache.add_prepared_image(key, prepared_image, len(prepared_image.base64_image))
+
+	return prepared_image
+
+
+def prepare_image_uncached(base64_image: str, image_role: ImageRole, policy: ImagePreparationPolicy) -> PreparedImage:
+
+	bytes_image_before = base64.b64decode(base64_image)
+	string_detail = policy.dict_detail_per_role.get(image_role, "auto")
+
+	with Image.open(io.BytesIO(bytes_image_before)) as image:
+		image.load()
+
+	int_width, int_height = image.size
+	# "auto" lets the model API decide; count it as "high" as that is the worst case
+	int_number_of_tokens_before = estimate_number_of_image_tokens(int_width, int_height, "high")
+
+	if policy.bool_resize_to_tile_grid:
+		size_new = get_size_on_tile_grid(int_width, int_height, string_detail, policy.float_max_fraction_of_tile_to_drop)
+
+		if size_new != image.size:
+			image = image.resize(size_new, Image.Resampling.LANCZOS)
+
+	string_format = policy.string_format.lower()
+
+	# JPEG has no alpha channel: flatten transparent sprites onto white
+	if string_format == "jpeg" and image.mode in ("RGBA", "LA", "P"):
+		image = image.convert("RGBA")
+		image_flattened = Image.new("RGB", image.size, (255, 255, 255))
+		image_flattened.paste(image, mask=image.getchannel("A"))
+		image = image_flattened
+
+	elif string_format == "jpeg" and image.mode != "RGB":
+		image = image.convert("RGB")
+
+	buffer = io.BytesIO()
+
+	if string_format == "png":
+		image.save(buffer, format="PNG", optimize=True)
+
+	else:
+		image.save(buffer, format=string_format.upper(), quality=policy.int_quality)
+
+	bytes_image_after = buffer.getvalue()
+
+	return PreparedImage(
+		base64_image=base64.b64encode(bytes_image_after).decode("utf-8"),
+		string_mime_type=DICT_MIME_TYPES[string_format],
+		string_detail=string_detail,
+		int_number_of_bytes_before=len(bytes_image_before),
+		int_number_of_bytes_after=len(bytes_image_after),
+		int_number_of_tokens_before=int_number_of_tokens_before,
+		int_number_of_tokens_after=estimate_number_of_image_tokens(image.size[0], image.size[1], string_detail),
+	)
+
+
+# Policy used by the message builders; None sends images as they are stored (the setup used in the paper)
+image_preparation_policy: Optional[ImagePreparationPolicy] = None
+image_preparation_stats = ImagePreparationStats()
+
+
+def configure_image_preparation(policy: Optional[ImagePreparationPolicy]):
+	global image_preparation_policy
+	image_preparation_policy = policy
+
+
+def get_image_preparation_policy() -> Optional[ImagePreparationPolicy]:
+	return image_preparation_policy
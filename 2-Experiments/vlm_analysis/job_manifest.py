@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from enum import Enum
+from pathlib import Path
+from typing import Optional, Union
+from sqlitedict import SqliteDict
+from . import PromptStrategy, ModelAPI
+
+
+PATH_TO_JOB_MANIFEST_DEFAULT = Path("../Data/2-Experiments/cache/jobs.sqlite")
+INT_MAX_ATTEMPTS_DEFAULT = 3
+
+
+class JobStatus(Enum):
+	PENDING = "pending"
+	IN_FLIGHT = "in_flight"
+	COMPLETED = "completed"
+	FAILED = "failed"
+
+
+class JobManifest:
+	"""
+	Durable record of every job (model, prompt strategy, app, snapshot) of the experiment matrix, stored in SQLite (via sqlitedict).
+
+	Each entry holds the status of the job, its number of attempts, the last error and the digest of its output,
+	so that an interrupted run can be restarted without redoing (and paying for) the jobs that completed.
+	"""
+
+	def __init__(self, path_to_manifest: Union[str, Path] = PATH_TO_JOB_MANIFEST_DEFAULT):
+		self.path_to_manifest = Path(path_to_manifest)
+		self.path_to_manifest.parent.mkdir(parents=True, exist_ok=True)
+		self.dict_entries = SqliteDict(str(self.path_to_manifest), tablename="jobs", autocommit=True)
+		self.lock = threading.Lock()
+
+	def get_entry(self, job: tuple[ModelAPI, PromptStrategy, str, str]) -> dict:
+		return self.dict_entries.get(make_key_of_job(job), make_entry())
+
+	def update_entry(self, job: tuple[ModelAPI, PromptStrategy, str, str], **kwargs) -> dict:
+
+		with self.lock:
+			string_key = make_key_of_job(job)
+			dict_entry = {**self.dict_entries.get(string_key, make_entry()), **kwargs, "float_time_updated": time.time()}
+			self.dict_entries[string_key] = dict_entry
+
+		return dict_entry
+
+	def mark_in_flight(self, job: tuple[ModelAPI, PromptStrategy, str, str]):
+
+		with self.lock:
+			string_key = make_key_of_job(job)
+			dict_entry = self.dict_entries.get(string_key, make_entry())
+			dict_entry.update(string_status=JobStatus.IN_FLIGHT.value, int_number_of_attempts=dict_entry["int_number_of_attempts"] + 1, float_time_updated=time.time())
+			self.dict_entries[string_key] = dict_entry
+
+	def mark_completed(self, job: tuple[ModelAPI, PromptStrategy, str, str], string_digest_of_output: str):
+		self.update_entry(job, string_status=JobStatus.COMPLETED.value, string_error="", string_digest_of_output=string_digest_of_output)
+
+	def mark_failed(self, job: tuple[ModelAPI, PromptStrategy, str, str], string_error: str):
+
+		with self.lock:
+			string_key = make_key_of_job(job)
+			dict_entry = self.dict_entries.get(string_key, make_entry())
+
+			# a job that failed before being sent (e.g. while building its messages) was never marked in flight: it is an attempt too
+			if dict_entry["string_status"] != JobStatus.IN_FLIGHT.value:
+				dict_entry["int_number_of_attempts"] += 1
+
+			dict_entry.update(string_status=JobStatus.FAILED.value, string_error=string_error, float_time_updated=time.time())
+			self.dict_entries[string_key] = dict_entry
+
+	def reset_in_flight(self) -> int:
+		"""Put the jobs that were in flight (when a run was interrupted or crashed) back to pending"""
+
+		with self.lock:
+			list_keys_in_flight = [
+				string_key for string_key, dict_entry in self.dict_entries.items()
+				if dict_entry["string_status"] == JobStatus.IN_FLIGHT.value
+			]
+
+			for string_key in list_keys_in_flight:
+				self.dict_entries[string_key] = {**self.dict_entries[string_key], "string_status": JobStatus.PENDING.value, "float_time_updated": time.time()}
+
+		return len(list_keys_in_flight)
+
+	def filter_jobs_to_run(self, list_of_jobs: list, int_max_attempts: int = INT_MAX_ATTEMPTS_DEFAULT) -> list:
+		"""Jobs that are not completed yet, and did not already fail int_max_attempts times"""
+
+		list_of_jobs_to_run = []
+		int_number_completed = 0
+		int_number_given_up = 0
+
+		for job in list_of_jobs:
+			dict_entry = self.get_entry(job)
+
+			if dict_entry["string_status"] == JobStatus.COMPLETED.value:
+				int_number_completed += 1
+				continue
+
+			if dict_entry["string_status"] == JobStatus.FAILED.value and dict_entry["int_number_of_attempts"] >= int_max_attempts:
+				int_number_given_up += 1
+				continue
+
+			if make_key_of_job(job) not in self.dict_entries:
+				self.update_entry(job)
+
+			list_of_jobs_to_run.append(job)
+
+		print(f"Job manifest \"{self.path_to_manifest}\": {int_number_completed} jobs already completed, {int_number_given_up} failed {int_max_attempts} times, {len(list_of_jobs_to_run)} to run")
+
+		return list_of_jobs_to_run
+
+	def get_counts(self) -> dict[str, int]:
+
+		dict_counts = {job_status.value: 0 for job_status in JobStatus}
+
+		for dict_entry in self.dict_entries.values():
+			dict_counts[dict_entry["string_status"]] += 1
+
+		return dict_counts
+
+	def close(self):
+		self.dict_entries.close()
+
+
+def make_entry() -> dict:
+	return {
+		"string_status": JobStatus.PENDING.value,
+		"int_number_of_attempts": 0,
+		"string_error": "",
+		"string_digest_of_output": "",
+		"float_time_updated": time.time(),
+	}
+
+
+def make_key_of_job(job: tuple[ModelAPI, PromptStrategy, str, str]) -> str:
+	model_api, prompt_strategy, string_name_of_app, string_name_of_snapshot = job
+	return f"{model_api.value}|{prompt_strategy.value}|{string_name_of_app}|{string_name_of_snapshot}"
+
+
+def make_digest_of_output(string_response_content: str, json_response_results: Union[str, dict]) -> str:
+	"""Digest of what save_results writes (.txt & .json) for a job"""
+	string_output = json.dumps([string_response_content, json_response_results], sort_keys=True, ensure_ascii=False)
+	return hashlib.sha256(string_output.encode("utf-8")).hexdigest()
+
+
+# Manifest used by the batch runners; disabled unless configured (or VLM_CANVAS_BUGS_JOB_MANIFEST_PATH is set)
+job_manifest: Optional[JobManifest] = None
+bool_job_manifest_is_configured = False
+lock_job_manifest = threading.RLock()
+
+
+def configure_job_manifest(path_to_manifest: Optional[Union[str, Path]]) -> Optional[JobManifest]:
+	"""Set (or with path_to_manifest=None, disable) the job manifest"""
+
+	global job_manifest, bool_job_manifest_is_configured
+
+	with lock_job_manifest:
+
+		if job_manifest is not None:
+			job_manifest.close()
+
+		job_manifest = None
+
+		if path_to_manifest is not None:
+			job_manifest = JobManifest(path_to_manifest)
+
+		bool_job_manifest_is_configured = True
+
+	return job_manifest
+
+
+def get_job_manifest() -> Optional[JobManifest]:
+
+	with lock_job_manifest:
+
+		if not bool_job_manifest_is_configured:
+			configure_job_manifest(os.getenv("VLM_CANVAS_BUGS_JOB_MANIFEST_PATH", None))
+
+		return job_manifest
@@ -0,0 +1,298 @@
+import argparse
+import math
+import warnings
+from itertools import combinations
+from pathlib import Path
+from typing import Optional
+import numpy as np
+import pandas as pd
+from .results_compiler import read_compiled_results
+
+
+# TextBugType: the snapshots of one bug type with the clean snapshots, the negatives (see pair_bug_types_with_clean)
+LIST_GROUP_BY_DEFAULT = ["TextModelAPI", "TextPromptStrategy", "TextBugType"]
+LIST_NAMES_OF_METRICS = ["Accuracy", "Precision", "Recall", "F1"]
+
+# outcome of each row, in this order; rows without an answer (e.g. a failed extraction) count in no metric
+LIST_NAMES_OF_OUTCOMES = ["TP", "FP", "TN", "FN", "None"]
+INT_TP, INT_FP, INT_TN, INT_FN, INT_NONE = range(len(LIST_NAMES_OF_OUTCOMES))
+
+# McNemar: below this number of discordant pairs, use the exact binomial test
+INT_MIN_DISCORDANT_PAIRS_FOR_CHI_SQUARE = 25
+
+
+def to_float_array(series: pd.Series) -> np.ndarray:
+	"""1.0 / 0.0 / NaN from booleans, 0/1 or "True"/"False" (as read from a CSV)"""
+
+	dict_values = {True: 1.0, False: 0.0, 1: 1.0, 0: 0.0, "True": 1.0, "False": 0.0, "true": 1.0, "false": 0.0, "1": 1.0, "0": 0.0}
+
+	return series.astype(object).map(lambda value: dict_values.get(value, np.nan)).to_numpy(dtype=float)
+
+
+def classify_outcomes(df_results: pd.DataFrame) -> np.ndarray:
+	"""
+	Outcome of each row, as in 3-Results/Results.ipynb:
+	a detected bug only counts as a true positive if its description is correct (when the results were marked),
+	and as a false positive otherwise.
+	"""
+
+	string_column_truth = "BoolScreenshotContainsVisualBug" if "BoolScreenshotContainsVisualBug" in df_results.columns else "BoolGroundTruth"
+	array_truth = to_float_array(df_results[string_column_truth])
+	array_detected = to_float_array(df_results["BoolDidDetectVisualBug"])
+
+	# unmarked results (straight from script_compile_results): take every description as correct
+	if "BoolDescriptionIsCorrect" in df_results.columns:
+		array_description_is_correct = to_float_array(df_results["BoolDescriptionIsCorrect"])
+	else:
+		array_description_is_correct = np.ones(len(df_results))
+
+	array_outcomes = np.full(len(df_results), INT_NONE, dtype=np.int64)
+	array_outcomes[(array_truth == 1) & (array_detected == 1) & (array_description_is_correct == 1)] = INT_TP
+	array_outcomes[(array_truth == 0) & (array_detected == 1)] = INT_FP
+	array_outcomes[(array_truth == 1) & (array_detected == 1) & (array_description_is_correct == 0)] = INT_FP
+	array_outcomes[(array_truth == 0) & (array_detected == 0)] = INT_TN
+	array_outcomes[(array_truth == 1) & (array_detected == 0)] = INT_FN
+
+	return array_outcomes
+
+
+def compute_metrics_from_counts(array_counts: np.ndarray) -> dict[str, np.ndarray]:
+	"""Metrics from counts of outcomes (last axis in LIST_NAMES_OF_OUTCOMES order), for any leading shape; NaN when undefined"""
+
+	array_tp = array_counts[..., INT_TP].astype(float)
+	array_fp = array_counts[..., INT_FP].astype(float)
+	array_tn = array_counts[..., INT_TN].astype(float)
+	array_fn = array_counts[..., INT_FN].astype(float)
+
+	def divide(array_numerator: np.ndarray, array_denominator: np.ndarray) -> np.ndarray:
+		# e.g. the precision of a group without positive answers: undefined, not 0.0
+		return np.divide(array_numerator, array_denominator, out=np.full_like(array_numerator, np.nan), where=array_denominator > 0)
+
+	return {
+		"Accuracy": divide(array_tp + array_tn, array_tp + array_tn + array_fp + array_fn),
+		"Precision": divide(array_tp, array_tp + array_fp),
+		"Recall": divide(array_tp, array_tp + array_fn),
+		# the harmonic mean of precision & recall, but also defined (0.0) when there is no true positive
+		"F1": divide(2 * array_tp, 2 * array_tp + array_fp + array_fn),
+	}
+
+
+def pair_bug_types_with_clean(df_results: pd.DataFrame) -> pd.DataFrame:
+	"""
+	The rows of each bug type (snapshot other than clean) with the clean rows, in a TextBugType column:
+	a bug type alone has no negatives, so its precision would be undefined. The clean rows are repeated for every bug type.
+	"""
+	array_is_clean = (df_results["TextSampleName"].astype(str) == "clean").to_numpy()
+	df_clean = df_results[array_is_clean]
+	df_bugs = df_results[~array_is_clean]
+
+	list_dataframes = []
+
+	for string_bug_type in sorted(df_bugs["TextSampleName"].astype(str).unique()):
+		df_of_bug_type = pd.concat([df_bugs[df_bugs["TextSampleName"].astype(str) == string_bug_type], df_clean], ignore_index=True)
+		df_of_bug_type["TextBugType"] = string_bug_type
+		list_dataframes.append(df_of_bug_type)
+
+	if len(list_dataframes) == 0:
+		return df_results.assign(TextBugType=pd.Series(dtype=str)).iloc[0:0]
+
+	return pd.concat(list_dataframes, ignore_index=True)
+
+
+def count_outcomes_per_group(df_results: pd.DataFrame, list_group_by: list[str]) -> tuple[pd.DataFrame, np.ndarray]:
+	"""The groups (one row each) and their counts of outcomes, shape (number of groups, number of outcomes)"""
+
+	array_outcomes = classify_outcomes(df_results)
+	grouped = df_results.groupby(list_group_by, observed=True, sort=True)
+	array_codes_of_groups = grouped.ngroup().to_numpy()
+	int_number_of_groups = grouped.ngroups
+
+	array_counts = np.bincount(
+		array_codes_of_groups * len(LIST_NAMES_OF_OUTCOMES) + array_outcomes,
+		minlength=int_number_of_groups * len(LIST_NAMES_OF_OUTCOMES)
+	).reshape(int_number_of_groups, len(LIST_NAMES_OF_OUTCOMES))
+
+	df_groups = grouped.size().reset_index(name="IntNumberOfSamples")
+
+	return df_groups, array_counts
+
+
+def compute_metrics(
+	df_results: pd.DataFrame,
+	list_group_by: Optional[list[str]] = None,
+	int_number_of_resamples: int = 10000,
+	float_confidence_level: float = 0.95,
+	int_seed: int = 0,
+	int_resamples_per_chunk: int = 1000
+) -> pd.DataFrame:
+	"""
+	Accuracy, precision, recall & F1 per group (by default per model x strategy x bug type, each bug type with the clean snapshots),
+	with percentile bootstrap confidence intervals; NaN when a metric is undefined (e.g. the precision of a group without positive answers).
+
+	Resampling the rows of a group with replacement only changes how many of each outcome it has,
+	so each bootstrap sample of a group is drawn as one multinomial over its observed outcome frequencies,
+	for all groups and many resamples at once.
+	"""
+
+	if list_group_by is None:
+		list_group_by = LIST_GROUP_BY_DEFAULT
+
+	if "TextBugType" in list_group_by and "TextBugType" not in df_results.columns:
+		df_results = pair_bug_types_with_clean(df_results)
+
+	df_groups, array_counts = count_outcomes_per_group(df_results, list_group_by)
+	dict_metrics = compute_metrics_from_counts(array_counts)
+
+	df_metrics = df_groups.copy()
+
+	for string_name_of_outcome, array_counts_of_outcome in zip(LIST_NAMES_OF_OUTCOMES, array_counts.T):
+		df_metrics[f"Int{string_name_of_outcome}"] = array_counts_of_outcome
+
+	for string_name_of_metric in LIST_NAMES_OF_METRICS:
+		df_metrics[string_name_of_metric] = dict_metrics[string_name_of_metric]
+
+	if int_number_of_resamples <= 0:
+		return df_metrics
+
+	array_number_of_rows = array_counts.sum(axis=1)
+	array_frequencies = array_counts / np.maximum(array_number_of_rows, 1)[:, None]
+	rng = np.random.default_rng(int_seed)
+
+	dict_resampled: dict[str, list[np.ndarray]] = {string_name_of_metric: [] for string_name_of_metric in LIST_NAMES_OF_METRICS}
+
+	# chunks of resamples keep memory bounded: (resamples, groups, outcomes) integers per chunk
+	for int_start in range(0, int_number_of_resamples, int_resamples_per_chunk):
+		int_number_in_chunk = min(int_resamples_per_chunk, int_number_of_resamples - int_start)
+		array_counts_resampled = rng.multinomial(array_number_of_rows, array_frequencies, size=(int_number_in_chunk, len(array_number_of_rows)))
+		dict_metrics_resampled = compute_metrics_from_counts(array_counts_resampled)
+
+		for string_name_of_metric in LIST_NAMES_OF_METRICS:
+			dict_resampled[string_name_of_metric].append(dict_metrics_resampled[string_name_of_metric])
+
+	float_alpha = (1.0 - float_confidence_level) / 2
+
+	for string_name_of_metric in LIST_NAMES_OF_METRICS:
+		array_resampled = np.concatenate(dict_resampled[string_name_of_metric], axis=0)
+
+		# resamples where the metric is undefined are left out; NaN if it is undefined in all of them
+		with warnings.catch_warnings():
+			warnings.simplefilter("ignore", RuntimeWarning)
+			array_low, array_high = np.nanquantile(array_resampled, [float_alpha, 1.0 - float_alpha], axis=0)
+		df_metrics[f"{string_name_of_metric}Low"] = array_low
+		df_metrics[f"{string_name_of_metric}High"] = array_high
+
+	return df_metrics
+
+
+def compute_p_value_of_mcnemar(int_b: int, int_c: int) -> float:
+	"""Two-sided McNemar test from the discordant pairs: exact binomial for few pairs, chi-square with continuity correction otherwise"""
+
+	int_n = int_b + int_c
+
+	if int_n == 0:
+		return 1.0
+
+	if int_n < INT_MIN_DISCORDANT_PAIRS_FOR_CHI_SQUARE:
+		float_cdf = sum(math.comb(int_n, int_k) for int_k in range(min(int_b, int_c) + 1)) / 2 ** int_n
+		return min(1.0, 2 * float_cdf)
+
+	float_chi_square = (abs(int_b - int_c) - 1) ** 2 / int_n
+
+	# survival function of the chi-square distribution with 1 degree of freedom
+	return math.erfc(math.sqrt(float_chi_square / 2))
+
+
+def compare_strategies(
+	df_results: pd.DataFrame,
+	list_group_by: Optional[list[str]] = None,
+	list_pair_by: Optional[list[str]] = None
+) -> pd.DataFrame:
+	"""
+	McNemar tests between every pair of prompt strategies (within each group, by default per model),
+	on the samples both strategies answered: the same app, snapshot (and run, if there are several).
+	A sample is correct if it is a true positive or a true negative.
+	"""
+
+	if list_group_by is None:
+		list_group_by = ["TextModelAPI"]
+
+	if list_pair_by is None:
+		list_pair_by = [string_column for string_column in ["TextAppName", "TextSampleName", "IntRunNumber"] if string_column in df_results.columns]
+
+	array_outcomes = classify_outcomes(df_results)
+	df_correct = df_results[list_group_by + list_pair_by + ["TextPromptStrategy"]].copy()
+	df_correct["BoolCorrect"] = np.isin(array_outcomes, [INT_TP, INT_TN])
+	df_correct = df_correct[array_outcomes != INT_NONE]
+
+	# one column of correctness per strategy, one row per paired sample
+	df_wide = df_correct.pivot_table(index=list_group_by + list_pair_by, columns="TextPromptStrategy", values="BoolCorrect", aggfunc="first", observed=True)
+
+	list_records = []
+
+	for tuple_group, df_wide_of_group in df_wide.groupby(level=list_group_by if len(list_group_by) > 1 else list_group_by[0], observed=True):
+
+		for string_strategy_a, string_strategy_b in combinations(df_wide_of_group.columns, 2):
+
+			df_pairs = df_wide_of_group[[string_strategy_a, string_strategy_b]].dropna()
+			array_a = df_pairs[string_strategy_a].to_numpy(dtype=bool)
+			array_b = df_pairs[string_strategy_b].to_numpy(dtype=bool)
+
+			int_b = int(np.sum(array_a & ~array_b))
+			int_c = int(np.sum(~array_a & array_b))
+
+			list_records.append({
+				**dict(zip(list_group_by, tuple_group if isinstance(tuple_group, tuple) else (tuple_group,))),
+				"TextPromptStrategyA": string_strategy_a,
+				"TextPromptStrategyB": string_strategy_b,
+				"IntNumberOfPairs": len(df_pairs),
+				"AccuracyA": float(array_a.mean()) if len(df_pairs) > 0 else np.nan,
+				"AccuracyB": float(array_b.mean()) if len(df_pairs) > 0 else np.nan,
+				"IntOnlyACorrect": int_b,
+				"IntOnlyBCorrect": int_c,
+				"PValue": compute_p_value_of_mcnemar(int_b, int_c),
+			})
+
+	return pd.DataFrame.from_records(list_records)
+
+
+def load_results_table(path_to_results: Path) -> pd.DataFrame:
+	"""compiled.csv (or a marked copy of it), or the Parquet dataset of script_compile_results --parquet"""
+
+	if path_to_results.is_dir():
+		return read_compiled_results(path_to_results, bool_with_responses=False)
+
+	if path_to_results.suffix == ".parquet":
+		return pd.read_parquet(path_to_results)
+
+	return pd.read_csv(path_to_results, index_col=None)
+
+
+def main():
+
+	parser = argparse.ArgumentParser(
+		prog='python3 -m vlm_analysis.metrics',
+		description='Accuracy, precision, recall & F1 with bootstrap confidence intervals, and McNemar tests between prompt strategies',
+	)
+	parser.add_argument("--results", type=str, default="../Data/2-Experiments/results/compiled.csv", help="compiled.csv, a marked copy of it, or a compiled.parquet dataset")
+	parser.add_argument("--group-by", type=str, nargs="+", default=LIST_GROUP_BY_DEFAULT, help="Columns to group by; TextBugType pairs each bug type with the clean snapshots")
+	parser.add_argument("--resamples", type=int, default=10000, help="Number of bootstrap resamples (0 to skip the confidence intervals)")
+	parser.add_argument("--confidence", type=float, default=0.95)
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--output-metrics", type=str, default="../Data/2-Experiments/results/metrics.csv")
+	parser.add_argument("--output-comparisons", type=str, default="../Data/2-Experiments/results/comparisons.csv")
+	args = parser.parse_args()
+
+	df_results = load_results_table(Path(args.results))
+
+	df_metrics = compute_metrics(df_results, args.group_by, args.resamples, args.confidence, args.seed)
+	df_metrics.to_csv(args.output_metrics, index=False)
+	print(f"Wrote metrics of {len(df_metrics)} groups to \"{args.output_metrics}\"")
+
+	df_comparisons = compare_strategies(df_results)
+	df_comparisons.to_csv(args.output_comparisons, index=False)
+	print(f"Wrote {len(df_comparisons)} comparisons of prompt strategies to \"{args.output_comparisons}\"")
+
+
+if __name__ == "__main__":
+
+	main()
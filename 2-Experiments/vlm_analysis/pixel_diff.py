@@ -0,0 +1,207 @@
+import base64
+import io
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import NamedTuple, Optional
+import numpy as np
+from PIL import Image
+from skimage.measure import label, regionprops
+from skimage.metrics import structural_similarity
+from skimage.morphology import remove_small_objects
+
+
+# duplicated hardcoded path! (see utilities.load_encoded_image)
+PATH_TO_SCREENSHOTS = Path("../Data/1d-Collecting_Screenshots/screenshots")
+
+# above this many regions, the diff is noise (or a change of the whole frame): one box around all of them is used
+INT_MAX_REGIONS_BEFORE_MERGING = 64
+
+
+@dataclass(frozen=True)
+class PixelDiffPolicy:
+	"""How a snapshot is compared to the clean.png of its app, and how its regions of interest are sent"""
+	# a pixel changed if one of its channels differs by more than this fraction of 255
+	float_threshold: float = 0.05
+	# changed areas smaller than this (in pixels) are noise, e.g. anti-aliasing
+	int_min_region_pixels: int = 16
+	# context kept around each changed area (in pixels of the screenshot); closer areas are merged
+	int_margin: int = 32
+	int_max_regions: int = 3
+	# regions covering more of the frame than this are not worth cropping: the full screenshot is sent
+	float_max_fraction_of_frame: float = 0.5
+	# send cropped regions of interest instead of the full screenshot (otherwise, only the diff statistics are recorded)
+	bool_send_regions_of_interest: bool = False
+	# crops are scaled (up to float_max_upscale times) so that their longest side is int_side_of_region
+	int_side_of_region: int = 512
+	float_max_upscale: float = 4.0
+	# also send the full screenshot, downscaled so that its longest side is int_side_of_full_frame (0: do not)
+	int_side_of_full_frame: int = 0
+
+
+class PixelDiff(NamedTuple):
+	dict_stats: dict
+	# (left, top, right, bottom) in pixels of the screenshot, largest first
+	list_boxes: list[tuple[int, int, int, int]]
+
+
+STRING_PROMPT_REGIONS_OF_INTEREST = "The screenshot is sent as enlarged crops of its regions of interest{string_full_frame}. Boxes of the regions (left, top, right, bottom) in pixels of the {int_width}x{int_height} screenshot: {string_boxes}."
+
+
+def make_path_to_screenshot(string_name_of_app: str, string_name_of_snapshot: str) -> Path:
+	return PATH_TO_SCREENSHOTS / string_name_of_app / f"{string_name_of_snapshot}.png"
+
+
+def compute_pixel_diff(string_name_of_app: str, string_name_of_snapshot: str, policy: PixelDiffPolicy) -> PixelDiff:
+	"""Diff of a snapshot against the clean.png of its app (cached while neither file changes)"""
+
+	path_to_snapshot = make_path_to_screenshot(string_name_of_app, string_name_of_snapshot)
+	path_to_baseline = make_path_to_screenshot(string_name_of_app, "clean")
+
+	pixel_diff = compute_pixel_diff_cached(str(path_to_snapshot), path_to_snapshot.stat().st_mtime_ns, str(path_to_baseline), path_to_baseline.stat().st_mtime_ns, policy)
+
+	# copies: the cached diff is shared
+	return PixelDiff(dict(pixel_diff.dict_stats), list(pixel_diff.list_boxes))
+
+
+@lru_cache(maxsize=256)
+def compute_pixel_diff_cached(string_path_to_snapshot: str, int_mtime_of_snapshot: int, string_path_to_baseline: str, int_mtime_of_baseline: int, policy: PixelDiffPolicy) -> PixelDiff:
+
+	with Image.open(string_path_to_snapshot) as image:
+		array_snapshot = np.asarray(image.convert("RGB"))
+
+	with Image.open(string_path_to_baseline) as image:
+		array_baseline = np.asarray(image.convert("RGB"))
+
+	int_height, int_width = array_snapshot.shape[:2]
+
+	# e.g. a bug that resized the canvas: no pixel-wise comparison possible
+	if array_snapshot.shape != array_baseline.shape:
+		return PixelDiff({"int_width": int_width, "int_height": int_height, "bool_size_differs": True}, [])
+
+	array_difference = np.abs(array_snapshot.astype(np.int16) - array_baseline.astype(np.int16)).max(axis=2) / 255.0
+	array_changed = remove_small_objects(array_difference > policy.float_threshold, min_size=policy.int_min_region_pixels)
+	int_number_of_changed_pixels = int(array_changed.sum())
+
+	list_boxes = []
+
+	if int_number_of_changed_pixels > 0:
+		list_boxes = merge_boxes(
+			[make_box_with_margin(region.bbox, policy.int_margin, int_width, int_height) for region in regionprops(label(array_changed, connectivity=2))],
+			policy.int_max_regions
+		)
+
+	dict_stats = {
+		"int_width": int_width,
+		"int_height": int_height,
+		"bool_size_differs": False,
+		"int_number_of_changed_pixels": int_number_of_changed_pixels,
+		"float_fraction_of_pixels_changed": int_number_of_changed_pixels / (int_width * int_height),
+		"float_max_difference": float(array_difference.max()),
+		"float_mean_difference_of_changed_pixels": float(array_difference[array_changed].mean()) if int_number_of_changed_pixels > 0 else 0.0,
+		"float_ssim": float(structural_similarity(
+			np.asarray(Image.fromarray(array_snapshot).convert("L")),
+			np.asarray(Image.fromarray(array_baseline).convert("L")),
+			data_range=255
+		)),
+		"list_boxes": [list(box) for box in list_boxes],
+		"float_fraction_of_frame_in_boxes": sum((box[2] - box[0]) * (box[3] - box[1]) for box in list_boxes) / (int_width * int_height),
+	}
+
+	return PixelDiff(dict_stats, list_boxes)
+
+
+def make_box_with_margin(tuple_bbox: tuple[int, int, int, int], int_margin: int, int_width: int, int_height: int) -> tuple[int, int, int, int]:
+	# regionprops: (min_row, min_col, max_row, max_col)
+	int_top, int_left, int_bottom, int_right = tuple_bbox
+	return max(0, int_left - int_margin), max(0, int_top - int_margin), min(int_width, int_right + int_margin), min(int_height, int_bottom + int_margin)
+
+
+def merge_boxes(list_boxes: list[tuple[int, int, int, int]], int_max_regions: int) -> list[tuple[int, int, int, int]]:
+	"""Merge overlapping boxes until none overlap; if more than int_max_regions are left, one box around all of them"""
+
+	if len(list_boxes) > INT_MAX_REGIONS_BEFORE_MERGING:
+		list_boxes = [make_box_around(list_boxes)]
+
+	bool_merged = True
+
+	while bool_merged:
+		bool_merged = False
+
+		for int_index_a in range(len(list_boxes)):
+
+			for int_index_b in range(int_index_a + 1, len(list_boxes)):
+
+				box_a, box_b = list_boxes[int_index_a], list_boxes[int_index_b]
+
+				if box_a[0] < box_b[2] and box_b[0] < box_a[2] and box_a[1] < box_b[3] and box_b[1] < box_a[3]:
+					list_boxes = [box for int_index, box in enumerate(list_boxes) if int_index not in (int_index_a, int_index_b)] + [make_box_around([box_a, box_b])]
+					bool_merged = True
+					break
+
+			if bool_merged:
+				break
+
+	if len(list_boxes) > int_max_regions:
+		list_boxes = [make_box_around(list_boxes)]
+
+	return sorted(list_boxes, key=lambda box: (-(box[2] - box[0]) * (box[3] - box[1]), box[1], box[0]))
+
+
+def make_box_around(list_boxes: list[tuple[int, int, int, int]]) -> tuple[int, int, int, int]:
+	return min(box[0] for box in list_boxes), min(box[1] for box in list_boxes), max(box[2] for box in list_boxes), max(box[3] for box in list_boxes)
+
+
+def make_images_of_regions_of_interest(string_name_of_app: str, string_name_of_snapshot: str, pixel_diff: PixelDiff, policy: PixelDiffPolicy) -> Optional[tuple[str, list[str]]]:
+	"""
+	Text describing the regions, and the base64 PNGs to send instead of the screenshot (the downscaled full frame first, if enabled),
+	or None if the full screenshot should be sent: nothing changed, or the regions cover too much of the frame
+	"""
+	if len(pixel_diff.list_boxes) == 0 or pixel_diff.dict_stats["float_fraction_of_frame_in_boxes"] > policy.float_max_fraction_of_frame:
+		return None
+
+	with Image.open(make_path_to_screenshot(string_name_of_app, string_name_of_snapshot)) as image:
+		image_screenshot = image.convert("RGB")
+
+	list_of_base64_images = []
+
+	if policy.int_side_of_full_frame > 0:
+		float_scale = min(1.0, policy.int_side_of_full_frame / max(image_screenshot.size))
+		size_full_frame = (max(1, round(image_screenshot.width * float_scale)), max(1, round(image_screenshot.height * float_scale)))
+		list_of_base64_images.append(encode_png(image_screenshot.resize(size_full_frame, Image.Resampling.LANCZOS)))
+
+	for box in pixel_diff.list_boxes:
+		image_region = image_screenshot.crop(box)
+		float_scale = min(policy.float_max_upscale, policy.int_side_of_region / max(image_region.size))
+		size_region = (max(1, round(image_region.width * float_scale)), max(1, round(image_region.height * float_scale)))
+		# nearest neighbour keeps the edges of enlarged pixels sharp (as for the sprites of the asset atlas)
+		resample = Image.Resampling.NEAREST if float_scale > 1.0 else Image.Resampling.LANCZOS
+		list_of_base64_images.append(encode_png(image_region.resize(size_region, resample)))
+
+	string_prompt = STRING_PROMPT_REGIONS_OF_INTEREST.format(
+		string_full_frame=", after the full screenshot (downscaled)" if policy.int_side_of_full_frame > 0 else "",
+		int_width=image_screenshot.width,
+		int_height=image_screenshot.height,
+		string_boxes=", ".join(str(tuple(box)) for box in pixel_diff.list_boxes)
+	)
+
+	return string_prompt, list_of_base64_images
+
+
+def encode_png(image: Image.Image) -> str:
+	buffer = io.BytesIO()
+	image.save(buffer, format="PNG", optimize=True)
+	return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+# Policy used by the message builders & save_results; None: no diff (the setup used in the paper)
+pixel_diff_policy: Optional[PixelDiffPolicy] = None
+
+
+def configure_pixel_diff(policy: Optional[PixelDiffPolicy]):
+	global pixel_diff_policy
+	pixel_diff_policy = policy
+
+
+def get_pixel_diff_policy() -> Optional[PixelDiffPolicy]:
+	return pixel_diff_policy
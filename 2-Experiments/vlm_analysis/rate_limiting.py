@@ -0,0 +1,289 @@
+import asyncio
+import json
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import Mapping, Optional
+
+
+# Rough token count of an image part used when budgeting tokens before the request is sent
+# (a 512px tile of a "high" detail image costs 170 tokens plus a base of 85 for gpt-4o)
+INT_ESTIMATED_TOKENS_PER_IMAGE = 765
+INT_ESTIMATED_TOKENS_PER_RESPONSE = 1000
+
+# concurrency is halved at most once per this many seconds (or per `retry-after`, if longer)
+FLOAT_MIN_SECONDS_BETWEEN_DECREASES = 1.0
+
+
+class AdaptiveRateLimiter:
+	"""
+	Shared limiter for asyncio model API calls.
+
+	Enforces requests-per-minute and tokens-per-minute budgets with token buckets,
+	and adapts the number of concurrent requests with AIMD (additive increase, multiplicative decrease)
+	from the `x-ratelimit-remaining-*` and `retry-after` headers returned by the API.
+	"""
+
+	def __init__(
+		self,
+		int_requests_per_minute: int = 500,
+		int_tokens_per_minute: int = 30000,
+		int_max_concurrency: int = 16,
+		int_min_concurrency: int = 1,
+		int_initial_concurrency: Optional[int] = None
+	):
+		self.int_requests_per_minute = int_requests_per_minute
+		self.int_tokens_per_minute = int_tokens_per_minute
+		self.int_max_concurrency = int_max_concurrency
+		self.int_min_concurrency = int_min_concurrency
+		self.float_concurrency = float(int_initial_concurrency or max(int_min_concurrency, int_max_concurrency // 2))
+
+		self.float_requests_available = float(int_requests_per_minute)
+		self.float_tokens_available = float(int_tokens_per_minute)
+		self.float_time_of_last_refill = time.monotonic()
+		# no request may start before this time (set from `retry-after`)
+		self.float_time_paused_until = 0.0
+		# one multiplicative decrease per congestion event, not one per response of the requests that were in flight
+		self.float_time_of_last_decrease = float("-inf")
+
+		self.int_number_in_flight = 0
+		self.int_number_of_rate_limited_responses = 0
+		self._condition: Optional[asyncio.Condition] = None
+
+	@property
+	def condition(self) -> asyncio.Condition:
+		# created lazily so the limiter can be constructed outside of the event loop
+		if self._condition is None:
+			self._condition = asyncio.Condition()
+		return self._condition
+
+	@property
+	def int_concurrency(self) -> int:
+		return max(self.int_min_concurrency, int(self.float_concurrency))
+
+	def refill(self):
+		float_now = time.monotonic()
+		float_minutes_elapsed = (float_now - self.float_time_of_last_refill) / 60.0
+		self.float_time_of_last_refill = float_now
+
+		self.float_requests_available = min(
+			float(self.int_requests_per_minute),
+			self.float_requests_available + float_minutes_elapsed * self.int_requests_per_minute
+		)
+		self.float_tokens_available = min(
+			float(self.int_tokens_per_minute),
+			self.float_tokens_available + float_minutes_elapsed * self.int_tokens_per_minute
+		)
+
+	def get_seconds_until_available(self, int_number_of_tokens: int) -> float:
+		"""Return 0 if a request of this size can start now, otherwise a time to wait before checking again"""
+		self.refill()
+
+		float_now = time.monotonic()
+
+		if float_now < self.float_time_paused_until:
+			return self.float_time_paused_until - float_now
+
+		if self.int_number_in_flight >= self.int_concurrency:
+			# woken up by release()
+			return float("inf")
+
+		# never wait forever on a request larger than the whole per-minute budget
+		float_tokens_needed = min(float(int_number_of_tokens), float(self.int_tokens_per_minute))
+
+		float_seconds_requests = max(0.0, (1.0 - self.float_requests_available) * 60.0 / self.int_requests_per_minute)
+		float_seconds_tokens = max(0.0, (float_tokens_needed - self.float_tokens_available) * 60.0 / self.int_tokens_per_minute)
+
+		return max(float_seconds_requests, float_seconds_tokens)
+
+	async def acquire(self, int_number_of_tokens: int):
+
+		async with self.condition:
+			while True:
+				float_seconds_to_wait = self.get_seconds_until_available(int_number_of_tokens)
+
+				if float_seconds_to_wait <= 0:
+					break
+
+				try:
+					timeout = None if float_seconds_to_wait == float("inf") else float_seconds_to_wait
+					await asyncio.wait_for(self.condition.wait(), timeout=timeout)
+
+				except asyncio.TimeoutError:
+					pass
+
+			self.float_requests_available -= 1
+			self.float_tokens_available -= int_number_of_tokens
+			self.int_number_in_flight += 1
+
+	async def release(self, int_number_of_tokens_estimated: int = 0, int_number_of_tokens_used: Optional[int] = None):
+
+		async with self.condition:
+			self.int_number_in_flight -= 1
+
+			# give back what was over-reserved (or take what was under-reserved)
+			if int_number_of_tokens_used is not None:
+				self.float_tokens_available += int_number_of_tokens_estimated - int_number_of_tokens_used
+
+			self.condition.notify_all()
+
+	@asynccontextmanager
+	async def limit(self, int_number_of_tokens: int):
+		"""
+		Usage:
+			async with rate_limiter.limit(int_number_of_tokens) as slot:
+				...
+				slot.update_from_response(headers, int_number_of_tokens_used)
+		"""
+		await self.acquire(int_number_of_tokens)
+		slot = RateLimiterSlot(self, int_number_of_tokens)
+
+		try:
+			yield slot
+
+		finally:
+			await self.release(int_number_of_tokens, slot.int_number_of_tokens_used)
+
+	def on_success(self, headers: Optional[Mapping[str, str]] = None):
+
+		int_remaining_requests = parse_int_header(headers, "x-ratelimit-remaining-requests")
+		int_remaining_tokens = parse_int_header(headers, "x-ratelimit-remaining-tokens")
+
+		# the server knows best how much budget is left
+		if int_remaining_requests is not None:
+			self.float_requests_available = min(self.float_requests_available, float(int_remaining_requests))
+
+		if int_remaining_tokens is not None:
+			self.float_tokens_available = min(self.float_tokens_available, float(int_remaining_tokens))
+
+		bool_close_to_limit = (
+			(int_remaining_requests is not None and int_remaining_requests < 0.05 * self.int_requests_per_minute)
+			or (int_remaining_tokens is not None and int_remaining_tokens < 0.05 * self.int_tokens_per_minute)
+		)
+
+		if bool_close_to_limit:
+			self.decrease_concurrency()
+
+		else:
+			# additive increase: one more slot per "window" of successful requests
+			self.float_concurrency = min(
+				float(self.int_max_concurrency),
+				self.float_concurrency + 1.0 / max(1.0, self.float_concurrency)
+			)
+
+	def on_rate_limited(self, headers: Optional[Mapping[str, str]] = None):
+
+		self.int_number_of_rate_limited_responses += 1
+
+		float_seconds_retry_after = parse_retry_after(headers)
+
+		if float_seconds_retry_after is None:
+			float_seconds_retry_after = 1.0
+
+		# the other 429s of the same window were caused by requests sent before this decrease
+		self.decrease_concurrency(max(FLOAT_MIN_SECONDS_BETWEEN_DECREASES, float_seconds_retry_after))
+
+		self.float_time_paused_until = max(self.float_time_paused_until, time.monotonic() + float_seconds_retry_after)
+
+	def decrease_concurrency(self, float_seconds_of_window: float = FLOAT_MIN_SECONDS_BETWEEN_DECREASES):
+		# multiplicative decrease, at most once per window
+		float_now = time.monotonic()
+
+		if float_now - self.float_time_of_last_decrease < float_seconds_of_window:
+			return
+
+		self.float_time_of_last_decrease = float_now
+		self.float_concurrency = max(float(self.int_min_concurrency), self.float_concurrency / 2.0)
+
+
+class RateLimiterSlot:
+
+	def __init__(self, rate_limiter: AdaptiveRateLimiter, int_number_of_tokens_estimated: int):
+		self.rate_limiter = rate_limiter
+		self.int_number_of_tokens_estimated = int_number_of_tokens_estimated
+		self.int_number_of_tokens_used: Optional[int] = None
+
+	def update_from_response(self, headers: Optional[Mapping[str, str]] = None, int_number_of_tokens_used: Optional[int] = None):
+		self.int_number_of_tokens_used = int_number_of_tokens_used
+		self.rate_limiter.on_success(headers)
+
+	def update_from_rate_limited_response(self, headers: Optional[Mapping[str, str]] = None):
+		self.rate_limiter.on_rate_limited(headers)
+
+
+def parse_int_header(headers: Optional[Mapping[str, str]], string_name: str) -> Optional[int]:
+
+	if headers is None:
+		return None
+
+	string_value = headers.get(string_name)
+
+	try:
+		return int(string_value)  # type: ignore
+
+	except (TypeError, ValueError):
+		return None
+
+
+def parse_retry_after(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+	"""Read `retry-after-ms`, `retry-after` or `x-ratelimit-reset-*` (e.g. "6m0s", "20ms") headers"""
+
+	if headers is None:
+		return None
+
+	try:
+		if headers.get("retry-after-ms") is not None:
+			return float(headers["retry-after-ms"]) / 1000.0
+
+		if headers.get("retry-after") is not None:
+			return float(headers["retry-after"])
+
+	except ValueError:
+		pass
+
+	list_seconds_until_reset = [
+		parse_duration(headers.get(string_name))
+		for string_name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+	]
+	list_seconds_until_reset = [s for s in list_seconds_until_reset if s is not None]
+
+	return max(list_seconds_until_reset) if list_seconds_until_reset else None
+
+
+def parse_duration(string_duration: Optional[str]) -> Optional[float]:
+
+	if not string_duration:
+		return None
+
+	dict_seconds_per_unit = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+	list_matches = re.findall(r"([\d.]+)(ms|h|m|s)", string_duration)
+
+	if not list_matches:
+		return None
+
+	return sum(float(string_number) * dict_seconds_per_unit[string_unit] for string_number, string_unit in list_matches)
+
+
+def estimate_number_of_tokens(list_of_message_dicts: list[dict], int_max_tokens_of_response: int = INT_ESTIMATED_TOKENS_PER_RESPONSE) -> int:
+	"""Cheap upper-bound estimate of the tokens a request will use (about 4 characters per token)"""
+
+	int_number_of_images = 0
+	int_number_of_characters = 0
+
+	for message_dict in list_of_message_dicts:
+
+		content = message_dict.get("content")
+		list_of_parts = content if isinstance(content, list) else [content]
+
+		for part in list_of_parts:
+
+			if isinstance(part, dict) and part.get("type") == "image_url":
+				int_number_of_images += 1
+
+			elif isinstance(part, dict):
+				int_number_of_characters += len(part.get("text", ""))
+
+			elif part is not None:
+				int_number_of_characters += len(json.dumps(part))
+
+	return int_number_of_characters // 4 + int_number_of_images * INT_ESTIMATED_TOKENS_PER_IMAGE + int_max_tokens_of_response
@@ -0,0 +1,266 @@
+import hashlib
+import math
+import os
+import re
+import threading
+from collections import Counter
+from typing import NamedTuple, Optional
+from .tokenization import count_tokens_of_text
+
+
+INT_MAX_TOKENS_PER_CHUNK_DEFAULT = 256
+
+# added to the prompt as the query: what the README chunks are ranked for
+STRING_QUERY_DEFAULT = (
+	"canvas screen display render draw drawing graphics visual view interface ui game play player controls "
+	"sprite image color colour layout shape text animation scene chart plot editor tool feature usage example demo screenshot"
+)
+
+# BM25 parameters (the usual defaults)
+FLOAT_K1 = 1.5
+FLOAT_B = 0.75
+
+SET_STOP_WORDS = {
+	"a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "if", "in", "is", "it", "its", "of", "on",
+	"or", "that", "the", "this", "to", "was", "were", "will", "with", "you", "your", "any", "so", "please", "does",
+}
+
+PATTERN_HTML_COMMENT = re.compile(r"<!--.*?-->", re.DOTALL)
+# [![alt](image)](link), possibly many on one line
+PATTERN_BADGE = re.compile(r"\[!\[[^\]]*\]\([^)]*\)\]\([^)]*\)")
+PATTERN_IMAGE = re.compile(r"!\[[^\]]*\]\([^)]*\)")
+# [label]: https://... reference definitions, mostly for badges
+PATTERN_LINK_REFERENCE = re.compile(r"^\s*\[[^\]]+\]:\s*\S+.*$", re.MULTILINE)
+PATTERN_HTML_TAG = re.compile(r"</?[a-zA-Z][^>]*>")
+PATTERN_BLANK_LINES = re.compile(r"\n\s*\n\s*\n+")
+PATTERN_HEADING = re.compile(r"^#{1,6}\s")
+PATTERN_WORD = re.compile(r"[a-z0-9]+")
+
+
+class ReadmeChunk(NamedTuple):
+	int_index: int
+	string_text: str
+	int_number_of_tokens: int
+
+
+def clean_readme(string_readme: str) -> str:
+	"""Remove what costs tokens without describing the app: badges, images, HTML tags & comments"""
+
+	string_readme = PATTERN_HTML_COMMENT.sub("", string_readme)
+	string_readme = PATTERN_BADGE.sub("", string_readme)
+	string_readme = PATTERN_IMAGE.sub("", string_readme)
+	string_readme = PATTERN_LINK_REFERENCE.sub("", string_readme)
+	# keep the text inside the tags
+	string_readme = PATTERN_HTML_TAG.sub("", string_readme)
+	string_readme = "\n".join(string_line.rstrip() for string_line in string_readme.split("\n"))
+	string_readme = PATTERN_BLANK_LINES.sub("\n\n", string_readme)
+
+	return string_readme.strip()
+
+
+def split_into_sections(string_readme: str) -> list[str]:
+	"""Split markdown at its headings (each section starts with its heading)"""
+
+	list_sections: list[list[str]] = [[]]
+	bool_in_code_block = False
+
+	for string_line in string_readme.split("\n"):
+
+		if string_line.lstrip().startswith("```"):
+			bool_in_code_block = not bool_in_code_block
+
+		if not bool_in_code_block and PATTERN_HEADING.match(string_line) and len(list_sections[-1]) > 0:
+			list_sections.append([])
+
+		list_sections[-1].append(string_line)
+
+	return [string_section for string_section in ("\n".join(list_lines).strip() for list_lines in list_sections) if len(string_section) > 0]
+
+
+def make_digest_of_section(string_section: str) -> str:
+	# the same section (e.g. "License" or "Installation") is often repeated in the READMEs of a monorepo's packages
+	return hashlib.sha256(" ".join(string_section.lower().split()).encode("utf-8")).hexdigest()
+
+
+def split_section_into_chunks(string_section: str, int_max_tokens_per_chunk: int) -> list[str]:
+	"""Split a long section at blank lines into chunks of up to about int_max_tokens_per_chunk tokens, repeating its heading in each"""
+
+	if count_tokens_of_text(string_section) <= int_max_tokens_per_chunk:
+		return [string_section]
+
+	list_paragraphs = string_section.split("\n\n")
+	string_heading = list_paragraphs[0] if PATTERN_HEADING.match(list_paragraphs[0]) else ""
+
+	list_chunks = []
+	list_paragraphs_of_chunk: list[str] = []
+	int_tokens_of_chunk = 0
+
+	for string_paragraph in list_paragraphs:
+
+		int_tokens_of_paragraph = count_tokens_of_text(string_paragraph)
+
+		if len(list_paragraphs_of_chunk) > 0 and int_tokens_of_chunk + int_tokens_of_paragraph > int_max_tokens_per_chunk:
+			list_chunks.append("\n\n".join(list_paragraphs_of_chunk))
+			list_paragraphs_of_chunk = [string_heading] if string_heading else []
+			int_tokens_of_chunk = count_tokens_of_text(string_heading) if string_heading else 0
+
+		list_paragraphs_of_chunk.append(string_paragraph)
+		int_tokens_of_chunk += int_tokens_of_paragraph
+
+	list_chunks.append("\n\n".join(list_paragraphs_of_chunk))
+
+	return list_chunks
+
+
+def make_chunks(string_readme: str, int_max_tokens_per_chunk: int = INT_MAX_TOKENS_PER_CHUNK_DEFAULT) -> list[ReadmeChunk]:
+
+	list_chunks = []
+	set_digests_of_sections = set()
+
+	for string_section in split_into_sections(clean_readme(string_readme)):
+
+		string_digest = make_digest_of_section(string_section)
+
+		if string_digest in set_digests_of_sections:
+			continue
+
+		set_digests_of_sections.add(string_digest)
+
+		for string_chunk in split_section_into_chunks(string_section, int_max_tokens_per_chunk):
+			list_chunks.append(ReadmeChunk(len(list_chunks), string_chunk, count_tokens_of_text(string_chunk)))
+
+	return list_chunks
+
+
+def tokenize_words(string_text: str) -> list[str]:
+	return [string_word for string_word in PATTERN_WORD.findall(string_text.lower()) if string_word not in SET_STOP_WORDS]
+
+
+def score_chunks_bm25(list_chunks: list[ReadmeChunk], string_query: str) -> list[float]:
+	"""Okapi BM25 score of every chunk for the query, with the chunks of the README as the corpus"""
+
+	list_counters = [Counter(tokenize_words(chunk.string_text)) for chunk in list_chunks]
+	list_lengths = [sum(counter.values()) for counter in list_counters]
+	float_mean_length = max(1.0, sum(list_lengths) / max(1, len(list_lengths)))
+	int_number_of_chunks = len(list_chunks)
+
+	counter_document_frequencies: Counter = Counter()
+
+	for counter in list_counters:
+		counter_document_frequencies.update(counter.keys())
+
+	set_words_of_query = set(tokenize_words(string_query))
+	list_scores = []
+
+	for counter, int_length in zip(list_counters, list_lengths):
+
+		float_score = 0.0
+
+		for string_word in set_words_of_query:
+
+			int_frequency = counter.get(string_word, 0)
+
+			if int_frequency == 0:
+				continue
+
+			int_document_frequency = counter_document_frequencies[string_word]
+			float_idf = math.log(1 + (int_number_of_chunks - int_document_frequency + 0.5) / (int_document_frequency + 0.5))
+			float_score += float_idf * int_frequency * (FLOAT_K1 + 1) / (int_frequency + FLOAT_K1 * (1 - FLOAT_B + FLOAT_B * int_length / float_mean_length))
+
+		list_scores.append(float_score)
+
+	return list_scores
+
+
+def select_chunks(list_chunks: list[ReadmeChunk], list_scores: list[float], int_budget_tokens: int) -> list[ReadmeChunk]:
+	"""
+	The best chunks that fit in the token budget, in their original order.
+	The first chunk (the title & introduction of the top-level README) is always taken first: it says what the app is.
+	"""
+	list_indices_by_score = sorted(range(len(list_chunks)), key=lambda i: (i != 0, -list_scores[i], i))
+
+	list_chunks_selected = []
+	int_tokens_selected = 0
+
+	for int_index in list_indices_by_score:
+
+		chunk = list_chunks[int_index]
+
+		# a smaller chunk further down the ranking may still fit
+		if int_tokens_selected + chunk.int_number_of_tokens > int_budget_tokens:
+			continue
+
+		list_chunks_selected.append(chunk)
+		int_tokens_selected += chunk.int_number_of_tokens
+
+	return sorted(list_chunks_selected, key=lambda chunk: chunk.int_index)
+
+
+class ReadmeContextBuilder:
+	"""
+	Builds the README context of an app within a token budget:
+	the concatenated READMEs are cleaned, deduplicated by section and chunked,
+	then the chunks most relevant to the prompt (BM25) are kept until the budget is full.
+	"""
+
+	def __init__(self, int_budget_tokens: int, int_max_tokens_per_chunk: int = INT_MAX_TOKENS_PER_CHUNK_DEFAULT, string_query: str = STRING_QUERY_DEFAULT):
+		self.int_budget_tokens = int_budget_tokens
+		self.int_max_tokens_per_chunk = int_max_tokens_per_chunk
+		self.string_query = string_query
+		self.dict_contexts: dict[str, str] = dict()
+		self.lock = threading.Lock()
+
+	def build(self, string_name_of_app: str, string_description: str, string_prompt: str = "") -> str:
+
+		string_key = hashlib.sha256(f"{string_name_of_app}\n{string_prompt}\n{string_description}".encode("utf-8")).hexdigest()
+
+		with self.lock:
+			string_context = self.dict_contexts.get(string_key)
+
+		if string_context is not None:
+			return string_context
+
+		list_chunks = make_chunks(string_description, self.int_max_tokens_per_chunk)
+		list_scores = score_chunks_bm25(list_chunks, f"{self.string_query} {string_prompt}")
+		list_chunks_selected = select_chunks(list_chunks, list_scores, self.int_budget_tokens)
+
+		string_context = "\n\n".join(chunk.string_text for chunk in list_chunks_selected)
+
+		print(
+			f"README context for app {string_name_of_app}: {len(list_chunks_selected)}/{len(list_chunks)} chunks, "
+			f"~{sum(chunk.int_number_of_tokens for chunk in list_chunks_selected)} tokens (README: ~{count_tokens_of_text(string_description)} tokens)"
+		)
+
+		with self.lock:
+			self.dict_contexts[string_key] = string_context
+
+		return string_context
+
+
+# Builder used by load_prompts; None sends the READMEs in full (the setup used in the paper)
+readme_context_builder: Optional[ReadmeContextBuilder] = None
+bool_readme_context_is_configured = False
+lock_readme_context = threading.RLock()
+
+
+def configure_readme_context(int_budget_tokens: Optional[int], int_max_tokens_per_chunk: int = INT_MAX_TOKENS_PER_CHUNK_DEFAULT) -> Optional[ReadmeContextBuilder]:
+	"""Set (or with int_budget_tokens=None, disable) the token budget of README contexts"""
+
+	global readme_context_builder, bool_readme_context_is_configured
+
+	with lock_readme_context:
+		readme_context_builder = None if int_budget_tokens is None else ReadmeContextBuilder(int_budget_tokens, int_max_tokens_per_chunk)
+		bool_readme_context_is_configured = True
+
+	return readme_context_builder
+
+
+def get_readme_context_builder() -> Optional[ReadmeContextBuilder]:
+
+	with lock_readme_context:
+
+		if not bool_readme_context_is_configured:
+			string_budget_tokens = os.getenv("VLM_CANVAS_BUGS_README_TOKEN_BUDGET", None)
+			configure_readme_context(None if string_budget_tokens is None else int(string_budget_tokens))
+
+		return readme_context_builder
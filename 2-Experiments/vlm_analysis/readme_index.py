@@ -0,0 +1,163 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, Union
+from git import Repo, InvalidGitRepositoryError, NoSuchPathError
+from sqlitedict import SqliteDict
+
+
+PATH_TO_README_INDEX_DEFAULT = Path("../Data/2-Experiments/cache/readmes.sqlite")
+
+# Never descend into these directories when looking for README.md files
+# (installed dependencies, build outputs & VCS internals, not the app's own documentation)
+DIRECTORY_NAMES_TO_PRUNE = {
+	"node_modules",
+	"bower_components",
+	".git",
+	"dist",
+	".cache",
+	".venv",
+	"__pycache__",
+}
+
+
+class ReadmeIndex:
+	"""
+	Concatenated README.md files of each app repository, cached per app and keyed on the repository's HEAD commit.
+
+	The description of an app is only rebuilt when its HEAD commit changes
+	(or once per process, if the app folder is not a git repository).
+	"""
+
+	def __init__(self, path_to_index: Optional[Union[str, Path]] = PATH_TO_README_INDEX_DEFAULT):
+		self.dict_descriptions_in_memory: dict[str, str] = dict()
+		self.lock = threading.Lock()
+		self.dict_descriptions_on_disk: Optional[SqliteDict] = None
+
+		if path_to_index is not None:
+			Path(path_to_index).parent.mkdir(parents=True, exist_ok=True)
+			self.dict_descriptions_on_disk = SqliteDict(str(path_to_index), tablename="readmes", autocommit=True)
+
+	def load_description(self, string_name_of_app: str, path_to_app_repo: Path) -> str:
+
+		string_commit = get_head_commit(path_to_app_repo)
+		# without a commit there is nothing to tell if the READMEs changed between runs, so only cache for this process
+		string_key = f"{string_name_of_app}|{string_commit if string_commit is not None else 'working-tree'}"
+
+		with self.lock:
+			string_description = self.dict_descriptions_in_memory.get(string_key)
+
+		if string_description is not None:
+			return string_description
+
+		if string_commit is not None and self.dict_descriptions_on_disk is not None:
+			string_description = self.dict_descriptions_on_disk.get(string_key)
+
+			if string_description is not None:
+				print(f"Using cached README for app {string_name_of_app} at commit {string_commit}")
+
+		if string_description is None:
+			string_description = walk_readmes(string_name_of_app, path_to_app_repo)
+
+			# an empty description is an error (see load_original_application_README), don't keep it
+			if len(string_description) <= 0:
+				return string_description
+
+			if string_commit is not None and self.dict_descriptions_on_disk is not None:
+				self.dict_descriptions_on_disk[string_key] = string_description
+
+		with self.lock:
+			self.dict_descriptions_in_memory[string_key] = string_description
+
+		return string_description
+
+	def warm_up(self, dict_paths_to_app_repos: dict[str, Path], int_number_of_workers: int = 8):
+		"""Load (and cache) the descriptions of many apps at once, e.g. all 20 apps before a batch run"""
+
+		with ThreadPoolExecutor(max_workers=int_number_of_workers) as executor:
+			list_futures = [
+				executor.submit(self.load_description, string_name_of_app, path_to_app_repo)
+				for string_name_of_app, path_to_app_repo in dict_paths_to_app_repos.items()
+			]
+
+			for future in list_futures:
+				future.result()
+
+	def close(self):
+		if self.dict_descriptions_on_disk is not None:
+			self.dict_descriptions_on_disk.close()
+
+
+def get_head_commit(path_to_app_repo: Path) -> Optional[str]:
+
+	try:
+		return Repo(path_to_app_repo).head.commit.hexsha
+
+	except (InvalidGitRepositoryError, NoSuchPathError, ValueError):
+		return None
+
+
+def list_paths_to_readmes(path_to_app_repo: Path) -> list[Path]:
+	"""
+	Find every README.md in the repository, pruning DIRECTORY_NAMES_TO_PRUNE during the walk.
+	Same order as Path.rglob("README.md"): directories depth-first, in directory listing order.
+	"""
+	list_paths = []
+
+	for string_path_to_dir, list_names_of_dirs, list_names_of_files in os.walk(path_to_app_repo):
+
+		# modifying the list in place stops os.walk from descending into the pruned directories
+		list_names_of_dirs[:] = [name for name in list_names_of_dirs if name not in DIRECTORY_NAMES_TO_PRUNE]
+
+		if "README.md" in list_names_of_files:
+			list_paths.append(Path(string_path_to_dir) / "README.md")
+
+	return list_paths
+
+
+def walk_readmes(string_name_of_app: str, path_to_app_repo: Path) -> str:
+
+	string_prompt_app_description = ""
+
+	for path_to_readme in list_paths_to_readmes(path_to_app_repo.resolve()):
+
+		print(f"Reading README for app {string_name_of_app} from path: \"{path_to_readme}\"")
+
+		with open(path_to_readme, "r", encoding="utf-8", errors="replace") as f:
+			string_readme = f.read()
+			string_prompt_app_description += f"\n{string_readme}"
+
+	return string_prompt_app_description.strip()
+
+
+# Index used by load_original_application_README
+readme_index: Optional[ReadmeIndex] = None
+lock_readme_index = threading.Lock()
+
+
+def get_readme_index() -> ReadmeIndex:
+
+	global readme_index
+
+	with lock_readme_index:
+
+		if readme_index is None:
+			readme_index = ReadmeIndex(os.getenv("VLM_CANVAS_BUGS_README_INDEX_PATH", str(PATH_TO_README_INDEX_DEFAULT)))
+
+		return readme_index
+
+
+def configure_readme_index(path_to_index: Optional[Union[str, Path]]) -> ReadmeIndex:
+	"""Replace the index (with path_to_index=None, only cache descriptions in memory)"""
+
+	global readme_index
+
+	with lock_readme_index:
+
+		if readme_index is not None:
+			readme_index.close()
+
+		readme_index = ReadmeIndex(path_to_index)
+
+		return readme_index
@@ -0,0 +1,638 @@
+import argparse
+import base64
+import hashlib
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from typing import Optional, Union
+from .rate_limiting import estimate_number_of_tokens
+
+
+PATH_TO_RESULTS_DIR_DEFAULT = Path("../Data/2-Experiments/results")
+PATH_TO_SCREENSHOTS_DEFAULT = Path("../Data/1d-Collecting_Screenshots/screenshots")
+
+LIST_LATENCY_DISTRIBUTIONS = ["fixed", "uniform", "exponential", "lognormal"]
+
+# https://platform.openai.com/docs/guides/prompt-caching
+INT_MIN_TOKENS_OF_CACHED_PREFIX = 1024
+INT_TOKENS_PER_CACHED_BLOCK = 128
+
+# used to synthesize a response when a request does not match any recorded one
+LIST_SYNTHESIZED_BUGS = [
+	"a sprite is drawn at the wrong position, overlapping another object",
+	"an object is missing from the scene",
+	"a sprite is rendered with the wrong texture",
+	"a sprite is stretched to the wrong size",
+	"the layering of two objects is wrong, one is drawn on top of the other",
+]
+
+
+class ReplaySettings:
+	"""How the replay server behaves: latency of responses, injected errors and rate limits"""
+
+	def __init__(
+		self,
+		string_latency_distribution: str = "lognormal",
+		float_latency_seconds: float = 1.0,
+		float_latency_sigma: float = 0.5,
+		float_seconds_per_output_token: float = 0.0,
+		float_rate_of_429: float = 0.0,
+		float_rate_of_5xx: float = 0.0,
+		float_seconds_retry_after: float = 1.0,
+		int_requests_per_minute: Optional[int] = None,
+		int_tokens_per_minute: Optional[int] = None,
+		list_prompt_strategies_preferred: Optional[list[str]] = None,
+		int_seed: int = 0
+	):
+		if string_latency_distribution not in LIST_LATENCY_DISTRIBUTIONS:
+			raise ValueError(f"Unknown latency distribution {string_latency_distribution!r}, expected one of {LIST_LATENCY_DISTRIBUTIONS}")
+
+		self.string_latency_distribution = string_latency_distribution
+		# the mean for "uniform" (0 to 2x) & "exponential", the median for "lognormal"
+		self.float_latency_seconds = float_latency_seconds
+		self.float_latency_sigma = float_latency_sigma
+		self.float_seconds_per_output_token = float_seconds_per_output_token
+		self.float_rate_of_429 = float_rate_of_429
+		self.float_rate_of_5xx = float_rate_of_5xx
+		self.float_seconds_retry_after = float_seconds_retry_after
+		self.int_requests_per_minute = int_requests_per_minute
+		self.int_tokens_per_minute = int_tokens_per_minute
+		self.list_prompt_strategies_preferred = list_prompt_strategies_preferred or []
+		self.int_seed = int_seed
+
+
+class RecordedResponses:
+	"""
+	Index of the results tree, to answer a request the way the model API answered it before:
+	- a response request is matched to its sample by the screenshot under test (the last known screenshot in its images)
+	- an answer extraction request is matched by its response (the user message), and answered with the recorded .json
+	"""
+
+	def __init__(self, path_to_results_dir: Path = PATH_TO_RESULTS_DIR_DEFAULT, path_to_screenshots: Path = PATH_TO_SCREENSHOTS_DEFAULT):
+
+		# digest of the base64 data of a screenshot -> (app, snapshot)
+		self.dict_samples_by_digest_of_screenshot: dict[str, tuple[str, str]] = dict()
+		# (app, snapshot) -> [(model dir, strategy, path to .txt)]
+		self.dict_responses_by_sample: dict[tuple[str, str], list[tuple[str, str, Path]]] = dict()
+		# digest of a recorded response -> path to its .json
+		self.dict_paths_to_answers_by_digest_of_response: dict[str, Path] = dict()
+
+		for path_to_screenshot in sorted(path_to_screenshots.glob("*/*.png")):
+			with open(path_to_screenshot, "rb") as f:
+				string_digest = make_digest(base64.b64encode(f.read()).decode("utf-8"))
+			self.dict_samples_by_digest_of_screenshot[string_digest] = (path_to_screenshot.parent.name, path_to_screenshot.stem)
+
+		# <model>/<strategy>/<app>/<snapshot>.txt
+		for path_to_txt in sorted(path_to_results_dir.glob("*/*/*/*.txt")):
+
+			string_name_of_model_dir, string_prompt_strategy, string_name_of_app = path_to_txt.parts[-4:-1]
+			self.dict_responses_by_sample.setdefault((string_name_of_app, path_to_txt.stem), []).append((string_name_of_model_dir, string_prompt_strategy, path_to_txt))
+
+			path_to_json = path_to_txt.with_suffix(".json")
+
+			if path_to_json.exists():
+				with open(path_to_txt, "r", encoding="utf-8", errors="replace") as f:
+					self.dict_paths_to_answers_by_digest_of_response[make_digest(f.read())] = path_to_json
+
+		print(
+			f"Replay index: {len(self.dict_samples_by_digest_of_screenshot)} screenshots, "
+			f"{sum(len(list_responses) for list_responses in self.dict_responses_by_sample.values())} recorded responses"
+		)
+
+	def find_sample(self, list_of_message_dicts: list[dict]) -> Optional[tuple[str, str]]:
+
+		tuple_sample = None
+
+		for string_url in iterate_image_urls(list_of_message_dicts):
+			# prepared (resized or transcoded) images cannot be matched
+			tuple_sample = self.dict_samples_by_digest_of_screenshot.get(make_digest(string_url.split(",", 1)[-1]), tuple_sample)
+
+		return tuple_sample
+
+	def find_response(self, string_model: str, tuple_sample: tuple[str, str], list_prompt_strategies_preferred: list[str]) -> Optional[str]:
+
+		list_responses = self.dict_responses_by_sample.get(tuple_sample, [])
+		# e.g. "gpt-4o-2024-08-06" is recorded as "openai-gpt-4o-2024-08-06"
+		list_responses = [response for response in list_responses if response[0].endswith(string_model.replace("/", "_"))] or list_responses
+
+		if len(list_responses) == 0:
+			return None
+
+		def get_rank(response: tuple[str, str, Path]) -> int:
+			string_prompt_strategy = response[1]
+			return list_prompt_strategies_preferred.index(string_prompt_strategy) if string_prompt_strategy in list_prompt_strategies_preferred else len(list_prompt_strategies_preferred)
+
+		_, _, path_to_txt = min(list_responses, key=get_rank)
+
+		with open(path_to_txt, "r", encoding="utf-8", errors="replace") as f:
+			return f.read()
+
+	def find_answer(self, string_response_content: str) -> Optional[dict]:
+
+		path_to_json = self.dict_paths_to_answers_by_digest_of_response.get(make_digest(string_response_content))
+
+		if path_to_json is None:
+			return None
+
+		with open(path_to_json, "r", encoding="utf-8") as f:
+			json_response_results = json.load(f)
+
+		# saved as a JSON string of the answer
+		if isinstance(json_response_results, str):
+			json_response_results = json.loads(json_response_results)
+
+		return {
+			"bool_did_detect_visual_bug": bool(json_response_results.get("bool_did_detect_visual_bug", False)),
+			"string_description_of_visual_bug": str(json_response_results.get("string_description_of_visual_bug", "")),
+		}
+
+
+def make_digest(string_text: str) -> str:
+	return hashlib.sha256(string_text.encode("utf-8")).hexdigest()
+
+
+def iterate_image_urls(list_of_message_dicts: list[dict]):
+
+	for message_dict in list_of_message_dicts:
+
+		content = message_dict.get("content")
+
+		if not isinstance(content, list):
+			continue
+
+		for part in content:
+			if isinstance(part, dict) and part.get("type") == "image_url":
+				yield part["image_url"]["url"]
+
+
+def remove_last_part(list_of_message_dicts: list[dict]) -> list[dict]:
+
+	if not list_of_message_dicts:
+		return list_of_message_dicts
+
+	content = list_of_message_dicts[-1].get("content")
+
+	if isinstance(content, list) and len(content) > 1:
+		return list_of_message_dicts[:-1] + [{**list_of_message_dicts[-1], "content": content[:-1]}]
+
+	return list_of_message_dicts[:-1]
+
+
+def get_last_user_text(list_of_message_dicts: list[dict]) -> str:
+
+	for message_dict in reversed(list_of_message_dicts):
+
+		if message_dict.get("role") != "user":
+			continue
+
+		content = message_dict.get("content")
+
+		if isinstance(content, str):
+			return content
+
+		return "".join(part.get("text", "") for part in content if isinstance(part, dict) and part.get("type") == "text")
+
+	return ""
+
+
+def synthesize_response(string_digest_of_request: str) -> str:
+	"""A deterministic response: the same request always gets the same one"""
+
+	rng = random.Random(string_digest_of_request)
+
+	if rng.random() < 0.5:
+		return "After carefully examining the screenshot, the scene looks as expected. I do not see any visual bug."
+
+	return f"After carefully examining the screenshot, there appears to be a visual bug: {rng.choice(LIST_SYNTHESIZED_BUGS)}."
+
+
+def synthesize_answer(string_response_content: str) -> dict:
+	"""What an answer extraction would make of a response it was not recorded for"""
+
+	string_response_lower = string_response_content.lower()
+	bool_did_detect_visual_bug = "visual bug" in string_response_lower and not any(
+		string_negation in string_response_lower for string_negation in ("no visual bug", "not see any visual bug", "no bug")
+	)
+
+	return {
+		"bool_did_detect_visual_bug": bool_did_detect_visual_bug,
+		"string_description_of_visual_bug": string_response_content.split(":", 1)[-1].strip() if bool_did_detect_visual_bug else "",
+	}
+
+
+class TokenBucket:
+
+	def __init__(self, int_per_minute: int):
+		self.int_per_minute = int_per_minute
+		self.float_available = float(int_per_minute)
+		self.float_time_of_last_refill = time.monotonic()
+
+	def refill(self):
+		float_now = time.monotonic()
+		self.float_available = min(float(self.int_per_minute), self.float_available + (float_now - self.float_time_of_last_refill) / 60.0 * self.int_per_minute)
+		self.float_time_of_last_refill = float_now
+
+	def get_seconds_until_full(self) -> float:
+		return (self.int_per_minute - self.float_available) * 60.0 / self.int_per_minute
+
+	def get_seconds_until_available(self, int_amount: int) -> float:
+		return max(0.0, (min(int_amount, self.int_per_minute) - self.float_available) * 60.0 / self.int_per_minute)
+
+
+def format_duration(float_seconds: float) -> str:
+	# the format of OpenAI's x-ratelimit-reset-* headers, e.g. "20ms" or "1.5s"
+	if float_seconds < 1.0:
+		return f"{round(float_seconds * 1000)}ms"
+
+	return f"{float_seconds:.3g}s"
+
+
+class ReplayServer(ThreadingHTTPServer):
+
+	daemon_threads = True
+
+	def __init__(self, tuple_address: tuple[str, int], recorded_responses: Optional[RecordedResponses], settings: ReplaySettings):
+
+		super().__init__(tuple_address, ReplayRequestHandler)
+
+		self.recorded_responses = recorded_responses
+		self.settings = settings
+		self.rng = random.Random(settings.int_seed)
+		self.lock = threading.Lock()
+		self.counter_ids = itertools.count()
+
+		# digests of the request prefixes seen so far, for the simulated prompt cache
+		self.set_digests_of_prefixes: set[str] = set()
+
+		self.bucket_requests = TokenBucket(settings.int_requests_per_minute) if settings.int_requests_per_minute else None
+		self.bucket_tokens = TokenBucket(settings.int_tokens_per_minute) if settings.int_tokens_per_minute else None
+
+		self.dict_stats = {
+			"int_number_of_requests": 0,
+			"int_number_of_responses_recorded": 0,
+			"int_number_of_responses_synthesized": 0,
+			"int_number_of_429_injected": 0,
+			"int_number_of_429_rate_limited": 0,
+			"int_number_of_5xx_injected": 0,
+			"int_number_in_flight": 0,
+			"int_max_number_in_flight": 0,
+			"int_number_of_prompt_cache_hits": 0,
+		}
+
+	def count(self, string_name: str, int_increment: int = 1):
+
+		with self.lock:
+			self.dict_stats[string_name] += int_increment
+
+			if string_name == "int_number_in_flight":
+				self.dict_stats["int_max_number_in_flight"] = max(self.dict_stats["int_max_number_in_flight"], self.dict_stats["int_number_in_flight"])
+
+	def count_cached_tokens(self, string_model: str, list_of_message_dicts: list[dict]) -> int:
+		"""
+		Prompt caching, roughly as OpenAI does it: the tokens of the request up to its last part (e.g. the screenshot under test)
+		are cached if an earlier request to the same model had that exact prefix, from 1024 tokens on and in steps of 128
+		"""
+		list_of_message_dicts_prefix = remove_last_part(list_of_message_dicts)
+		int_tokens_of_prefix = estimate_number_of_tokens(list_of_message_dicts_prefix, 0)
+
+		if int_tokens_of_prefix < INT_MIN_TOKENS_OF_CACHED_PREFIX:
+			return 0
+
+		string_digest = hashlib.sha256(json.dumps([string_model, list_of_message_dicts_prefix]).encode("utf-8")).hexdigest()
+
+		with self.lock:
+			bool_is_cached = string_digest in self.set_digests_of_prefixes
+			self.set_digests_of_prefixes.add(string_digest)
+
+		if not bool_is_cached:
+			return 0
+
+		self.count("int_number_of_prompt_cache_hits")
+
+		return int_tokens_of_prefix // INT_TOKENS_PER_CACHED_BLOCK * INT_TOKENS_PER_CACHED_BLOCK
+
+	def sample_latency(self) -> float:
+
+		settings = self.settings
+
+		with self.lock:
+
+			if settings.string_latency_distribution == "uniform":
+				return self.rng.uniform(0.0, 2.0 * settings.float_latency_seconds)
+
+			if settings.string_latency_distribution == "exponential":
+				return self.rng.expovariate(1.0 / settings.float_latency_seconds) if settings.float_latency_seconds > 0 else 0.0
+
+			if settings.string_latency_distribution == "lognormal" and settings.float_latency_seconds > 0:
+				return settings.float_latency_seconds * self.rng.lognormvariate(0.0, settings.float_latency_sigma)
+
+			return settings.float_latency_seconds
+
+	def draw_injected_error(self) -> Optional[int]:
+
+		with self.lock:
+			float_random = self.rng.random()
+
+			if float_random < self.settings.float_rate_of_429:
+				return 429
+
+			if float_random < self.settings.float_rate_of_429 + self.settings.float_rate_of_5xx:
+				return self.rng.choice([500, 502, 503])
+
+		return None
+
+	def take_from_buckets(self, int_number_of_tokens: int) -> tuple[Optional[float], dict[str, str]]:
+		"""Take a request from the rate limits: returns the seconds to retry after (None if within the limits) and the x-ratelimit-* headers"""
+
+		dict_headers: dict[str, str] = dict()
+		float_seconds_retry_after: Optional[float] = None
+
+		with self.lock:
+
+			for string_kind, bucket, int_amount in (("requests", self.bucket_requests, 1), ("tokens", self.bucket_tokens, int_number_of_tokens)):
+
+				if bucket is None:
+					continue
+
+				bucket.refill()
+				float_seconds_until_available = bucket.get_seconds_until_available(int_amount)
+
+				if float_seconds_until_available > 0:
+					float_seconds_retry_after = max(float_seconds_retry_after or 0.0, float_seconds_until_available)
+
+			# only take from the buckets if the request fits in both
+			for string_kind, bucket, int_amount in (("requests", self.bucket_requests, 1), ("tokens", self.bucket_tokens, int_number_of_tokens)):
+
+				if bucket is None:
+					continue
+
+				if float_seconds_retry_after is None:
+					bucket.float_available -= min(int_amount, bucket.int_per_minute)
+
+				dict_headers[f"x-ratelimit-limit-{string_kind}"] = str(bucket.int_per_minute)
+				dict_headers[f"x-ratelimit-remaining-{string_kind}"] = str(max(0, int(bucket.float_available)))
+				dict_headers[f"x-ratelimit-reset-{string_kind}"] = format_duration(bucket.get_seconds_until_full())
+
+		return float_seconds_retry_after, dict_headers
+
+	def make_response_content(self, dict_request: dict) -> str:
+
+		list_of_message_dicts = dict_request.get("messages", [])
+		dict_response_format = dict_request.get("response_format") or dict()
+		string_name_of_schema = (dict_response_format.get("json_schema") or dict()).get("name")
+		string_model = dict_request.get("model", "")
+
+		string_response_content = None
+		bool_is_answer_extraction = string_name_of_schema is not None and string_name_of_schema != "response_with_answer"
+
+		# backends without JSON schemas get the schema in a last system message (see backends.OpenAICompatibleAdapter)
+		if dict_response_format.get("type") == "json_object" and list_of_message_dicts:
+			bool_is_answer_extraction = "string_response_content" not in str(list_of_message_dicts[-1].get("content"))
+
+		if self.recorded_responses is not None and not bool_is_answer_extraction:
+			tuple_sample = self.recorded_responses.find_sample(list_of_message_dicts)
+
+			if tuple_sample is not None:
+				string_response_content = self.recorded_responses.find_response(string_model, tuple_sample, self.settings.list_prompt_strategies_preferred)
+
+		if bool_is_answer_extraction:
+			string_response_of_model = get_last_user_text(list_of_message_dicts)
+			dict_answer = self.recorded_responses.find_answer(string_response_of_model) if self.recorded_responses is not None else None
+			self.count("int_number_of_responses_synthesized" if dict_answer is None else "int_number_of_responses_recorded")
+			return json.dumps(dict_answer if dict_answer is not None else synthesize_answer(string_response_of_model))
+
+		self.count("int_number_of_responses_synthesized" if string_response_content is None else "int_number_of_responses_recorded")
+
+		if string_response_content is None:
+			string_response_content = synthesize_response(make_digest(json.dumps(list_of_message_dicts, sort_keys=True)))
+
+		if string_name_of_schema == "response_with_answer":
+			dict_answer = self.recorded_responses.find_answer(string_response_content) if self.recorded_responses is not None else None
+			return json.dumps({"string_response_content": string_response_content, **(dict_answer or synthesize_answer(string_response_content))})
+
+		return string_response_content
+
+
+class ReplayRequestHandler(BaseHTTPRequestHandler):
+
+	protocol_version = "HTTP/1.1"
+	server: ReplayServer
+
+	def log_message(self, format, *args):
+		pass
+
+	def send_json(self, int_status: int, obj: Union[dict, list], dict_headers: Optional[dict[str, str]] = None):
+
+		bytes_body = json.dumps(obj).encode("utf-8")
+
+		self.send_response(int_status)
+		self.send_header("content-type", "application/json")
+		self.send_header("content-length", str(len(bytes_body)))
+
+		for string_name, string_value in (dict_headers or dict()).items():
+			self.send_header(string_name, string_value)
+
+		self.end_headers()
+		self.wfile.write(bytes_body)
+
+	def send_error_json(self, int_status: int, string_message: str, string_type: str, dict_headers: Optional[dict[str, str]] = None):
+		self.send_json(int_status, {"error": {"message": string_message, "type": string_type, "param": None, "code": None}}, dict_headers)
+
+	def do_GET(self):
+
+		if self.path.rstrip("/").endswith("/stats"):
+			with self.server.lock:
+				return self.send_json(200, dict(self.server.dict_stats))
+
+		if self.path.rstrip("/").endswith("/models"):
+			return self.send_json(200, {"object": "list", "data": []})
+
+		self.send_error_json(404, f"Unknown path {self.path}", "invalid_request_error")
+
+	def do_POST(self):
+
+		bytes_body = self.rfile.read(int(self.headers.get("content-length", 0)))
+
+		if not self.path.rstrip("/").endswith("/chat/completions"):
+			return self.send_error_json(404, f"Unknown path {self.path} (only chat completions are replayed)", "invalid_request_error")
+
+		try:
+			dict_request = json.loads(bytes_body)
+
+		except ValueError:
+			return self.send_error_json(400, "The body of the request is not valid JSON", "invalid_request_error")
+
+		server = self.server
+		server.count("int_number_of_requests")
+		server.count("int_number_in_flight")
+
+		try:
+			self.handle_chat_completion(dict_request)
+
+		finally:
+			server.count("int_number_in_flight", -1)
+
+	def handle_chat_completion(self, dict_request: dict):
+
+		server = self.server
+		list_of_message_dicts = dict_request.get("messages", [])
+		int_prompt_tokens = estimate_number_of_tokens(list_of_message_dicts, 0)
+
+		float_seconds_retry_after, dict_headers = server.take_from_buckets(int_prompt_tokens)
+
+		if float_seconds_retry_after is not None:
+			server.count("int_number_of_429_rate_limited")
+			dict_headers["retry-after"] = f"{float_seconds_retry_after:.3f}"
+			return self.send_error_json(429, f"Rate limit reached, please try again in {float_seconds_retry_after:.3f}s.", "requests", dict_headers)
+
+		int_status_injected = server.draw_injected_error()
+
+		if int_status_injected == 429:
+			server.count("int_number_of_429_injected")
+			dict_headers["retry-after"] = f"{server.settings.float_seconds_retry_after:.3f}"
+			return self.send_error_json(429, "Rate limit reached (injected by the replay server).", "requests", dict_headers)
+
+		float_seconds_of_latency = server.sample_latency()
+
+		if int_status_injected is not None:
+			server.count("int_number_of_5xx_injected")
+			# server errors usually come after some of the latency
+			time.sleep(float_seconds_of_latency / 2)
+			return self.send_error_json(int_status_injected, "The server had an error while processing your request (injected by the replay server).", "server_error", dict_headers)
+
+		string_content = server.make_response_content(dict_request)
+		# about 4 characters per token, the same as rate_limiting.estimate_number_of_tokens
+		int_completion_tokens = max(1, len(string_content) // 4)
+		float_seconds_of_generation = int_completion_tokens * server.settings.float_seconds_per_output_token
+
+		dict_usage = {
+			"prompt_tokens": int_prompt_tokens,
+			"completion_tokens": int_completion_tokens,
+			"total_tokens": int_prompt_tokens + int_completion_tokens,
+			"prompt_tokens_details": {"cached_tokens": server.count_cached_tokens(dict_request.get("model", ""), list_of_message_dicts)},
+		}
+		string_id = f"chatcmpl-replay-{next(server.counter_ids)}"
+		string_model = dict_request.get("model", "")
+
+		# the latency is the time to the first token
+		time.sleep(float_seconds_of_latency)
+
+		if dict_request.get("stream"):
+			return self.send_stream(string_id, string_model, string_content, dict_usage, float_seconds_of_generation, dict_request, dict_headers)
+
+		time.sleep(float_seconds_of_generation)
+
+		self.send_json(200, {
+			"id": string_id,
+			"object": "chat.completion",
+			"created": int(time.time()),
+			"model": string_model,
+			"choices": [{"index": 0, "message": {"role": "assistant", "content": string_content, "refusal": None}, "logprobs": None, "finish_reason": "stop"}],
+			"usage": dict_usage,
+		}, dict_headers)
+
+	def send_stream(self, string_id: str, string_model: str, string_content: str, dict_usage: dict, float_seconds_of_generation: float, dict_request: dict, dict_headers: dict[str, str]):
+
+		self.send_response(200)
+		self.send_header("content-type", "text/event-stream")
+		self.send_header("transfer-encoding", "chunked")
+
+		for string_name, string_value in dict_headers.items():
+			self.send_header(string_name, string_value)
+
+		self.end_headers()
+
+		def write_event(dict_chunk: Optional[dict]):
+			string_data = "[DONE]" if dict_chunk is None else json.dumps(dict_chunk)
+			bytes_event = f"data: {string_data}\n\n".encode("utf-8")
+			self.wfile.write(f"{len(bytes_event):x}\r\n".encode("ascii") + bytes_event + b"\r\n")
+			self.wfile.flush()
+
+		def make_chunk(dict_delta: dict, string_finish_reason: Optional[str] = None) -> dict:
+			return {
+				"id": string_id,
+				"object": "chat.completion.chunk",
+				"created": int(time.time()),
+				"model": string_model,
+				"choices": [{"index": 0, "delta": dict_delta, "logprobs": None, "finish_reason": string_finish_reason}],
+			}
+
+		# pieces of about 4 tokens
+		list_pieces = [string_content[i:i + 16] for i in range(0, len(string_content), 16)] or [""]
+		float_seconds_per_piece = float_seconds_of_generation / len(list_pieces)
+
+		write_event(make_chunk({"role": "assistant", "content": ""}))
+
+		for string_piece in list_pieces:
+			time.sleep(float_seconds_per_piece)
+			write_event(make_chunk({"content": string_piece}))
+
+		write_event(make_chunk(dict(), "stop"))
+
+		if (dict_request.get("stream_options") or dict()).get("include_usage"):
+			write_event({"id": string_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": string_model, "choices": [], "usage": dict_usage})
+
+		write_event(None)
+		self.wfile.write(b"0\r\n\r\n")
+		self.wfile.flush()
+
+
+def main(list_of_arguments: Optional[list[str]] = None):
+
+	parser = argparse.ArgumentParser(
+		prog='python3 -m vlm_analysis.replay_server',
+		description='Serve an OpenAI-compatible chat completions API that replays recorded responses (or synthesizes them), to load-test the runner without calling the model API',
+	)
+	parser.add_argument("--host", type=str, default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=8765)
+	parser.add_argument("--results-dir", type=str, default=str(PATH_TO_RESULTS_DIR_DEFAULT), help="Results tree of the recorded responses")
+	parser.add_argument("--screenshots", type=str, default=str(PATH_TO_SCREENSHOTS_DEFAULT), help="Screenshots used to match a request to its sample")
+	parser.add_argument("--synthesize-only", action="store_true", help="Do not replay recorded responses, synthesize all of them")
+	parser.add_argument("--prompt-strategies", type=str, nargs="+", default=None, help="Replay the responses of these strategies first (by default, whichever is recorded for the sample)")
+	parser.add_argument("--latency-distribution", type=str, choices=LIST_LATENCY_DISTRIBUTIONS, default="lognormal")
+	parser.add_argument("--latency", type=float, default=1.0, help="Seconds to the first token (median for lognormal, mean otherwise)")
+	parser.add_argument("--latency-sigma", type=float, default=0.5, help="Sigma of the lognormal latency distribution")
+	parser.add_argument("--seconds-per-output-token", type=float, default=0.0, help="Generation time added per output token")
+	parser.add_argument("--error-rate-429", type=float, default=0.0, help="Fraction of requests answered with an injected 429")
+	parser.add_argument("--error-rate-5xx", type=float, default=0.0, help="Fraction of requests answered with an injected 500, 502 or 503")
+	parser.add_argument("--retry-after", type=float, default=1.0, help="Seconds of the retry-after header of injected 429s")
+	parser.add_argument("--requests-per-minute", type=int, default=None, help="Rate limit on requests (x-ratelimit-*-requests headers, 429 when exceeded)")
+	parser.add_argument("--tokens-per-minute", type=int, default=None, help="Rate limit on prompt tokens (x-ratelimit-*-tokens headers, 429 when exceeded)")
+	parser.add_argument("--seed", type=int, default=0)
+	args = parser.parse_args(list_of_arguments)
+
+	settings = ReplaySettings(
+		string_latency_distribution=args.latency_distribution,
+		float_latency_seconds=args.latency,
+		float_latency_sigma=args.latency_sigma,
+		float_seconds_per_output_token=args.seconds_per_output_token,
+		float_rate_of_429=args.error_rate_429,
+		float_rate_of_5xx=args.error_rate_5xx,
+		float_seconds_retry_after=args.retry_after,
+		int_requests_per_minute=args.requests_per_minute,
+		int_tokens_per_minute=args.tokens_per_minute,
+		list_prompt_strategies_preferred=args.prompt_strategies,
+		int_seed=args.seed,
+	)
+	recorded_responses = None if args.synthesize_only else RecordedResponses(Path(args.results_dir), Path(args.screenshots))
+
+	server = ReplayServer((args.host, args.port), recorded_responses, settings)
+	print(f"Replaying on http://{args.host}:{args.port}/v1 (run the batch runner with --base-url http://{args.host}:{args.port}/v1), statistics at /v1/stats")
+
+	try:
+		server.serve_forever()
+
+	except KeyboardInterrupt:
+		pass
+
+	finally:
+		server.server_close()
+		print(json.dumps(server.dict_stats, indent=2))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,268 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Optional, Union
+from sqlitedict import SqliteDict
+from . import ModelAPI
+from .clients import get_base_url
+
+
+PATH_TO_RESPONSE_CACHE_DEFAULT = Path("../Data/2-Experiments/cache/responses.sqlite")
+# when writes put the cache over a size limit, the oldest entries are evicted until it is this fraction of the limit,
+# so that the following writes do not scan the whole cache again
+FLOAT_FRACTION_OF_LIMITS_AFTER_EVICTION = 0.9
+# with a maximum age, expired entries are also evicted after this many writes
+INT_WRITES_BETWEEN_EVICTIONS = 1000
+
+
+class ResponseCache:
+	"""
+	Persistent cache of model API responses, stored in SQLite (via sqlitedict).
+
+	Entries are keyed on a stable hash of (model, normalized messages, response_format, and the base URL if not the OpenAI API),
+	where images are replaced by the digest of their data, see make_key_of_request.
+	"""
+
+	def __init__(
+		self,
+		path_to_cache: Union[str, Path] = PATH_TO_RESPONSE_CACHE_DEFAULT,
+		bool_read_only: bool = False,
+		int_max_entries: Optional[int] = None,
+		int_max_bytes: Optional[int] = None,
+		float_max_age_seconds: Optional[float] = None
+	):
+		self.path_to_cache = Path(path_to_cache)
+		self.bool_read_only = bool_read_only
+		self.int_max_entries = int_max_entries
+		self.int_max_bytes = int_max_bytes
+		self.float_max_age_seconds = float_max_age_seconds
+
+		self.int_number_of_hits = 0
+		self.int_number_of_misses = 0
+		self.lock_counters = threading.Lock()
+
+		# size of the cache as of the last eviction plus the writes since (overwritten entries are counted twice until the next eviction)
+		self.int_number_of_entries_stored = 0
+		self.int_number_of_bytes_stored = 0
+		self.int_number_of_writes_since_eviction = 0
+		self.lock_eviction = threading.Lock()
+
+		if bool_read_only:
+			self.dict_entries = SqliteDict(str(self.path_to_cache), tablename="responses", flag="r")
+
+		else:
+			self.path_to_cache.parent.mkdir(parents=True, exist_ok=True)
+			self.dict_entries = SqliteDict(str(self.path_to_cache), tablename="responses", autocommit=True)
+			self.evict()
+
+	def get(self, string_key: str) -> Optional[Any]:
+
+		dict_entry = self.dict_entries.get(string_key)
+
+		if dict_entry is not None and self.is_expired(dict_entry):
+			dict_entry = None
+
+		with self.lock_counters:
+			if dict_entry is None:
+				self.int_number_of_misses += 1
+			else:
+				self.int_number_of_hits += 1
+
+		return None if dict_entry is None else dict_entry["value"]
+
+	def set(self, string_key: str, value: Any):
+
+		if self.bool_read_only:
+			return
+
+		int_number_of_bytes = len(json.dumps(value))
+
+		self.dict_entries[string_key] = {
+			"value": value,
+			"float_time_created": time.time(),
+			"int_number_of_bytes": int_number_of_bytes,
+		}
+
+		with self.lock_eviction:
+			self.int_number_of_entries_stored += 1
+			self.int_number_of_bytes_stored += int_number_of_bytes
+			self.int_number_of_writes_since_eviction += 1
+
+			bool_is_over_limits = (
+				(self.int_max_entries is not None and self.int_number_of_entries_stored > self.int_max_entries)
+				or (self.int_max_bytes is not None and self.int_number_of_bytes_stored > self.int_max_bytes)
+			)
+			bool_is_time_to_expire = self.float_max_age_seconds is not None and self.int_number_of_writes_since_eviction >= INT_WRITES_BETWEEN_EVICTIONS
+
+			# a long batch run keeps the cache within its limits, not only the next run
+			if bool_is_over_limits or bool_is_time_to_expire:
+				self.evict_while_locked(FLOAT_FRACTION_OF_LIMITS_AFTER_EVICTION)
+
+	def is_expired(self, dict_entry: dict) -> bool:
+
+		if self.float_max_age_seconds is None:
+			return False
+
+		return (time.time() - dict_entry["float_time_created"]) > self.float_max_age_seconds
+
+	def evict(self, float_fraction_of_limits: float = 1.0) -> int:
+		"""Delete expired entries, then the oldest entries until the cache fits its size limits (or this fraction of them)"""
+
+		if self.bool_read_only:
+			return 0
+
+		with self.lock_eviction:
+			return self.evict_while_locked(float_fraction_of_limits)
+
+	def evict_while_locked(self, float_fraction_of_limits: float) -> int:
+
+		list_of_entries = []
+
+		for string_key, dict_entry in self.dict_entries.items():
+			list_of_entries.append((dict_entry["float_time_created"], dict_entry["int_number_of_bytes"], string_key, self.is_expired(dict_entry)))
+
+		list_of_entries.sort()
+		list_keys_to_delete = [string_key for _, _, string_key, bool_is_expired in list_of_entries if bool_is_expired]
+		list_of_entries = [entry for entry in list_of_entries if not entry[3]]
+
+		int_number_of_bytes = sum(entry[1] for entry in list_of_entries)
+		int_index_of_oldest = 0
+
+		while int_index_of_oldest < len(list_of_entries) and (
+			(self.int_max_entries is not None and len(list_of_entries) - int_index_of_oldest > self.int_max_entries * float_fraction_of_limits)
+			or (self.int_max_bytes is not None and int_number_of_bytes > self.int_max_bytes * float_fraction_of_limits)
+		):
+			_, int_number_of_bytes_of_entry, string_key, _ = list_of_entries[int_index_of_oldest]
+			list_keys_to_delete.append(string_key)
+			int_number_of_bytes -= int_number_of_bytes_of_entry
+			int_index_of_oldest += 1
+
+		for string_key in list_keys_to_delete:
+			del self.dict_entries[string_key]
+
+		self.int_number_of_entries_stored = len(list_of_entries) - int_index_of_oldest
+		self.int_number_of_bytes_stored = int_number_of_bytes
+		self.int_number_of_writes_since_eviction = 0
+
+		if len(list_keys_to_delete) > 0:
+			print(f"Evicted {len(list_keys_to_delete)} entries from response cache \"{self.path_to_cache}\"")
+
+		return len(list_keys_to_delete)
+
+	def get_stats(self) -> dict[str, int]:
+		with self.lock_counters:
+			return {
+				"int_number_of_hits": self.int_number_of_hits,
+				"int_number_of_misses": self.int_number_of_misses,
+				"int_number_of_entries": len(self.dict_entries),
+			}
+
+	def close(self):
+		self.dict_entries.close()
+
+
+def make_key_of_request(model_api: ModelAPI, list_of_message_dicts: list[dict], dict_response_format: Optional[dict] = None) -> str:
+
+	dict_request = {
+		"model": model_api.value,
+		"messages": normalize_messages(list_of_message_dicts),
+		"response_format": dict_response_format,
+	}
+
+	# the same request to another server (e.g. the replay server with --base-url) is another entry;
+	# requests to the OpenAI API keep the keys they had before the server was part of them
+	string_base_url = get_base_url(model_api) or os.getenv("OPENAI_BASE_URL")
+
+	if string_base_url:
+		dict_request["base_url"] = string_base_url.rstrip("/")
+	string_request = json.dumps(dict_request, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+	return hashlib.sha256(string_request.encode("utf-8")).hexdigest()
+
+
+def normalize_messages(list_of_message_dicts: list[dict]) -> list[dict]:
+	"""Copy of the messages where each base64 image is replaced with the digest of its data"""
+
+	list_normalized = []
+
+	for message_dict in list_of_message_dicts:
+
+		content = message_dict.get("content")
+
+		if isinstance(content, list):
+			content = [normalize_content_part(part) for part in content]
+
+		elif isinstance(content, dict):
+			content = normalize_content_part(content)
+
+		list_normalized.append({**message_dict, "content": content})
+
+	return list_normalized
+
+
+def normalize_content_part(part: dict) -> dict:
+
+	if part.get("type") != "image_url":
+		return part
+
+	dict_image_url = dict(part["image_url"])
+	string_url = dict_image_url["url"]
+
+	if string_url.startswith("data:") and "," in string_url:
+		string_header, string_data = string_url.split(",", 1)
+		dict_image_url["url"] = f"{string_header},sha256:{hashlib.sha256(string_data.encode('ascii')).hexdigest()}"
+
+	return {**part, "image_url": dict_image_url}
+
+
+# Cache used by get_response; disabled unless configured (or VLM_CANVAS_BUGS_RESPONSE_CACHE_PATH is set)
+response_cache: Optional[ResponseCache] = None
+bool_response_cache_is_configured = False
+lock_response_cache = threading.RLock()
+
+
+def configure_response_cache(
+	path_to_cache: Optional[Union[str, Path]],
+	bool_read_only: bool = False,
+	int_max_entries: Optional[int] = None,
+	int_max_bytes: Optional[int] = None,
+	float_max_age_seconds: Optional[float] = None
+) -> Optional[ResponseCache]:
+	"""Set (or with path_to_cache=None, disable) the response cache used by get_response"""
+
+	global response_cache, bool_response_cache_is_configured
+
+	with lock_response_cache:
+
+		if response_cache is not None:
+			response_cache.close()
+
+		response_cache = None
+
+		if path_to_cache is not None:
+			response_cache = ResponseCache(
+				path_to_cache,
+				bool_read_only=bool_read_only,
+				int_max_entries=int_max_entries,
+				int_max_bytes=int_max_bytes,
+				float_max_age_seconds=float_max_age_seconds
+			)
+
+		bool_response_cache_is_configured = True
+
+	return response_cache
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+
+	with lock_response_cache:
+
+		if not bool_response_cache_is_configured:
+			string_path_to_cache = os.getenv("VLM_CANVAS_BUGS_RESPONSE_CACHE_PATH", None)
+			bool_read_only = os.getenv("VLM_CANVAS_BUGS_RESPONSE_CACHE_READ_ONLY", "0") == "1"
+			configure_response_cache(string_path_to_cache, bool_read_only=bool_read_only)
+
+		return response_cache
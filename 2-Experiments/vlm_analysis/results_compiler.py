@@ -0,0 +1,305 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import NamedTuple, Optional
+import pandas as pd
+from .results_store import ResultsStore, make_dict_model_api_values_by_dir_name, parse_response_results
+
+
+PATH_TO_RESULTS_DIR_DEFAULT = Path("../Data/2-Experiments/results")
+# a folder of part files, read as one dataset (see read_compiled_results)
+PATH_TO_COMPILED_DEFAULT = Path("../Data/2-Experiments/results/compiled.parquet")
+STRING_NAME_OF_STATE_FILE = "_state.json"
+
+LIST_COLUMNS_OF_KEY = ["TextModelAPI", "TextPromptStrategy", "TextAppName", "TextSampleName"]
+LIST_COLUMNS_CATEGORICAL = LIST_COLUMNS_OF_KEY
+
+
+class SampleFiles(NamedTuple):
+	"""The .txt & .json of one sample, with what tells if they changed since the last compile"""
+	string_model_api: str
+	string_prompt_strategy: str
+	string_name_of_app: str
+	string_name_of_snapshot: str
+	path_to_txt: str
+	path_to_json: str
+	list_signature: list
+
+
+def scan_strategy_dir(string_model_api: str, string_path_to_strategy: str, string_prompt_strategy: str) -> list[SampleFiles]:
+
+	list_samples = []
+
+	for entry_app in os.scandir(string_path_to_strategy):
+
+		if not entry_app.is_dir():
+			continue
+
+		dict_entries_of_files = {entry.name: entry for entry in os.scandir(entry_app.path) if entry.is_file()}
+
+		for string_name_of_file, entry_txt in dict_entries_of_files.items():
+
+			if not string_name_of_file.endswith(".txt"):
+				continue
+
+			string_name_of_snapshot = string_name_of_file[:-len(".txt")]
+			entry_json = dict_entries_of_files.get(f"{string_name_of_snapshot}.json")
+			stat_txt = entry_txt.stat()
+			list_signature = [stat_txt.st_mtime_ns, stat_txt.st_size]
+
+			if entry_json is not None:
+				stat_json = entry_json.stat()
+				list_signature += [stat_json.st_mtime_ns, stat_json.st_size]
+
+			list_samples.append(SampleFiles(
+				string_model_api,
+				string_prompt_strategy,
+				entry_app.name,
+				string_name_of_snapshot,
+				entry_txt.path,
+				str(Path(entry_app.path) / f"{string_name_of_snapshot}.json"),
+				list_signature
+			))
+
+	return list_samples
+
+
+def scan_results_dir(path_to_results_dir: Path, int_number_of_workers: int = 8) -> list[SampleFiles]:
+	"""Find every sample of <model>/<strategy>/<app>/<snapshot>.txt, one model/strategy folder per worker"""
+
+	dict_model_api_values_by_dir_name = make_dict_model_api_values_by_dir_name()
+	list_strategy_dirs = []
+
+	for entry_model in os.scandir(path_to_results_dir):
+
+		# e.g. compiled.parquet
+		if not entry_model.is_dir() or entry_model.name.endswith(".parquet"):
+			continue
+
+		string_model_api = dict_model_api_values_by_dir_name.get(entry_model.name, entry_model.name)
+
+		for entry_strategy in os.scandir(entry_model.path):
+			if entry_strategy.is_dir():
+				list_strategy_dirs.append((string_model_api, entry_strategy.path, entry_strategy.name))
+
+	with ThreadPoolExecutor(max_workers=int_number_of_workers) as executor:
+		list_of_lists = executor.map(lambda args: scan_strategy_dir(*args), list_strategy_dirs)
+
+	return [sample_files for list_samples in list_of_lists for sample_files in list_samples]
+
+
+def scan_results_store(results_store: ResultsStore) -> dict[str, list]:
+	"""Signature of every sample of the results store: when it was last saved"""
+	return {"|".join(key): [float_time_saved] for key, float_time_saved in results_store.get_times_saved().items()}
+
+
+def make_record_from_store(results_store: ResultsStore, string_key: str, float_time_compiled: float) -> dict:
+
+	string_model_api, string_prompt_strategy, string_name_of_app, string_name_of_snapshot = string_key.split("|")
+	tuple_results = results_store.load(string_model_api, string_prompt_strategy, string_name_of_app, string_name_of_snapshot)
+
+	# deleted since it was scanned: the next compile marks it as deleted
+	if tuple_results is None:
+		return make_record_of_deletion(string_key, float_time_compiled)
+
+	string_response_content, string_response_results = tuple_results
+
+	return make_record_of_sample(string_model_api, string_prompt_strategy, string_name_of_app, string_name_of_snapshot, string_response_content, parse_response_results(string_response_results), float_time_compiled)
+
+
+def make_record(sample_files: SampleFiles, float_time_compiled: float) -> dict:
+
+	with open(sample_files.path_to_txt, "r", encoding="utf-8") as f:
+		string_response_content = f.read()
+
+	try:
+		# the .json holds the JSON string of the answer, encoded once more (see load_results)
+		with open(sample_files.path_to_json, "r") as f:
+			dict_response_results = json.loads(json.loads(f.read()))
+
+	except Exception as e:
+		print(f"Caught error while reading results JSON to file: \"{sample_files.path_to_json}\"", e)
+		dict_response_results = dict()
+
+	if not isinstance(dict_response_results, dict):
+		dict_response_results = dict()
+
+	return make_record_of_sample(
+		sample_files.string_model_api,
+		sample_files.string_prompt_strategy,
+		sample_files.string_name_of_app,
+		sample_files.string_name_of_snapshot,
+		string_response_content,
+		dict_response_results,
+		float_time_compiled
+	)
+
+
+def make_record_of_sample(
+	string_model_api: str,
+	string_prompt_strategy: str,
+	string_name_of_app: str,
+	string_name_of_snapshot: str,
+	string_response_content: str,
+	dict_response_results: dict,
+	float_time_compiled: float
+) -> dict:
+
+	return {
+		"TextModelAPI": string_model_api,
+		"TextPromptStrategy": string_prompt_strategy,
+		"TextAppName": string_name_of_app,
+		"TextSampleName": string_name_of_snapshot,
+		"BoolGroundTruth": string_name_of_snapshot != "clean",
+		"BoolDidDetectVisualBug": dict_response_results.get("bool_did_detect_visual_bug"),
+		"TextDescriptionOfVisualBug": dict_response_results.get("string_description_of_visual_bug"),
+		"TextResponse": string_response_content,
+		"BoolDeleted": False,
+		"FloatTimeCompiled": float_time_compiled,
+	}
+
+
+def make_record_of_deletion(string_key: str, float_time_compiled: float) -> dict:
+
+	string_model_api, string_prompt_strategy, string_name_of_app, string_name_of_snapshot = string_key.split("|")
+
+	return {
+		"TextModelAPI": string_model_api,
+		"TextPromptStrategy": string_prompt_strategy,
+		"TextAppName": string_name_of_app,
+		"TextSampleName": string_name_of_snapshot,
+		"BoolGroundTruth": string_name_of_snapshot != "clean",
+		"BoolDidDetectVisualBug": None,
+		"TextDescriptionOfVisualBug": None,
+		"TextResponse": None,
+		"BoolDeleted": True,
+		"FloatTimeCompiled": float_time_compiled,
+	}
+
+
+def make_dataframe(list_records: list[dict]) -> pd.DataFrame:
+
+	df_results = pd.DataFrame.from_records(list_records)
+	df_results["BoolDidDetectVisualBug"] = df_results["BoolDidDetectVisualBug"].astype("boolean")
+
+	for string_column in LIST_COLUMNS_CATEGORICAL:
+		df_results[string_column] = df_results[string_column].astype("category")
+
+	return df_results
+
+
+def compile_results_incrementally(
+	path_to_results_dir: Path = PATH_TO_RESULTS_DIR_DEFAULT,
+	path_to_compiled: Path = PATH_TO_COMPILED_DEFAULT,
+	int_number_of_workers: int = 8,
+	results_store: Optional[ResultsStore] = None
+) -> int:
+	"""
+	Append the samples that are new or changed since the last compile (by mtime & size of their files) to the Parquet dataset,
+	plus a deletion marker for each sample whose files are gone. Returns the number of rows appended.
+	With a results store, its rows are compiled instead of the results folder (changed: saved again since the last compile).
+	"""
+	path_to_compiled.mkdir(parents=True, exist_ok=True)
+	path_to_state = path_to_compiled / STRING_NAME_OF_STATE_FILE
+
+	dict_signatures_compiled: dict[str, list] = dict()
+
+	if path_to_state.is_file():
+		with open(path_to_state, "r") as f:
+			dict_signatures_compiled = json.load(f)
+
+	if results_store is not None:
+		print(f"Compiling results from the results store \"{results_store.path_to_store}\"")
+		dict_signatures_now = scan_results_store(results_store)
+
+	else:
+		dict_samples_files = {"|".join(sample_files[:4]): sample_files for sample_files in scan_results_dir(path_to_results_dir, int_number_of_workers)}
+		dict_signatures_now = {string_key: sample_files.list_signature for string_key, sample_files in dict_samples_files.items()}
+
+	list_keys_changed = [
+		string_key for string_key, list_signature in dict_signatures_now.items()
+		if dict_signatures_compiled.get(string_key) != list_signature
+	]
+	list_keys_deleted = [string_key for string_key in dict_signatures_compiled if string_key not in dict_signatures_now]
+
+	if len(list_keys_changed) == 0 and len(list_keys_deleted) == 0:
+		print(f"Compiled results are up to date ({len(dict_signatures_now)} samples)")
+		return 0
+
+	float_time_compiled = time.time()
+
+	if results_store is not None:
+		list_records = [make_record_from_store(results_store, string_key, float_time_compiled) for string_key in list_keys_changed]
+
+	else:
+		with ThreadPoolExecutor(max_workers=int_number_of_workers) as executor:
+			list_records = list(executor.map(lambda string_key: make_record(dict_samples_files[string_key], float_time_compiled), list_keys_changed))
+
+	list_records += [make_record_of_deletion(string_key, float_time_compiled) for string_key in list_keys_deleted]
+
+	path_to_part = path_to_compiled / f"part-{time.strftime('%Y%m%d-%H%M%S')}-{int(float_time_compiled * 1e6) % 1000000:06d}.parquet"
+	make_dataframe(list_records).to_parquet(path_to_part, engine="pyarrow", index=False)
+
+	# only after the part is written: if interrupted before, the same samples are appended again and deduplicated on read
+	dict_signatures_compiled = dict_signatures_now
+	path_to_state_tmp = path_to_state.with_suffix(".tmp")
+
+	with open(path_to_state_tmp, "w") as f:
+		json.dump(dict_signatures_compiled, f)
+
+	os.replace(path_to_state_tmp, path_to_state)
+
+	print(f"Appended {len(list_keys_changed)} new or changed samples and {len(list_keys_deleted)} deleted samples to \"{path_to_part}\"")
+
+	return len(list_records)
+
+
+def read_compiled_results(path_to_compiled: Path = PATH_TO_COMPILED_DEFAULT, bool_with_responses: bool = True) -> pd.DataFrame:
+	"""The latest row of every sample in the Parquet dataset (without deleted samples)"""
+
+	list_columns: Optional[list[str]] = None
+
+	if not bool_with_responses:
+		list_columns = LIST_COLUMNS_OF_KEY + ["BoolGroundTruth", "BoolDidDetectVisualBug", "TextDescriptionOfVisualBug", "BoolDeleted", "FloatTimeCompiled"]
+
+	list_paths_to_parts = sorted(path_to_compiled.glob("part-*.parquet"))
+
+	if len(list_paths_to_parts) == 0:
+		return pd.DataFrame(columns=LIST_COLUMNS_OF_KEY)
+
+	df_results = pd.concat(
+		[pd.read_parquet(path_to_part, engine="pyarrow", columns=list_columns) for path_to_part in list_paths_to_parts],
+		ignore_index=True
+	)
+
+	# part files can have different categories, so concatenating turns them back into strings
+	for string_column in LIST_COLUMNS_CATEGORICAL:
+		df_results[string_column] = df_results[string_column].astype("category")
+
+	df_results = df_results.sort_values("FloatTimeCompiled", kind="stable").drop_duplicates(LIST_COLUMNS_OF_KEY, keep="last")
+	df_results = df_results[~df_results["BoolDeleted"]].drop(columns=["BoolDeleted", "FloatTimeCompiled"])
+
+	return df_results.sort_values(LIST_COLUMNS_OF_KEY).reset_index(drop=True)
+
+
+def compact_compiled_results(path_to_compiled: Path = PATH_TO_COMPILED_DEFAULT):
+	"""Rewrite the dataset as a single part file, e.g. after many small incremental compiles"""
+
+	list_paths_to_parts = sorted(path_to_compiled.glob("part-*.parquet"))
+
+	if len(list_paths_to_parts) <= 1:
+		return
+
+	df_results = read_compiled_results(path_to_compiled)
+	df_results["BoolDeleted"] = False
+	df_results["FloatTimeCompiled"] = time.time()
+
+	path_to_part = path_to_compiled / f"part-{time.strftime('%Y%m%d-%H%M%S')}-compacted.parquet"
+	df_results.to_parquet(path_to_part, engine="pyarrow", index=False)
+
+	for path_to_part_old in list_paths_to_parts:
+		path_to_part_old.unlink()
+
+	print(f"Compacted {len(list_paths_to_parts)} part files into \"{path_to_part}\"")
@@ -0,0 +1,455 @@
+import argparse
+import atexit
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Union
+from . import PromptStrategy, ModelAPI
+
+
+PATH_TO_RESULTS_STORE_DEFAULT = Path("../Data/2-Experiments/results.sqlite")
+PATH_TO_RESULTS_DIR_DEFAULT = Path("../Data/2-Experiments/results")
+
+STRING_SQL_CREATE = """
+CREATE TABLE IF NOT EXISTS results (
+	string_model_api TEXT NOT NULL,
+	string_prompt_strategy TEXT NOT NULL,
+	string_name_of_app TEXT NOT NULL,
+	string_name_of_snapshot TEXT NOT NULL,
+	string_response_content TEXT NOT NULL,
+	-- the structured answer as returned by the model API (a JSON string, stored once, not twice like the .json files)
+	string_response_results TEXT NOT NULL,
+	bool_did_detect_visual_bug INTEGER,
+	string_description_of_visual_bug TEXT,
+	float_time_saved REAL NOT NULL,
+	PRIMARY KEY (string_model_api, string_prompt_strategy, string_name_of_app, string_name_of_snapshot)
+);
+CREATE INDEX IF NOT EXISTS index_results_by_strategy ON results (string_prompt_strategy, string_name_of_app, string_name_of_snapshot);
+CREATE INDEX IF NOT EXISTS index_results_by_app ON results (string_name_of_app, string_name_of_snapshot);
+"""
+
+# a transaction that fails (e.g. the database is locked by another process for too long) is tried again this many times
+INT_MAX_ATTEMPTS_OF_TRANSACTION = 3
+FLOAT_SECONDS_BETWEEN_ATTEMPTS_OF_TRANSACTION = 1.0
+
+STRING_SQL_UPSERT = """
+INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+class ResultsStoreWriteError(Exception):
+	"""Results that could not be written to the results store, although their save had returned"""
+
+	def __init__(self, dict_errors_of_keys: dict[tuple[str, str, str, str], str]):
+		super().__init__(f"{len(dict_errors_of_keys)} results could not be written to the results store: {next(iter(dict_errors_of_keys.values()))}")
+		self.dict_errors_of_keys = dict_errors_of_keys
+
+
+class ResultsStore:
+	"""
+	All results (response text & structured answer of every sample) in one SQLite database in WAL mode,
+	instead of a .txt and a .json file per sample.
+
+	Saves are queued and written by a background thread in batches (one transaction per batch),
+	so concurrent workers never wait on the disk, and readers are not blocked by the writer.
+	"""
+
+	def __init__(
+		self,
+		path_to_store: Union[str, Path] = PATH_TO_RESULTS_STORE_DEFAULT,
+		int_max_rows_per_transaction: int = 256,
+		float_max_seconds_between_transactions: float = 0.5
+	):
+		self.path_to_store = Path(path_to_store)
+		self.path_to_store.parent.mkdir(parents=True, exist_ok=True)
+		self.int_max_rows_per_transaction = int_max_rows_per_transaction
+		self.float_max_seconds_between_transactions = float_max_seconds_between_transactions
+
+		connection = self.connect()
+		connection.executescript(STRING_SQL_CREATE)
+		connection.close()
+
+		# rows queued but not written yet, so that a load right after a save sees it
+		self.dict_rows_pending: dict[tuple[str, str, str, str], tuple] = dict()
+		# rows whose transaction failed every attempt (still in dict_rows_pending), with the error; raised by flush
+		self.dict_errors_of_keys: dict[tuple[str, str, str, str], str] = dict()
+		self.lock_rows_pending = threading.Lock()
+		self.queue_of_rows: queue.Queue = queue.Queue()
+		self.local = threading.local()
+
+		self.thread_writer = threading.Thread(target=self.write, daemon=True)
+		self.thread_writer.start()
+
+	def connect(self) -> sqlite3.Connection:
+		connection = sqlite3.connect(self.path_to_store, timeout=30)
+		connection.execute("PRAGMA journal_mode=WAL")
+		connection.execute("PRAGMA synchronous=NORMAL")
+		return connection
+
+	def get_connection_for_reading(self) -> sqlite3.Connection:
+		# sqlite3 connections must not be shared between threads
+		if getattr(self.local, "connection", None) is None:
+			self.local.connection = self.connect()
+
+		return self.local.connection
+
+	def save(self, model_api_value: str, prompt_strategy_value: str, string_name_of_app: str, string_name_of_snapshot: str, string_response_content: str, string_response_results: str):
+
+		dict_response_results = parse_response_results(string_response_results)
+		bool_did_detect_visual_bug = dict_response_results.get("bool_did_detect_visual_bug")
+
+		key = (model_api_value, prompt_strategy_value, string_name_of_app, string_name_of_snapshot)
+		row = (
+			*key,
+			string_response_content,
+			string_response_results,
+			None if bool_did_detect_visual_bug is None else int(bool_did_detect_visual_bug),
+			dict_response_results.get("string_description_of_visual_bug"),
+			time.time()
+		)
+
+		with self.lock_rows_pending:
+			self.dict_rows_pending[key] = row
+
+		self.queue_of_rows.put(row)
+
+	def write(self):
+
+		connection = self.connect()
+
+		while True:
+			row = self.queue_of_rows.get()
+
+			# sentinel: the store is closing
+			if row is None:
+				self.queue_of_rows.task_done()
+				break
+
+			list_of_rows = [row]
+			float_time_deadline = time.monotonic() + self.float_max_seconds_between_transactions
+			bool_is_closing = False
+
+			# gather more rows into the same transaction
+			while len(list_of_rows) < self.int_max_rows_per_transaction:
+				try:
+					row = self.queue_of_rows.get(timeout=max(0.0, float_time_deadline - time.monotonic()))
+
+				except queue.Empty:
+					break
+
+				if row is None:
+					bool_is_closing = True
+					break
+
+				list_of_rows.append(row)
+
+			string_error = self.write_rows(connection, list_of_rows)
+
+			with self.lock_rows_pending:
+				for row_written in list_of_rows:
+					key = tuple(row_written[:4])
+
+					# unless saved again since
+					if self.dict_rows_pending.get(key) is not row_written:
+						continue
+
+					# kept pending, so that loads of this process still see it
+					if string_error:
+						self.dict_errors_of_keys[key] = string_error  # type: ignore
+						continue
+
+					del self.dict_rows_pending[key]  # type: ignore
+					self.dict_errors_of_keys.pop(key, None)  # type: ignore
+
+			for _ in range(len(list_of_rows) + (1 if bool_is_closing else 0)):
+				self.queue_of_rows.task_done()
+
+			if bool_is_closing:
+				break
+
+		connection.close()
+
+	def write_rows(self, connection: sqlite3.Connection, list_of_rows: list[tuple]) -> str:
+		"""Write the rows in one transaction, trying again if it fails; the error of the last attempt, or "" """
+
+		string_error = ""
+
+		for int_attempt in range(1, INT_MAX_ATTEMPTS_OF_TRANSACTION + 1):
+
+			try:
+				with connection:
+					connection.executemany(STRING_SQL_UPSERT, list_of_rows)
+
+				return ""
+
+			except sqlite3.Error as err:
+				string_error = repr(err)
+				print(f"ERROR: Failed to write {len(list_of_rows)} results to \"{self.path_to_store}\" (attempt {int_attempt} of {INT_MAX_ATTEMPTS_OF_TRANSACTION}): {err}")
+
+			if int_attempt < INT_MAX_ATTEMPTS_OF_TRANSACTION:
+				time.sleep(FLOAT_SECONDS_BETWEEN_ATTEMPTS_OF_TRANSACTION * int_attempt)
+
+		return string_error
+
+	def flush(self):
+		"""Wait until every queued result is written; raises ResultsStoreWriteError (once) for the results that could not be"""
+		self.queue_of_rows.join()
+
+		with self.lock_rows_pending:
+			dict_errors_of_keys = self.dict_errors_of_keys
+			self.dict_errors_of_keys = dict()
+
+		if len(dict_errors_of_keys) > 0:
+			raise ResultsStoreWriteError(dict_errors_of_keys)
+
+	def load(self, model_api_value: str, prompt_strategy_value: str, string_name_of_app: str, string_name_of_snapshot: str) -> Optional[tuple[str, str]]:
+		"""The response text & structured answer (JSON string) of a sample, or None if there is no result"""
+
+		key = (model_api_value, prompt_strategy_value, string_name_of_app, string_name_of_snapshot)
+
+		with self.lock_rows_pending:
+			row = self.dict_rows_pending.get(key)
+
+		if row is not None:
+			return row[4], row[5]
+
+		row = self.get_connection_for_reading().execute(
+			"SELECT string_response_content, string_response_results FROM results WHERE string_model_api = ? AND string_prompt_strategy = ? AND string_name_of_app = ? AND string_name_of_snapshot = ?",
+			key
+		).fetchone()
+
+		return None if row is None else (row[0], row[1])
+
+	def list_model_apis(self) -> list[str]:
+		"""Models with at least one result"""
+
+		self.flush()
+
+		return [row[0] for row in self.get_connection_for_reading().execute("SELECT DISTINCT string_model_api FROM results ORDER BY 1")]
+
+	def list_samples(self, model_api_value: str, prompt_strategy_value: str) -> list[tuple[str, str]]:
+		"""(app, snapshot) of every result of a model with a prompt strategy"""
+
+		self.flush()
+
+		return self.get_connection_for_reading().execute(
+			"SELECT string_name_of_app, string_name_of_snapshot FROM results WHERE string_model_api = ? AND string_prompt_strategy = ? ORDER BY string_name_of_app, string_name_of_snapshot",
+			(model_api_value, prompt_strategy_value)
+		).fetchall()
+
+	def get_times_saved(self) -> dict[tuple[str, str, str, str], float]:
+		"""When each result was last saved, by (model, prompt strategy, app, snapshot)"""
+
+		self.flush()
+
+		return {
+			tuple(row[:4]): row[4] for row in self.get_connection_for_reading().execute(
+				"SELECT string_model_api, string_prompt_strategy, string_name_of_app, string_name_of_snapshot, float_time_saved FROM results"
+			)
+		}
+
+	def iterate_rows(self):
+
+		self.flush()
+
+		yield from self.get_connection_for_reading().execute(
+			"SELECT string_model_api, string_prompt_strategy, string_name_of_app, string_name_of_snapshot, string_response_content, string_response_results FROM results ORDER BY 1, 2, 3, 4"
+		)
+
+	def close(self):
+
+		if self.thread_writer.is_alive():
+			self.queue_of_rows.put(None)
+			self.thread_writer.join()
+
+		if len(self.dict_errors_of_keys) > 0:
+			print(f"ERROR: {len(self.dict_errors_of_keys)} results could not be written to \"{self.path_to_store}\"")
+
+		if getattr(self.local, "connection", None) is not None:
+			self.local.connection.close()
+			self.local.connection = None
+
+
+def parse_response_results(string_response_results: str) -> dict:
+
+	try:
+		dict_response_results = json.loads(string_response_results)
+
+	except (TypeError, ValueError):
+		return dict()
+
+	return dict_response_results if isinstance(dict_response_results, dict) else dict()
+
+
+def make_name_of_model_dir(model_api_value: str) -> str:
+	# the results folders of models have ":" replaced with "-" (and the "/" of e.g. "vllm:Qwen/Qwen2-VL-7B-Instruct" with "_")
+	return model_api_value.replace(":", "-").replace("/", "_")
+
+
+def make_dict_model_api_values_by_dir_name() -> dict[str, str]:
+	return {make_name_of_model_dir(model_api.value): model_api.value for model_api in ModelAPI}
+
+
+def migrate_results_dir(path_to_results_dir: Path, results_store: ResultsStore) -> int:
+	"""Copy every <model>/<strategy>/<app>/<snapshot>.txt & .json of a results folder into the store"""
+
+	dict_model_api_values_by_dir_name = make_dict_model_api_values_by_dir_name()
+	set_prompt_strategy_values = {prompt_strategy.value for prompt_strategy in PromptStrategy}
+	int_number_migrated = 0
+
+	for entry_model in os.scandir(path_to_results_dir):
+
+		if not entry_model.is_dir():
+			continue
+
+		model_api_value = dict_model_api_values_by_dir_name.get(entry_model.name)
+
+		if model_api_value is None:
+			# e.g. a model that is commented out in ModelAPI; keep its folder name
+			print(f"WARNING: Unknown model folder \"{entry_model.path}\", migrating it as model \"{entry_model.name}\"")
+			model_api_value = entry_model.name
+
+		for entry_strategy in os.scandir(entry_model.path):
+
+			if not entry_strategy.is_dir():
+				continue
+
+			if entry_strategy.name not in set_prompt_strategy_values:
+				print(f"WARNING: Unknown prompt strategy folder \"{entry_strategy.path}\"")
+
+			for entry_app in os.scandir(entry_strategy.path):
+
+				if not entry_app.is_dir():
+					continue
+
+				for entry_sample in os.scandir(entry_app.path):
+
+					if not (entry_sample.is_file() and entry_sample.name.endswith(".txt")):
+						continue
+
+					string_name_of_snapshot = entry_sample.name[:-len(".txt")]
+
+					with open(entry_sample.path, "r") as f:
+						string_response_content = f.read()
+
+					try:
+						# the .json files hold the JSON string of the answer, encoded once more
+						with open(Path(entry_app.path) / f"{string_name_of_snapshot}.json", "r") as f:
+							string_response_results = json.loads(f.read())
+
+					except (OSError, ValueError) as err:
+						print(f"WARNING: Missing or invalid results JSON for \"{entry_sample.path}\": {err}")
+						string_response_results = ""
+
+					results_store.save(model_api_value, entry_strategy.name, entry_app.name, string_name_of_snapshot, string_response_content, string_response_results)
+					int_number_migrated += 1
+
+	results_store.flush()
+
+	return int_number_migrated
+
+
+def export_results_dir(results_store: ResultsStore, path_to_results_dir: Path) -> int:
+	"""Write every result of the store to the per-sample .txt & .json layout of save_results"""
+
+	set_paths_created = set()
+	int_number_exported = 0
+
+	for model_api_value, prompt_strategy_value, string_name_of_app, string_name_of_snapshot, string_response_content, string_response_results in results_store.iterate_rows():
+
+		path_to_app = path_to_results_dir / make_name_of_model_dir(model_api_value) / prompt_strategy_value / string_name_of_app
+
+		if path_to_app not in set_paths_created:
+			path_to_app.mkdir(parents=True, exist_ok=True)
+			set_paths_created.add(path_to_app)
+
+		with open(path_to_app / f"{string_name_of_snapshot}.txt", "w") as f:
+			f.write(string_response_content)
+
+		with open(path_to_app / f"{string_name_of_snapshot}.json", "w") as f:
+			f.write(json.dumps(string_response_results))
+
+		int_number_exported += 1
+
+	return int_number_exported
+
+
+# Store used by save_results & load_results; disabled unless configured (or VLM_CANVAS_BUGS_RESULTS_STORE_PATH is set)
+results_store: Optional[ResultsStore] = None
+bool_results_store_is_configured = False
+lock_results_store = threading.RLock()
+
+
+def configure_results_store(path_to_store: Optional[Union[str, Path]]) -> Optional[ResultsStore]:
+	"""Set (or with path_to_store=None, disable) the results store"""
+
+	global results_store, bool_results_store_is_configured
+
+	with lock_results_store:
+
+		if results_store is not None:
+			results_store.close()
+
+		results_store = None
+
+		if path_to_store is not None:
+			results_store = ResultsStore(path_to_store)
+
+		bool_results_store_is_configured = True
+
+	return results_store
+
+
+def get_results_store() -> Optional[ResultsStore]:
+
+	with lock_results_store:
+
+		if not bool_results_store_is_configured:
+			configure_results_store(os.getenv("VLM_CANVAS_BUGS_RESULTS_STORE_PATH", None))
+
+		return results_store
+
+
+def close_results_store():
+	"""Write the results still queued; the writer thread is a daemon and would drop them at exit"""
+
+	with lock_results_store:
+
+		if results_store is not None:
+			results_store.close()
+
+
+atexit.register(close_results_store)
+
+
+def main():
+
+	parser = argparse.ArgumentParser(
+		prog='python3 -m vlm_analysis.results_store',
+		description='Move results between the per-sample .txt/.json files and the SQLite results store',
+	)
+	parser.add_argument("command", type=str, choices=["migrate", "export"], help="migrate: files -> store, export: store -> files")
+	parser.add_argument("--results-dir", type=str, default=str(PATH_TO_RESULTS_DIR_DEFAULT), help="e.g. ../Data/2-Experiments/RESULTS_RUN_0")
+	parser.add_argument("--results-store", type=str, default=str(PATH_TO_RESULTS_STORE_DEFAULT))
+	args = parser.parse_args()
+
+	results_store = ResultsStore(args.results_store)
+
+	if args.command == "migrate":
+		int_number = migrate_results_dir(Path(args.results_dir), results_store)
+		print(f"Migrated {int_number} results from \"{args.results_dir}\" to \"{args.results_store}\"")
+
+	else:
+		int_number = export_results_dir(results_store, Path(args.results_dir))
+		print(f"Exported {int_number} results from \"{args.results_store}\" to \"{args.results_dir}\"")
+
+	results_store.close()
+
+
+if __name__ == "__main__":
+
+	main()
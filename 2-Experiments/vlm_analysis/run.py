@@ -1,11 +1,22 @@
 # from pdb import set_trace  # https://web.stanford.edu/class/physics91si/2013/handouts/Pdb_Commands.pdf
+from typing import Optional
+from openai import AsyncOpenAI
 from . import PromptStrategy, ModelAPI
+from .rate_limiting import AdaptiveRateLimiter
+from .tracing import span, trace_job, measure_messages, STAGE_MESSAGE_BUILD
+from .streaming import get_bool_streaming_is_enabled
 from .utilities import (
 	load_prompts,
 	load_encoded_image,
 	make_list_of_message_dicts_with_images,
 	get_response,
 	get_structured_answer,
+	get_response_async,
+	get_structured_answer_async,
+	get_response_with_structured_answer,
+	get_response_with_structured_answer_async,
+	get_bool_single_call_is_enabled,
+	make_path_to_streamed_output_of_sample,
 	save_results,
 	verify_response_to_clean_sample_is_correct,
 	load_hardcoded_response,
@@ -13,9 +24,30 @@ from .utilities import (
 	verify_app_has_assets_available,
 	load_assets,
 	make_list_of_message_dicts_with_images_and_assets,
+	replace_screenshot_with_regions_of_interest,
 )
 
 
+APPS_INCLUDED_IN_ABLATION_STUDY = [
+	"chase-manning-react-photo-studio",
+	"ha-shine-wasm-tetris",
+	"higlass-higlass",
+	"p5aholic-playground",
+	"starwards-starwards",
+	"VoiceSpaceUnder5-VoiceSpace"
+]
+
+# Prompting strategies whose prompt includes the README(s) of the app's repository
+PROMPT_STRATEGIES_WITH_README = [
+	PromptStrategy.DESCRIBE_TASK_AND_PROVIDE_README,
+	PromptStrategy.BASELINE_AND_PROVIDE_README,
+	PromptStrategy.DESCRIBE_TASK_AND_PROVIDE_VERIFIED_SAMPLE,
+	PromptStrategy.DESCRIBE_TASK_AND_PROVIDE_MOCK_VERIFIED_SAMPLE,
+	PromptStrategy.DESCRIBE_TASK_AND_PROVIDE_ASSETS,
+	PromptStrategy.DESCRIBE_TASK_AND_PROVIDE_COMBINED_CONTEXT,
+]
+
+
 def run(
 	model_api: ModelAPI,
 	prompt_strategy: PromptStrategy,
@@ -23,7 +55,41 @@ def run(
 	string_name_of_snapshot: str
 ) -> tuple[str, dict]:
 
-	# Generate messages
+	with trace_job((model_api, prompt_strategy, string_name_of_app, string_name_of_snapshot)):
+
+		# Generate messages
+		list_of_message_dicts = make_list_of_messages_traced(model_api, prompt_strategy, string_name_of_app, string_name_of_snapshot)
+
+		if list_of_message_dicts is None:
+			return "", dict()
+
+		return run_with_messages(model_api, prompt_strategy, string_name_of_app, string_name_of_snapshot, list_of_message_dicts)
+
+
+def make_list_of_messages_traced(
+	model_api: ModelAPI,
+	prompt_strategy: PromptStrategy,
+	string_name_of_app: str,
+	string_name_of_snapshot: str
+) -> Optional[list[dict]]:
+
+	with span(STAGE_MESSAGE_BUILD) as span_message_build:
+		list_of_message_dicts = make_list_of_messages(model_api, prompt_strategy, string_name_of_app, string_name_of_snapshot)
+
+		if list_of_message_dicts is not None:
+			span_message_build.set(**measure_messages(list_of_message_dicts))
+
+	return list_of_message_dicts
+
+
+def make_list_of_messages(
+	model_api: ModelAPI,
+	prompt_strategy: PromptStrategy,
+	string_name_of_app: str,
+	string_name_of_snapshot: str
+) -> Optional[list[dict]]:
+	"""Build the list of messages for a prompting strategy, or None if the experiment cannot be performed"""
+
 	# Prompting strategy "NoContext" in the paper
 	if prompt_strategy == PromptStrategy.BASELINE:
 		list_of_message_dicts = make_list_of_messages_v0_baseline(string_name_of_app, string_name_of_snapshot)
@@ -48,7 +114,7 @@ def run(
 
 		if not verify_response_to_clean_sample_is_correct(model_api, prompt_strategy_used_for_hardcoded_response, string_name_of_app):
 			print(f"ERROR: Failed to perform experiment using strategy {prompt_strategy.value} on app {string_name_of_app}: Do not have verified (correct) response to bug-free screenshot.")
-			return "", dict()
+			return None
 
 		list_of_message_dicts = make_list_of_messages_v3_describe_task_and_provide_verified_sample(
 			string_name_of_app,
@@ -70,7 +136,7 @@ def run(
 
 		if not verify_app_has_assets_available(string_name_of_app):
 			print(f"ERROR: Failed to perform experiment using strategy {prompt_strategy.value} on app {string_name_of_app}: Do not have assets available.")
-			return "", dict()
+			return None
 
 		list_of_message_dicts = make_list_of_messages_v4_describe_task_and_provide_readme_plus_assets(
 			string_name_of_app,
@@ -82,7 +148,7 @@ def run(
 
 		if not verify_app_has_assets_available(string_name_of_app):
 			print(f"ERROR: Failed to perform experiment using strategy {prompt_strategy.value} on app {string_name_of_app}: Do not have assets available.")
-			return "", dict()
+			return None
 
 		list_of_message_dicts = make_list_of_messages_v5_describe_task_and_provide_readme_plus_mock_verified_sample_plus_assets(
 			string_name_of_app,
@@ -107,10 +173,63 @@ def run(
 		_possible_selections = [p.value for p in PromptStrategy]
 		raise ValueError(f"Invalid prompt_strategy_selected. Valid strategies to select from: {_possible_selections}")
 
-	# Call the Model API with list of messages
-	string_response_content: str = get_response(model_api, list_of_message_dicts)  # type: ignore
-	# Call the Model API to extract structured output for results
-	json_response_results: dict = get_structured_answer(model_api, string_response_content)
+	if list_of_message_dicts is not None:
+		list_of_message_dicts = replace_screenshot_with_regions_of_interest(list_of_message_dicts, string_name_of_app, string_name_of_snapshot)
+
+	return list_of_message_dicts
+
+
+def run_with_messages(
+	model_api: ModelAPI,
+	prompt_strategy: PromptStrategy,
+	string_name_of_app: str,
+	string_name_of_snapshot: str,
+	list_of_message_dicts: list[dict]
+) -> tuple[str, dict]:
+
+	if get_bool_single_call_is_enabled():
+		# Call the Model API once, for the response and its structured output
+		string_response_content, json_response_results = get_response_with_structured_answer(model_api, list_of_message_dicts)  # type: ignore
+
+	else:
+		# Call the Model API with list of messages (appended to a file as it arrives, if streaming)
+		path_to_streamed_output = make_path_to_streamed_output_of_sample(model_api, prompt_strategy, string_name_of_app, string_name_of_snapshot) if get_bool_streaming_is_enabled() else None
+		string_response_content: str = get_response(model_api, list_of_message_dicts, path_to_streamed_output=path_to_streamed_output)  # type: ignore
+		# Call the Model API to extract structured output for results
+		json_response_results: dict = get_structured_answer(model_api, string_response_content)
+	# Save to filesystem (json_response_results -> .json, string_response_content -> .txt)
+	save_results(
+		model_api,
+		prompt_strategy,
+		string_name_of_app,
+		string_name_of_snapshot,
+		string_response_content,
+		json_response_results
+	)
+	# Return results in case further processing is desired
+	return string_response_content, json_response_results
+
+
+async def run_with_messages_async(
+	model_api: ModelAPI,
+	prompt_strategy: PromptStrategy,
+	string_name_of_app: str,
+	string_name_of_snapshot: str,
+	list_of_message_dicts: list[dict],
+	rate_limiter: AdaptiveRateLimiter,
+	client_async: Optional[AsyncOpenAI] = None
+) -> tuple[str, dict]:
+
+	if get_bool_single_call_is_enabled():
+		# Call the Model API once, for the response and its structured output
+		string_response_content, json_response_results = await get_response_with_structured_answer_async(model_api, list_of_message_dicts, rate_limiter, client_async)  # type: ignore
+
+	else:
+		# Call the Model API with list of messages (appended to a file as it arrives, if streaming)
+		path_to_streamed_output = make_path_to_streamed_output_of_sample(model_api, prompt_strategy, string_name_of_app, string_name_of_snapshot) if get_bool_streaming_is_enabled() else None
+		string_response_content: str = await get_response_async(model_api, list_of_message_dicts, rate_limiter, client_async, path_to_streamed_output=path_to_streamed_output)  # type: ignore
+		# Call the Model API to extract structured output for results
+		json_response_results: dict = await get_structured_answer_async(model_api, string_response_content, rate_limiter, client_async)
 	# Save to filesystem (json_response_results -> .json, string_response_content -> .txt)
 	save_results(
 		model_api,
@@ -318,15 +437,6 @@ def make_list_of_messages_for_ablation_experiment(
 ):
 	"""Run the ablation experiment with the following approach: V2a - Simple prompt and provide readme"""
 
-	APPS_INCLUDED_IN_ABLATION_STUDY = [
-		"chase-manning-react-photo-studio",
-		"ha-shine-wasm-tetris",
-		"higlass-higlass",
-		"p5aholic-playground",
-		"starwards-starwards",
-		"VoiceSpaceUnder5-VoiceSpace"
-	]
-
 	if string_name_of_app not in APPS_INCLUDED_IN_ABLATION_STUDY:
 		print(f"ERROR: Failed to perform ablation experiment on app {string_name_of_app}: App not included in ablation study.")
 		exit(1)
@@ -0,0 +1,296 @@
+import argparse
+import hashlib
+import os
+import threading
+from pathlib import Path
+from typing import NamedTuple, Optional, Union
+import numpy as np
+from PIL import Image
+from sqlitedict import SqliteDict
+
+
+PATH_TO_SCREENSHOT_INDEX_DEFAULT = Path("../Data/2-Experiments/cache/screenshots.sqlite")
+PATH_TO_SCREENSHOTS_DEFAULT = Path("../Data/1d-Collecting_Screenshots/screenshots")
+
+# out of the 64 bits of the pHash & dHash: screenshots this close look the same at a glance
+INT_MAX_DISTANCE_OF_NEAR_DUPLICATES_DEFAULT = 4
+
+INT_SIZE_OF_HASH = 8
+INT_SIZE_OF_DCT = 32
+
+
+class NearDuplicate(NamedTuple):
+	"""Two screenshots of an app that are pixel-identical (bool_exact) or within the distance of near-duplicates"""
+	string_name_of_app: str
+	string_name_of_snapshot_a: str
+	string_name_of_snapshot_b: str
+	bool_exact: bool
+	int_distance_phash: int
+	int_distance_dhash: int
+
+
+def compute_hashes(path_to_screenshot: Union[str, Path]) -> dict:
+	"""Digest of the pixels (pixel-identical screenshots share it, however their PNG files were encoded), pHash & dHash"""
+
+	with Image.open(path_to_screenshot) as image:
+		image_rgba = image.convert("RGBA")
+
+	hasher = hashlib.sha256(f"{image_rgba.width}x{image_rgba.height}".encode("ascii"))
+	hasher.update(np.asarray(image_rgba).tobytes())
+
+	image_grayscale = image_rgba.convert("L")
+
+	return {
+		"string_digest_of_pixels": hasher.hexdigest(),
+		"int_phash": compute_phash(image_grayscale),
+		"int_dhash": compute_dhash(image_grayscale),
+		"int_width": image_rgba.width,
+		"int_height": image_rgba.height,
+	}
+
+
+def compute_phash(image_grayscale: Image.Image) -> int:
+	# low frequencies of the DCT of a 32x32 thumbnail, above or below their median
+	array_pixels = np.asarray(image_grayscale.resize((INT_SIZE_OF_DCT, INT_SIZE_OF_DCT), Image.Resampling.LANCZOS), dtype=np.float64)
+	array_dct = make_dct_matrix(INT_SIZE_OF_DCT)
+	array_low_frequencies = (array_dct @ array_pixels @ array_dct.T)[:INT_SIZE_OF_HASH, :INT_SIZE_OF_HASH]
+	# the DC term is the mean brightness, not a feature
+	float_median = np.median(array_low_frequencies.flatten()[1:])
+
+	return pack_bits(array_low_frequencies > float_median)
+
+
+def compute_dhash(image_grayscale: Image.Image) -> int:
+	# whether each pixel of a 9x8 thumbnail is brighter than its left neighbour
+	array_pixels = np.asarray(image_grayscale.resize((INT_SIZE_OF_HASH + 1, INT_SIZE_OF_HASH), Image.Resampling.LANCZOS), dtype=np.int16)
+
+	return pack_bits(array_pixels[:, 1:] > array_pixels[:, :-1])
+
+
+def make_dct_matrix(int_size: int) -> np.ndarray:
+	# orthonormal DCT-II
+	array_k = np.arange(int_size).reshape(-1, 1)
+	array_n = np.arange(int_size).reshape(1, -1)
+	array_dct = np.sqrt(2.0 / int_size) * np.cos(np.pi * (2 * array_n + 1) * array_k / (2 * int_size))
+	array_dct[0, :] = np.sqrt(1.0 / int_size)
+
+	return array_dct
+
+
+def pack_bits(array_bits: np.ndarray) -> int:
+	return int.from_bytes(np.packbits(array_bits.flatten()).tobytes(), "big")
+
+
+def count_different_bits(int_hash_a: int, int_hash_b: int) -> int:
+	return bin(int_hash_a ^ int_hash_b).count("1")
+
+
+class ScreenshotIndex:
+	"""
+	Content & perceptual hashes of every screenshot (<app>/<snapshot>.png), stored in SQLite (via sqlitedict).
+
+	Entries are keyed on "<app>/<snapshot>" and hold the mtime & size of the file they were computed from,
+	so updating the index only hashes the screenshots that were added or changed.
+	"""
+
+	def __init__(self, path_to_index: Union[str, Path] = PATH_TO_SCREENSHOT_INDEX_DEFAULT, path_to_screenshots: Union[str, Path] = PATH_TO_SCREENSHOTS_DEFAULT):
+		self.path_to_index = Path(path_to_index)
+		self.path_to_screenshots = Path(path_to_screenshots)
+		self.path_to_index.parent.mkdir(parents=True, exist_ok=True)
+		self.dict_entries = SqliteDict(str(self.path_to_index), tablename="screenshots", autocommit=True)
+		self.lock = threading.Lock()
+
+	def update(self, list_names_of_apps: Optional[list[str]] = None) -> int:
+		"""Hash the new & changed screenshots (of these apps), drop the entries of removed ones; returns the number hashed"""
+
+		if list_names_of_apps is None:
+			list_names_of_apps = sorted(path_to_app.name for path_to_app in self.path_to_screenshots.iterdir() if path_to_app.is_dir())
+
+		int_number_hashed = 0
+
+		with self.lock:
+
+			for string_name_of_app in list_names_of_apps:
+
+				set_keys_of_app = set()
+
+				for path_to_screenshot in sorted((self.path_to_screenshots / string_name_of_app).glob("*.png")):
+
+					string_key = f"{string_name_of_app}/{path_to_screenshot.stem}"
+					set_keys_of_app.add(string_key)
+
+					stat = path_to_screenshot.stat()
+					dict_entry = self.dict_entries.get(string_key)
+
+					if dict_entry is not None and dict_entry["int_mtime_ns"] == stat.st_mtime_ns and dict_entry["int_size"] == stat.st_size:
+						continue
+
+					try:
+						dict_hashes = compute_hashes(path_to_screenshot)
+
+					except Exception as err:
+						print(f"WARNING: Failed to hash screenshot \"{path_to_screenshot}\": {err!r}")
+						continue
+
+					self.dict_entries[string_key] = {"int_mtime_ns": stat.st_mtime_ns, "int_size": stat.st_size, **dict_hashes}
+					int_number_hashed += 1
+
+				for string_key in [string_key for string_key in self.dict_entries.keys() if string_key.startswith(f"{string_name_of_app}/") and string_key not in set_keys_of_app]:
+					del self.dict_entries[string_key]
+
+		return int_number_hashed
+
+	def get_entry(self, string_name_of_app: str, string_name_of_snapshot: str) -> Optional[dict]:
+		return self.dict_entries.get(f"{string_name_of_app}/{string_name_of_snapshot}")
+
+	def find_source_of_duplicate(self, string_name_of_app: str, string_name_of_snapshot: str, list_names_of_snapshots: list[str]) -> Optional[str]:
+		"""
+		The first snapshot (in the order of list_names_of_snapshots, e.g. "clean" first) of the app with the same pixels,
+		or None if there is none before this snapshot: its verdict can be reused for this one
+		"""
+		dict_entry = self.get_entry(string_name_of_app, string_name_of_snapshot)
+
+		if dict_entry is None:
+			return None
+
+		for string_name_of_snapshot_other in list_names_of_snapshots:
+
+			if string_name_of_snapshot_other == string_name_of_snapshot:
+				return None
+
+			dict_entry_other = self.get_entry(string_name_of_app, string_name_of_snapshot_other)
+
+			if dict_entry_other is not None and dict_entry_other["string_digest_of_pixels"] == dict_entry["string_digest_of_pixels"]:
+				return string_name_of_snapshot_other
+
+		return None
+
+	def find_near_duplicates(self, int_max_distance: int = INT_MAX_DISTANCE_OF_NEAR_DUPLICATES_DEFAULT, list_names_of_apps: Optional[list[str]] = None) -> list[NearDuplicate]:
+		"""Pairs of screenshots of the same app that are pixel-identical, or whose pHash & dHash both differ by at most int_max_distance bits"""
+
+		dict_entries_by_app: dict[str, list[tuple[str, dict]]] = dict()
+
+		for string_key, dict_entry in self.dict_entries.items():
+			string_name_of_app, string_name_of_snapshot = string_key.split("/", 1)
+
+			if list_names_of_apps is None or string_name_of_app in list_names_of_apps:
+				dict_entries_by_app.setdefault(string_name_of_app, []).append((string_name_of_snapshot, dict_entry))
+
+		list_near_duplicates = []
+
+		for string_name_of_app, list_entries in sorted(dict_entries_by_app.items()):
+
+			list_entries.sort(key=lambda entry: entry[0])
+
+			for int_index, (string_name_of_snapshot_a, dict_entry_a) in enumerate(list_entries):
+
+				for string_name_of_snapshot_b, dict_entry_b in list_entries[int_index + 1:]:
+
+					bool_exact = dict_entry_a["string_digest_of_pixels"] == dict_entry_b["string_digest_of_pixels"]
+					int_distance_phash = count_different_bits(dict_entry_a["int_phash"], dict_entry_b["int_phash"])
+					int_distance_dhash = count_different_bits(dict_entry_a["int_dhash"], dict_entry_b["int_dhash"])
+
+					if bool_exact or max(int_distance_phash, int_distance_dhash) <= int_max_distance:
+						list_near_duplicates.append(NearDuplicate(string_name_of_app, string_name_of_snapshot_a, string_name_of_snapshot_b, bool_exact, int_distance_phash, int_distance_dhash))
+
+		return list_near_duplicates
+
+	def find_exact_duplicates_across_apps(self) -> list[list[str]]:
+		"""Groups of pixel-identical screenshots that belong to different apps (most likely a mistake in the dataset)"""
+
+		dict_keys_by_digest: dict[str, list[str]] = dict()
+
+		for string_key, dict_entry in self.dict_entries.items():
+			dict_keys_by_digest.setdefault(dict_entry["string_digest_of_pixels"], []).append(string_key)
+
+		return [
+			sorted(list_keys) for list_keys in dict_keys_by_digest.values()
+			if len({string_key.split("/", 1)[0] for string_key in list_keys}) > 1
+		]
+
+	def close(self):
+		self.dict_entries.close()
+
+
+def format_near_duplicates(list_near_duplicates: list[NearDuplicate]) -> str:
+
+	list_lines = []
+
+	for near_duplicate in list_near_duplicates:
+		string_kind = "pixel-identical" if near_duplicate.bool_exact else f"near-duplicate (pHash distance {near_duplicate.int_distance_phash}, dHash distance {near_duplicate.int_distance_dhash})"
+		list_lines.append(f"  {near_duplicate.string_name_of_app}: {near_duplicate.string_name_of_snapshot_a} ~ {near_duplicate.string_name_of_snapshot_b}: {string_kind}")
+
+	return "\n".join(list_lines)
+
+
+# Index used by the batch runner; disabled unless configured (or VLM_CANVAS_BUGS_SCREENSHOT_INDEX_PATH is set)
+screenshot_index: Optional[ScreenshotIndex] = None
+bool_screenshot_index_is_configured = False
+lock_screenshot_index = threading.RLock()
+
+
+def configure_screenshot_index(path_to_index: Optional[Union[str, Path]], path_to_screenshots: Union[str, Path] = PATH_TO_SCREENSHOTS_DEFAULT) -> Optional[ScreenshotIndex]:
+	"""Set (or with path_to_index=None, disable) the screenshot index used to reuse the verdicts of duplicate screenshots"""
+
+	global screenshot_index, bool_screenshot_index_is_configured
+
+	with lock_screenshot_index:
+
+		if screenshot_index is not None:
+			screenshot_index.close()
+
+		screenshot_index = None
+
+		if path_to_index is not None:
+			screenshot_index = ScreenshotIndex(path_to_index, path_to_screenshots)
+
+		bool_screenshot_index_is_configured = True
+
+	return screenshot_index
+
+
+def get_screenshot_index() -> Optional[ScreenshotIndex]:
+
+	with lock_screenshot_index:
+
+		if not bool_screenshot_index_is_configured:
+			configure_screenshot_index(os.getenv("VLM_CANVAS_BUGS_SCREENSHOT_INDEX_PATH", None))
+
+		return screenshot_index
+
+
+def main(list_of_arguments: Optional[list[str]] = None):
+
+	parser = argparse.ArgumentParser(
+		prog='python3 -m vlm_analysis.screenshot_index',
+		description='Update the index of screenshot hashes, and report the screenshots that are pixel-identical or near-duplicates of another one',
+	)
+	parser.add_argument("--index", type=str, default=str(PATH_TO_SCREENSHOT_INDEX_DEFAULT), help="SQLite file of the index")
+	parser.add_argument("--screenshots", type=str, default=str(PATH_TO_SCREENSHOTS_DEFAULT), help="Folder of the screenshots (<app>/<snapshot>.png)")
+	parser.add_argument("--apps", type=str, nargs="+", default=None, help="Only these apps (default: all)")
+	parser.add_argument("--max-distance", type=int, default=INT_MAX_DISTANCE_OF_NEAR_DUPLICATES_DEFAULT, help="Screenshots whose pHash & dHash differ by at most this many bits (of 64) are near-duplicates")
+	parser.add_argument("--output", type=str, default=None, help="Also write the pairs of duplicates to this CSV file")
+	args = parser.parse_args(list_of_arguments)
+
+	index = ScreenshotIndex(args.index, args.screenshots)
+	int_number_hashed = index.update(args.apps)
+	print(f"Screenshot index \"{args.index}\": {len(index.dict_entries)} screenshots ({int_number_hashed} hashed now)")
+
+	list_near_duplicates = index.find_near_duplicates(args.max_distance, args.apps)
+	print(f"{sum(1 for near_duplicate in list_near_duplicates if near_duplicate.bool_exact)} pairs of pixel-identical screenshots, {sum(1 for near_duplicate in list_near_duplicates if not near_duplicate.bool_exact)} pairs of near-duplicates")
+
+	if len(list_near_duplicates) > 0:
+		print(format_near_duplicates(list_near_duplicates))
+
+	for list_keys in index.find_exact_duplicates_across_apps():
+		print(f"WARNING: Pixel-identical screenshots of different apps: {', '.join(list_keys)}")
+
+	if args.output is not None:
+		import pandas as pd
+		pd.DataFrame.from_records(list_near_duplicates, columns=NearDuplicate._fields).to_csv(args.output, index=False)
+
+	index.close()
+
+
+if __name__ == "__main__":
+	main()
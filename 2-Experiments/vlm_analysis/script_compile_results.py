@@ -1,15 +1,24 @@
+import argparse
 import base64
+from pathlib import Path
 import pandas as pd
 from . import PromptStrategy, ModelAPI
 from .utilities import load_results, make_path_to_results_dir_for_model_with_strategy
+from .results_store import get_results_store, make_name_of_model_dir
+from .results_compiler import compile_results_incrementally, compact_compiled_results, PATH_TO_RESULTS_DIR_DEFAULT, PATH_TO_COMPILED_DEFAULT
 
 
 def main():
 
-	list_model_apis = list(ModelAPI)
+	# e.g. the self-hosted models are only in the results if they were run (see backends.py)
+	list_model_apis = list_model_apis_with_results()
 	list_prompt_strategies = list(PromptStrategy)
 	list_results_dataframes = list()
 
+	if len(list_model_apis) == 0:
+		print("WARNING: no results to compile")
+		return
+
 	for model_api in list_model_apis:
 
 		for prompt_strategy in list_prompt_strategies:
@@ -21,10 +30,60 @@ def main():
 	df_results.to_csv("../Data/2-Experiments/results/compiled.csv")
 
 
+def list_model_apis_with_results() -> list[ModelAPI]:
+
+	results_store = get_results_store()
+
+	if results_store is not None:
+		list_model_api_values = results_store.list_model_apis()
+		return [model_api for model_api in ModelAPI if model_api.value in list_model_api_values]
+
+	return [model_api for model_api in ModelAPI if (PATH_TO_RESULTS_DIR_DEFAULT / make_name_of_model_dir(model_api.value)).is_dir()]
+
+
 def compile_results_for_model_with_strategy(model_api, prompt_strategy):
 
 	list_records = []
 
+	for app_name, sample_name in list_samples_for_model_with_strategy(model_api, prompt_strategy):
+
+		bool_ground_truth = False if sample_name == "clean" else True
+
+		string_results_text, dict_results_json = load_results(model_api, prompt_strategy, app_name, sample_name)
+
+		try:
+			encoded_results_text = base64.b64encode(string_results_text.encode('utf-8'))
+
+		except Exception:
+			print(f"WARNING: Failed to encode response text with base64: \"{string_results_text}\"")
+			encoded_results_text = None
+
+		record = {}
+		record["TextModelAPI"] = model_api.value
+		record["TextPromptStrategy"] = prompt_strategy.value
+		record["TextAppName"] = app_name
+		record["TextSampleName"] = sample_name
+		record["BoolGroundTruth"] = bool_ground_truth
+		record["BoolDidDetectVisualBug"] = dict_results_json.get("bool_did_detect_visual_bug")
+		record["TextDescriptionOfVisualBug"] = dict_results_json.get("string_description_of_visual_bug")
+		record["EncodedBase64Response"] = encoded_results_text
+
+		list_records.append(record)
+
+	df_results = pd.DataFrame.from_records(list_records)
+
+	return df_results
+
+
+def list_samples_for_model_with_strategy(model_api, prompt_strategy) -> list[tuple[str, str]]:
+
+	results_store = get_results_store()
+
+	if results_store is not None:
+		return results_store.list_samples(model_api.value, prompt_strategy.value)
+
+	list_samples = []
+
 	path_to_results_for_model_with_strategy = make_path_to_results_dir_for_model_with_strategy(model_api, prompt_strategy)
 
 	for path_to_results_for_app in path_to_results_for_model_with_strategy.glob("*"):
@@ -42,35 +101,30 @@ def compile_results_for_model_with_strategy(model_api, prompt_strategy):
 				print(f"WARNING: Skipping invalid path (does not point to a file): \"{path_to_results_for_app_sample}\"")
 				continue
 
-			sample_name = path_to_results_for_app_sample.stem
-			bool_ground_truth = False if sample_name == "clean" else True
-
-			string_results_text, dict_results_json = load_results(model_api, prompt_strategy, app_name, sample_name)
+			list_samples.append((app_name, path_to_results_for_app_sample.stem))
 
-			try:
-				encoded_results_text = base64.b64encode(string_results_text.encode('utf-8'))
-
-			except Exception:
-				print(f"WARNING: Failed to encode response text with base64: \"{string_results_text}\"")
-				encoded_results_text = None
-
-			record = {}
-			record["TextModelAPI"] = model_api.value
-			record["TextPromptStrategy"] = prompt_strategy.value
-			record["TextAppName"] = app_name
-			record["TextSampleName"] = sample_name
-			record["BoolGroundTruth"] = bool_ground_truth
-			record["BoolDidDetectVisualBug"] = dict_results_json.get("bool_did_detect_visual_bug")
-			record["TextDescriptionOfVisualBug"] = dict_results_json.get("string_description_of_visual_bug")
-			record["EncodedBase64Response"] = encoded_results_text
-
-			list_records.append(record)
-
-	df_results = pd.DataFrame.from_records(list_records)
-
-	return df_results
+	return list_samples
 
 
 if __name__ == "__main__":
 
-	main()
+	parser = argparse.ArgumentParser(
+		prog='python3 -m vlm_analysis.script_compile_results',
+		description='Compile results into ../Data/2-Experiments/results/compiled.csv (or, with --parquet, a Parquet dataset updated incrementally)',
+	)
+	parser.add_argument("--parquet", action="store_true", help="Only add new or changed samples to the Parquet dataset, instead of rewriting compiled.csv")
+	parser.add_argument("--compact", action="store_true", help="With --parquet, merge the part files of the dataset into one")
+	parser.add_argument("--results-dir", type=str, default=str(PATH_TO_RESULTS_DIR_DEFAULT))
+	parser.add_argument("--compiled", type=str, default=str(PATH_TO_COMPILED_DEFAULT))
+	parser.add_argument("--workers", type=int, default=8)
+	args = parser.parse_args()
+
+	if args.parquet:
+		# with a results store (VLM_CANVAS_BUGS_RESULTS_STORE_PATH), its rows are compiled instead of --results-dir, as in main()
+		compile_results_incrementally(Path(args.results_dir), Path(args.compiled), args.workers, get_results_store())
+
+		if args.compact:
+			compact_compiled_results(Path(args.compiled))
+
+	else:
+		main()
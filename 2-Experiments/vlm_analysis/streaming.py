@@ -0,0 +1,84 @@
+import os
+import time
+from pathlib import Path
+from typing import Optional
+from .call_policy import InvalidResponseError
+from .tracing import add_to_current_span
+
+
+# the response being streamed is appended to <snapshot>.txt.partial, which the results compilers (*.txt) do not pick up;
+# save_results writes the .txt & .json and removes it, so a .txt.partial left behind is the output of a run that was stopped
+STRING_SUFFIX_OF_STREAMED_OUTPUT = ".partial"
+
+
+class StreamedOutput:
+	"""Appends the pieces of a streamed response to a file as they arrive, and times the stream"""
+
+	def __init__(self, path_to_streamed_output: Path, float_counter_start: Optional[float] = None):
+		self.path_to_streamed_output = path_to_streamed_output
+		self.list_of_pieces: list[str] = []
+		# time.perf_counter() when the request was sent (the response headers only come with the first token)
+		self.float_counter_start = time.perf_counter() if float_counter_start is None else float_counter_start
+		self.float_seconds_to_first_token: Optional[float] = None
+		# truncates what an earlier (failed) attempt wrote
+		self.file = open(path_to_streamed_output, "w", encoding="utf-8")
+
+	def add(self, string_piece: Optional[str]):
+
+		if not string_piece:
+			return
+
+		if self.float_seconds_to_first_token is None:
+			self.float_seconds_to_first_token = time.perf_counter() - self.float_counter_start
+
+		self.list_of_pieces.append(string_piece)
+		self.file.write(string_piece)
+		# so that a run killed mid-stream keeps what was received
+		self.file.flush()
+
+	def close(self) -> str:
+		"""The whole response (raises if the stream was empty)"""
+
+		self.file.close()
+
+		add_to_current_span(
+			bool_streamed=True,
+			float_seconds_to_first_token=self.float_seconds_to_first_token,
+			float_seconds_of_generation=time.perf_counter() - self.float_counter_start,
+			int_number_of_pieces=len(self.list_of_pieces),
+		)
+
+		string_response_content = "".join(self.list_of_pieces)
+
+		if not string_response_content.strip():
+			raise InvalidResponseError("Empty streamed response")
+
+		return string_response_content
+
+	def abort(self):
+		# the partial output stays on disk
+		self.file.close()
+
+	def __enter__(self) -> "StreamedOutput":
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is not None:
+			self.abort()
+
+
+def make_path_to_streamed_output(path_to_results_txt: Path) -> Path:
+	return path_to_results_txt.with_name(path_to_results_txt.name + STRING_SUFFIX_OF_STREAMED_OUTPUT)
+
+
+# Off by default: the response is received in one piece, as in the paper
+bool_streaming_is_enabled = os.getenv("VLM_CANVAS_BUGS_STREAMING", "0") == "1"
+
+
+def configure_streaming(bool_enabled: bool):
+	global bool_streaming_is_enabled
+	bool_streaming_is_enabled = bool_enabled
+
+
+def get_bool_streaming_is_enabled() -> bool:
+	return bool_streaming_is_enabled
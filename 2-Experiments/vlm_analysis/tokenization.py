@@ -0,0 +1,29 @@
+from functools import lru_cache
+
+
+STRING_NAME_OF_ENCODING = "o200k_base"
+
+
+@lru_cache(maxsize=1)
+def get_encoding():
+	"""The tokenizer of gpt-4o, or None if it cannot be loaded (tiktoken downloads it on first use)"""
+
+	try:
+		import tiktoken
+		return tiktoken.get_encoding(STRING_NAME_OF_ENCODING)
+
+	except Exception as err:
+		print(f"WARNING: Failed to load the tiktoken encoding {STRING_NAME_OF_ENCODING}, estimating 4 characters per token instead: {err!r}")
+		return None
+
+
+@lru_cache(maxsize=1024)
+def count_tokens_of_text(string_text: str) -> int:
+	# the same README is sent with every snapshot of an app, so counts are cached
+
+	encoding = get_encoding()
+
+	if encoding is None:
+		return (len(string_text) + 3) // 4
+
+	return len(encoding.encode(string_text, disallowed_special=()))
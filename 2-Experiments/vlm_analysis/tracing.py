@@ -0,0 +1,361 @@
+import argparse
+import atexit
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterator, Optional, Union
+import numpy as np
+
+
+PATH_TO_TRACE_DEFAULT = Path("../Data/2-Experiments/traces/trace.jsonl")
+
+# stages of the pipeline, in the order a job goes through them
+STAGE_MESSAGE_BUILD = "message_build"
+STAGE_PROMPT_LOAD = "prompt_load"
+STAGE_README_LOAD = "readme_load"
+STAGE_IMAGE_LOAD = "image_load"
+STAGE_PIXEL_DIFF = "pixel_diff"
+STAGE_API_CALL = "api_call"
+STAGE_EXTRACTION_CALL = "extraction_call"
+STAGE_SAVE = "save"
+# a whole stage of the Batch API runner: submitting the batch files and waiting for their results
+STAGE_BATCH = "batch_submit_and_wait"
+# not a span: the time to the first token of streamed API calls, reported by trace-summary next to their duration
+STAGE_TIME_TO_FIRST_TOKEN = "time_to_first_token"
+
+LIST_PERCENTILES = [50, 95, 99]
+
+
+class Span:
+	"""A timed stage of a job; attributes (sizes, token usage, retries) can be added until it ends"""
+
+	__slots__ = ("string_stage", "dict_attributes")
+
+	def __init__(self, string_stage: str, dict_attributes: dict):
+		self.string_stage = string_stage
+		self.dict_attributes = dict_attributes
+
+	def set(self, **kwargs):
+		self.dict_attributes.update(kwargs)
+
+
+class NoOpSpan(Span):
+	"""Handed out when tracing is disabled"""
+
+	def set(self, **kwargs):
+		pass
+
+
+SPAN_NO_OP = NoOpSpan("", dict())
+
+# the job being prepared or run, and the innermost span, of the current thread or asyncio task
+contextvar_labels_of_job: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("labels_of_job", default=None)
+contextvar_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("span", default=None)
+
+
+class Tracer:
+	"""Appends one JSON line per span to a trace file, shared by all threads"""
+
+	def __init__(self, path_to_trace: Union[str, Path] = PATH_TO_TRACE_DEFAULT):
+		self.path_to_trace = Path(path_to_trace)
+		self.path_to_trace.parent.mkdir(parents=True, exist_ok=True)
+		self.lock = threading.Lock()
+		# line buffered: every span is on disk as soon as it ends, even if the run is killed (see read_trace)
+		self.file = open(self.path_to_trace, "a", encoding="utf-8", buffering=1)
+
+	def write(self, dict_span: dict):
+
+		string_line = json.dumps(dict_span, default=str)
+
+		with self.lock:
+			if not self.file.closed:
+				self.file.write(string_line + "\n")
+
+	def close(self):
+		with self.lock:
+			self.file.close()
+
+
+@contextmanager
+def trace_job(job: tuple) -> Iterator[None]:
+	"""Label the spans of everything done for this job (in this thread or asyncio task)"""
+
+	model_api, prompt_strategy, string_name_of_app, string_name_of_snapshot = job
+
+	token = contextvar_labels_of_job.set({
+		"string_model_api": model_api.value,
+		"string_prompt_strategy": prompt_strategy.value,
+		"string_name_of_app": string_name_of_app,
+		"string_name_of_snapshot": string_name_of_snapshot,
+	})
+
+	try:
+		yield
+
+	finally:
+		contextvar_labels_of_job.reset(token)
+
+
+@contextmanager
+def span(string_stage: str, **kwargs) -> Iterator[Span]:
+
+	tracer = get_tracer()
+
+	if tracer is None:
+		yield SPAN_NO_OP
+		return
+
+	span_parent = contextvar_span.get()
+	span_new = Span(string_stage, kwargs)
+	token = contextvar_span.set(span_new)
+	float_time_start = time.time()
+	float_counter_start = time.perf_counter()
+	string_error = ""
+
+	try:
+		yield span_new
+
+	except BaseException as err:
+		string_error = repr(err)
+		raise
+
+	finally:
+		float_duration_seconds = time.perf_counter() - float_counter_start
+		contextvar_span.reset(token)
+
+		tracer.write({
+			"string_stage": string_stage,
+			"string_parent_stage": span_parent.string_stage if span_parent is not None else None,
+			**(contextvar_labels_of_job.get() or dict()),
+			"float_time_start": float_time_start,
+			"float_duration_seconds": float_duration_seconds,
+			"string_error": string_error,
+			"dict_attributes": span_new.dict_attributes,
+		})
+
+
+def add_to_current_span(**kwargs):
+	"""Add attributes to the innermost span, e.g. from deep inside a model API call"""
+
+	span_current = contextvar_span.get()
+
+	if span_current is not None:
+		span_current.set(**kwargs)
+
+
+def add_usage_to_current_span(usage: Any):
+	"""Token usage of an OpenAI chat completion"""
+
+	if usage is None or contextvar_span.get() is None:
+		return
+
+	prompt_tokens_details = getattr(usage, "prompt_tokens_details", None)
+
+	# versions of the openai package older than the field keep it as a dict
+	if isinstance(prompt_tokens_details, dict):
+		int_cached_tokens = prompt_tokens_details.get("cached_tokens")
+
+	else:
+		int_cached_tokens = getattr(prompt_tokens_details, "cached_tokens", None)
+
+	add_to_current_span(
+		int_prompt_tokens=usage.prompt_tokens,
+		int_completion_tokens=usage.completion_tokens,
+		int_cached_tokens=int_cached_tokens,
+	)
+
+
+def measure_messages(list_of_message_dicts: list[dict]) -> dict[str, int]:
+	"""Size of a request: characters of text, number of images and characters of their (base64) data"""
+
+	int_number_of_characters_of_text = 0
+	int_number_of_images = 0
+	int_number_of_characters_of_images = 0
+
+	for message_dict in list_of_message_dicts:
+
+		content = message_dict.get("content")
+		list_of_parts = content if isinstance(content, list) else [content]
+
+		for part in list_of_parts:
+
+			if isinstance(part, dict) and part.get("type") == "image_url":
+				int_number_of_images += 1
+				int_number_of_characters_of_images += len(part["image_url"]["url"])
+
+			elif isinstance(part, dict):
+				int_number_of_characters_of_text += len(part.get("text", ""))
+
+			elif isinstance(part, str):
+				int_number_of_characters_of_text += len(part)
+
+	return {
+		"int_request_characters_of_text": int_number_of_characters_of_text,
+		"int_request_number_of_images": int_number_of_images,
+		"int_request_characters_of_images": int_number_of_characters_of_images,
+	}
+
+
+def read_trace(path_to_trace: Union[str, Path]) -> list[dict]:
+
+	list_spans = []
+
+	with open(path_to_trace, "r", encoding="utf-8") as f:
+
+		for string_line in f:
+
+			try:
+				list_spans.append(json.loads(string_line))
+
+			# the last line of a run that was killed may be cut off
+			except json.JSONDecodeError:
+				continue
+
+	return list_spans
+
+
+def summarize_trace(list_spans: list[dict]) -> list[dict]:
+	"""p50/p95/p99 & total duration per stage, for all strategies and per strategy"""
+
+	dict_durations: dict[tuple[str, str], list[float]] = dict()
+	dict_number_of_errors: dict[tuple[str, str], int] = dict()
+
+	for dict_span in list_spans:
+
+		list_stages_and_durations = [(dict_span["string_stage"], dict_span["float_duration_seconds"])]
+		float_seconds_to_first_token = (dict_span.get("dict_attributes") or dict()).get("float_seconds_to_first_token")
+
+		if float_seconds_to_first_token is not None:
+			list_stages_and_durations.append((STAGE_TIME_TO_FIRST_TOKEN, float_seconds_to_first_token))
+
+		for string_stage, float_duration_seconds in list_stages_and_durations:
+			for string_prompt_strategy in ("*", dict_span.get("string_prompt_strategy") or "-"):
+				tuple_key = (string_stage, string_prompt_strategy)
+				dict_durations.setdefault(tuple_key, []).append(float_duration_seconds)
+				dict_number_of_errors[tuple_key] = dict_number_of_errors.get(tuple_key, 0) + (1 if dict_span.get("string_error") else 0)
+
+	list_stages = [STAGE_MESSAGE_BUILD, STAGE_PROMPT_LOAD, STAGE_README_LOAD, STAGE_IMAGE_LOAD, STAGE_PIXEL_DIFF, STAGE_TIME_TO_FIRST_TOKEN, STAGE_API_CALL, STAGE_EXTRACTION_CALL, STAGE_SAVE, STAGE_BATCH]
+	list_rows = []
+
+	for (string_stage, string_prompt_strategy), list_durations in sorted(
+		dict_durations.items(),
+		key=lambda item: (list_stages.index(item[0][0]) if item[0][0] in list_stages else len(list_stages), item[0][0], item[0][1] != "*", item[0][1])
+	):
+		array_durations = np.asarray(list_durations)
+		array_percentiles = np.percentile(array_durations, LIST_PERCENTILES)
+
+		list_rows.append({
+			"string_stage": string_stage,
+			"string_prompt_strategy": string_prompt_strategy,
+			"int_count": len(array_durations),
+			"int_number_of_errors": dict_number_of_errors[(string_stage, string_prompt_strategy)],
+			**{f"float_p{int_percentile}_seconds": float(float_value) for int_percentile, float_value in zip(LIST_PERCENTILES, array_percentiles)},
+			"float_total_seconds": float(array_durations.sum()),
+		})
+
+	return list_rows
+
+
+def summarize_prompt_cache(list_spans: list[dict]) -> tuple[int, int]:
+	"""Prompt tokens of the traced calls, and how many of them the provider served from its prompt cache"""
+
+	int_prompt_tokens = 0
+	int_cached_tokens = 0
+
+	for dict_span in list_spans:
+		dict_attributes = dict_span.get("dict_attributes") or dict()
+		int_prompt_tokens += dict_attributes.get("int_prompt_tokens") or 0
+		int_cached_tokens += dict_attributes.get("int_cached_tokens") or 0
+
+	return int_prompt_tokens, int_cached_tokens
+
+
+def format_summary(list_rows: list[dict]) -> str:
+
+	list_lines = [f"{'stage':<22} {'prompt strategy':<40} {'count':>7} {'errors':>6} {'p50 (s)':>9} {'p95 (s)':>9} {'p99 (s)':>9} {'total (s)':>10}"]
+
+	for dict_row in list_rows:
+		# the long strategy names are cut, their prefix (v0, v2a, ...) is what tells them apart
+		list_lines.append(
+			f"{dict_row['string_stage']:<22} {dict_row['string_prompt_strategy'][:40]:<40} {dict_row['int_count']:>7} {dict_row['int_number_of_errors']:>6} "
+			f"{dict_row['float_p50_seconds']:>9.3f} {dict_row['float_p95_seconds']:>9.3f} {dict_row['float_p99_seconds']:>9.3f} {dict_row['float_total_seconds']:>10.1f}"
+		)
+
+	return "\n".join(list_lines)
+
+
+# Tracer used by the pipeline; disabled unless configured (or VLM_CANVAS_BUGS_TRACE_PATH is set)
+tracer: Optional[Tracer] = None
+bool_tracing_is_configured = False
+lock_tracer = threading.RLock()
+
+
+def configure_tracing(path_to_trace: Optional[Union[str, Path]]) -> Optional[Tracer]:
+	"""Set (or with path_to_trace=None, disable) the trace file"""
+
+	global tracer, bool_tracing_is_configured
+
+	with lock_tracer:
+
+		if tracer is not None:
+			tracer.close()
+
+		tracer = None
+
+		if path_to_trace is not None:
+			tracer = Tracer(path_to_trace)
+
+		bool_tracing_is_configured = True
+
+	return tracer
+
+
+def get_tracer() -> Optional[Tracer]:
+
+	# cheap check first: this is called for every span
+	if bool_tracing_is_configured:
+		return tracer
+
+	with lock_tracer:
+
+		if not bool_tracing_is_configured:
+			configure_tracing(os.getenv("VLM_CANVAS_BUGS_TRACE_PATH", None))
+
+		return tracer
+
+
+def close_tracer():
+	with lock_tracer:
+		if tracer is not None:
+			tracer.close()
+
+
+atexit.register(close_tracer)
+
+
+def main(list_of_arguments: Optional[list[str]] = None):
+
+	parser = argparse.ArgumentParser(
+		prog='python3 -m vlm_analysis trace-summary',
+		description='Report the p50/p95/p99 duration of each stage of the pipeline, overall (*) and per prompt strategy',
+	)
+	parser.add_argument("path_to_trace", type=str, nargs="?", default=str(PATH_TO_TRACE_DEFAULT))
+	parser.add_argument("--output", type=str, default=None, help="Also write the summary to this CSV file")
+	args = parser.parse_args(list_of_arguments)
+
+	list_spans = read_trace(args.path_to_trace)
+	list_rows = summarize_trace(list_spans)
+	print(format_summary(list_rows))
+
+	int_prompt_tokens, int_cached_tokens = summarize_prompt_cache(list_spans)
+
+	if int_prompt_tokens > 0:
+		print(f"Prompt cache: {int_cached_tokens} of {int_prompt_tokens} prompt tokens cached ({100 * int_cached_tokens / int_prompt_tokens:.1f}%)")
+
+	if args.output is not None:
+		import pandas as pd
+		pd.DataFrame.from_records(list_rows).to_csv(args.output, index=False)
@@ -1,13 +1,27 @@
 # from pdb import set_trace  # https://web.stanford.edu/class/physics91si/2013/handouts/Pdb_Commands.pdf
 from typing import Optional, Union
 import os
-import base64
 import json
+import time
 from pathlib import Path
 from dotenv import load_dotenv
 # from PIL import Image
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, RateLimitError
 from . import PromptStrategy, ModelAPI
+from .clients import get_client, get_client_async, dict_client_settings
+from .backends import get_backend, get_name_of_backend, get_name_of_model, limit_concurrency, limit_concurrency_async
+from .call_policy import call_with_policy, call_with_policy_async, InvalidResponseError
+from .streaming import StreamedOutput, make_path_to_streamed_output
+from .response_cache import get_response_cache, make_key_of_request
+from .image_cache import get_encoded_image_cache
+from .readme_index import get_readme_index
+from .readme_context import get_readme_context_builder
+from .asset_atlas import get_asset_atlas_cache, STRING_PROMPT_ATLAS
+from .results_store import get_results_store, parse_response_results, make_name_of_model_dir
+from .image_preparation import ImageRole, prepare_image, get_image_preparation_policy, image_preparation_stats
+from .rate_limiting import AdaptiveRateLimiter, estimate_number_of_tokens
+from .pixel_diff import get_pixel_diff_policy, compute_pixel_diff, make_images_of_regions_of_interest
+from .tracing import span, add_to_current_span, add_usage_to_current_span, measure_messages, STAGE_PROMPT_LOAD, STAGE_README_LOAD, STAGE_IMAGE_LOAD, STAGE_PIXEL_DIFF, STAGE_API_CALL, STAGE_EXTRACTION_CALL, STAGE_SAVE
 
 
 def load_prompts(
@@ -17,6 +31,25 @@ def load_prompts(
 	bool_ablated_readme_has_the_good_part: Optional[bool] = None
 ) -> str:
 
+	with span(STAGE_PROMPT_LOAD) as span_prompt_load:
+		string_prompt_user = load_prompts_untraced(
+			prompt_strategy,
+			string_name_of_app_for_description,
+			string_name_of_app_for_ablated_description,
+			bool_ablated_readme_has_the_good_part
+		)
+		span_prompt_load.set(int_characters=len(string_prompt_user))
+
+	return string_prompt_user
+
+
+def load_prompts_untraced(
+	prompt_strategy: PromptStrategy,
+	string_name_of_app_for_description: Optional[str] = None,
+	string_name_of_app_for_ablated_description: Optional[str] = None,
+	bool_ablated_readme_has_the_good_part: Optional[bool] = None
+) -> str:
+
 	path_to_prompts = Path("./vlm_analysis/prompts")
 	path_to_prompt_base = path_to_prompts / f"{prompt_strategy.value}.md"
 
@@ -26,6 +59,12 @@ def load_prompts(
 	if string_name_of_app_for_description is not None:
 
 		string_prompt_app_description = load_original_application_README(string_name_of_app_for_description)
+		readme_context_builder = get_readme_context_builder()
+
+		# only the README chunks most relevant to the prompt, within a token budget (if enabled)
+		if readme_context_builder is not None:
+			string_prompt_app_description = readme_context_builder.build(string_name_of_app_for_description, string_prompt_app_description, string_prompt_user)
+
 		string_prompt_user = f"{string_prompt_user}\n{string_prompt_app_description}"
 	
 	elif string_name_of_app_for_ablated_description is not None:
@@ -43,6 +82,33 @@ def load_prompts(
 
 
 def load_original_application_README(string_name_of_app_for_description: str) -> str:
+
+	path_to_app_repo = make_path_to_app_repo(string_name_of_app_for_description)
+
+	with span(STAGE_README_LOAD) as span_readme_load:
+		# READMEs are found with a pruned walk of the repo, and cached per app until its HEAD commit changes
+		string_prompt_app_description = get_readme_index().load_description(string_name_of_app_for_description, path_to_app_repo)
+		span_readme_load.set(int_characters=len(string_prompt_app_description))
+
+	if len(string_prompt_app_description) <= 0:
+		msg = f"ERROR: Missing description of app! {string_name_of_app_for_description}.\nPath to app repo: {path_to_app_repo.resolve()}"
+		print(msg)
+		exit(1)
+
+	return string_prompt_app_description
+
+
+def warm_up_readme_index(list_names_of_apps: list[str]):
+	"""Load the README descriptions of many apps up front (e.g. before a batch run)"""
+
+	dict_paths_to_app_repos = {
+		string_name_of_app: make_path_to_app_repo(string_name_of_app)
+		for string_name_of_app in list_names_of_apps
+	}
+	get_readme_index().warm_up(dict_paths_to_app_repos)
+
+
+def make_path_to_app_repo(string_name_of_app: str) -> Path:
 	# Determine the root directory and the path to the .env file
 	root_dir = Path.cwd().parent
 	dotenv_path = root_dir / ".env"
@@ -65,28 +131,9 @@ def load_original_application_README(string_name_of_app_for_description: str) ->
 		print(str_msg_error)
 		exit(1)
 
-	path_to_app_repo = Path("..") / Path(relative_path_to_external_repos) / string_name_of_app_for_description
-	string_prompt_app_description = ""
+	path_to_app_repo = Path("..") / Path(relative_path_to_external_repos) / string_name_of_app
 
-	for path_to_readme in path_to_app_repo.resolve().rglob("README.md"):
-
-		if "node_modules" in str(path_to_readme):
-			continue
-
-		print(f"Reading README for app {string_name_of_app_for_description} from path: \"{path_to_readme}\"")
-
-		with open(path_to_readme, "r", encoding="utf-8", errors="replace") as f:
-			string_readme = f.read()
-			string_prompt_app_description += f"\n{string_readme}"
-
-	string_prompt_app_description = string_prompt_app_description.strip()
-
-	if len(string_prompt_app_description) <= 0:
-		msg = f"ERROR: Missing description of app! {string_name_of_app_for_description}.\nPath to app repo: {path_to_app_repo.resolve()}"
-		print(msg)
-		exit(1)
-
-	return string_prompt_app_description
+	return path_to_app_repo
 
 
 def load_ablated_application_README(string_name_of_app_for_ablated_description: str, bool_ablated_readme_has_the_good_part: bool) -> str:
@@ -101,8 +148,11 @@ def load_ablated_application_README(string_name_of_app_for_ablated_description:
 
 	print(f"Reading ablated README for app {string_name_of_app_for_ablated_description} from path: \"{path_to_ablated_readme}\"")
 	
-	with open(path_to_ablated_readme, "r", encoding="utf-8", errors="replace") as f:
-		string_ablated_readme = f.read()
+	with span(STAGE_README_LOAD) as span_readme_load:
+		with open(path_to_ablated_readme, "r", encoding="utf-8", errors="replace") as f:
+			string_ablated_readme = f.read()
+
+		span_readme_load.set(int_characters=len(string_ablated_readme))
 
 	return string_ablated_readme
 
@@ -114,6 +164,24 @@ def load_hardcoded_response(
 	string_name_of_snapshot_for_hardcoded_response: str
 ) -> str:
 
+	results_store = get_results_store()
+
+	# the verified response is read where verify_response_to_clean_sample_is_correct read its verdict
+	if results_store is not None:
+		print(f"Reading verified response to bug-free snapshot for app {string_name_of_app_for_description} from the results store")
+
+		tuple_results = results_store.load(
+			model_api_used_for_hardcoded_response.value,
+			prompt_strategy_used_for_hardcoded_response.value,
+			string_name_of_app_for_description,
+			string_name_of_snapshot_for_hardcoded_response
+		)
+
+		if tuple_results is None:
+			raise FileNotFoundError(f"No verified response in the results store for {model_api_used_for_hardcoded_response.value} / {prompt_strategy_used_for_hardcoded_response.value} / {string_name_of_app_for_description} / {string_name_of_snapshot_for_hardcoded_response}")
+
+		return tuple_results[0]
+
 	path_to_results = make_path_to_results_dir_for_model_with_strategy_on_app(
 		model_api_used_for_hardcoded_response,
 		prompt_strategy_used_for_hardcoded_response,
@@ -157,17 +225,37 @@ def load_bugfree_baseline_image(string_name_of_app: str) -> str:
 
 
 def load_and_encode_image(path_to_image) -> str:
-	with open(path_to_image, "rb") as image_file:
-		return base64.b64encode(image_file.read()).decode('utf-8')
 
+	with span(STAGE_IMAGE_LOAD, string_path=str(path_to_image)) as span_image_load:
+		# clean.png & assets are shared by every snapshot (and strategy) of an app, so only encode them once
+		base64_image = get_encoded_image_cache().load_and_encode_image(path_to_image)
+		span_image_load.set(int_characters=len(base64_image))
 
-def load_assets(string_name_of_app: str) -> list[str]:
+	return base64_image
+
+
+def list_paths_to_assets(string_name_of_app: str) -> list[Path]:
 	path_to_assets = Path("../Data/1d-Collecting_Screenshots/assets/")
 	path_to_assets_for_app = path_to_assets / string_name_of_app
 
+	return list(path_to_assets_for_app.rglob("*.png"))
+
+
+def load_assets(string_name_of_app: str) -> list[str]:
+
+	asset_atlas_cache = get_asset_atlas_cache()
+
+	# in atlas mode, the assets are packed into a few labelled sheets instead of one image each
+	if asset_atlas_cache is not None:
+		with span(STAGE_IMAGE_LOAD, string_path="asset_atlas") as span_image_load:
+			list_of_encoded_sheets = asset_atlas_cache.load_encoded_sheets(string_name_of_app, list_paths_to_assets(string_name_of_app))
+			span_image_load.set(int_characters=sum(len(base64_sheet) for base64_sheet in list_of_encoded_sheets))
+
+		return list_of_encoded_sheets
+
 	list_of_encoded_assets = []
 
-	for path_to_image in path_to_assets_for_app.rglob("*.png"):
+	for path_to_image in list_paths_to_assets(string_name_of_app):
 
 		try:
 			encoded_image = load_and_encode_image(path_to_image)
@@ -185,7 +273,13 @@ def make_list_of_message_dicts_with_images(list_of_tuples_of_prompts_and_base64_
 
 	list_of_message_dicts = []
 
-	for string_role, string_prompt, base64_screenshot_canvas in list_of_tuples_of_prompts_and_base64_images:
+	# the image of the last message is the screenshot under test, any earlier image is a bug-free baseline
+	int_index_of_last_image = max(
+		(i for i, (_, _, base64_image) in enumerate(list_of_tuples_of_prompts_and_base64_images) if base64_image is not None),
+		default=-1
+	)
+
+	for int_index, (string_role, string_prompt, base64_screenshot_canvas) in enumerate(list_of_tuples_of_prompts_and_base64_images):
 
 		content: Union[list[dict], dict] = dict()
 
@@ -195,12 +289,8 @@ def make_list_of_message_dicts_with_images(list_of_tuples_of_prompts_and_base64_
 		}
 
 		if base64_screenshot_canvas is not None:
-			image_content = {
-				"type": "image_url",
-				"image_url": {
-					"url": f"data:image/jpeg;base64,{base64_screenshot_canvas}"
-				}
-			}
+			image_role = ImageRole.SCREENSHOT if int_index == int_index_of_last_image else ImageRole.BASELINE
+			image_content = make_image_content(base64_screenshot_canvas, image_role)
 			content = [
 				text_content,
 				image_content
@@ -225,24 +315,79 @@ def make_list_of_message_dicts_with_images_and_assets(
 ) -> list[dict]:
 
 	list_of_message_dicts = make_list_of_message_dicts_with_images(list_of_tuples_of_prompts_and_base64_images)
+	image_role = ImageRole.ASSET
+	list_of_content_assets = []
+
+	if get_asset_atlas_cache() is not None:
+		image_role = ImageRole.ASSET_ATLAS
+		list_of_content_assets.append({"type": "text", "text": STRING_PROMPT_ATLAS})
 
-	# update the list of messages to include oracles in the first user request
 	for string_encoded_asset in list_of_encoded_assets:
+		list_of_content_assets.append(make_image_content(string_encoded_asset, image_role))
 
-		content_asset = {
+	# update the list of messages to include oracles in the first user request,
+	# before the screenshot under test if it is in that request (v4): the screenshot is always the last part of a request,
+	# so that the requests for the snapshots of an app share everything before it (and providers can cache that prefix)
+	list_of_content_first_message = list_of_message_dicts[0]["content"]
+	int_index_of_assets = len(list_of_content_first_message) - 1 if len(list_of_message_dicts) == 1 else len(list_of_content_first_message)
+	list_of_content_first_message[int_index_of_assets:int_index_of_assets] = list_of_content_assets
+
+	# set_trace()
+
+	return list_of_message_dicts
+
+
+def replace_screenshot_with_regions_of_interest(list_of_message_dicts: list[dict], string_name_of_app: str, string_name_of_snapshot: str) -> list[dict]:
+	"""
+	If enabled (see pixel_diff.py), send enlarged crops of the regions where the screenshot differs from the app's clean.png instead of the
+	screenshot, which is always the last part of the request; the full screenshot is kept when nothing changed or most of the frame did
+	"""
+	policy = get_pixel_diff_policy()
+
+	if policy is None or not policy.bool_send_regions_of_interest:
+		return list_of_message_dicts
+
+	with span(STAGE_PIXEL_DIFF) as span_pixel_diff:
+		pixel_diff = compute_pixel_diff(string_name_of_app, string_name_of_snapshot, policy)
+		tuple_regions_of_interest = make_images_of_regions_of_interest(string_name_of_app, string_name_of_snapshot, pixel_diff, policy)
+		span_pixel_diff.set(int_number_of_regions=len(pixel_diff.list_boxes), bool_sent_regions_of_interest=tuple_regions_of_interest is not None)
+
+	if tuple_regions_of_interest is None:
+		return list_of_message_dicts
+
+	string_prompt_regions_of_interest, list_of_base64_images = tuple_regions_of_interest
+	list_of_content_last_message = list_of_message_dicts[-1]["content"]
+
+	list_of_message_dicts[-1]["content"] = list_of_content_last_message[:-1] + [{"type": "text", "text": string_prompt_regions_of_interest}] + [
+		make_image_content(base64_image, ImageRole.SCREENSHOT) for base64_image in list_of_base64_images
+	]
+
+	return list_of_message_dicts
+
+
+def make_image_content(base64_image: str, image_role: ImageRole) -> dict:
+
+	policy = get_image_preparation_policy()
+
+	# images are sent as stored (and labelled as JPEG), as in the paper
+	if policy is None:
+		return {
 			"type": "image_url",
 			"image_url": {
-				"url": f"data:image/jpeg;base64,{string_encoded_asset}"
+				"url": f"data:image/jpeg;base64,{base64_image}"
 			}
 		}
 
-		list_of_message_dicts[0]["content"].append(
-			content_asset
-		)
+	prepared_image = prepare_image(base64_image, image_role, policy)
+	image_preparation_stats.add(prepared_image)
 
-	# set_trace()
-
-	return list_of_message_dicts
+	return {
+		"type": "image_url",
+		"image_url": {
+			"url": f"data:{prepared_image.string_mime_type};base64,{prepared_image.base64_image}",
+			"detail": prepared_image.string_detail
+		}
+	}
 
 
 def make_list_of_message_dicts_text_only(list_of_tuples_of_prompts: list[tuple[str, str]]) -> list[dict]:
@@ -263,19 +408,89 @@ def make_list_of_message_dicts_text_only(list_of_tuples_of_prompts: list[tuple[s
 
 def get_response(model_api: ModelAPI, list_of_message_dicts: list[dict], **kwargs) -> Union[str, dict[str, Union[bool, str]]]:
 
-	if "openai" in model_api.value:
-		return get_response_openai(model_api, list_of_message_dicts, **kwargs)
+	with span(get_stage_of_request(kwargs.get("dict_structured_outputs_response_format")), **measure_messages(list_of_message_dicts)) as span_call:
+		response_content = get_response_untraced(model_api, list_of_message_dicts, **kwargs)
+		span_call.set(int_response_characters=len(response_content or ""))
+
+	return response_content
+
+
+def get_stage_of_request(dict_structured_outputs_response_format: Optional[dict]) -> str:
+	# the answer extraction is the only request with this response format
+	return STAGE_EXTRACTION_CALL if dict_structured_outputs_response_format is DICT_RESPONSE_FORMAT_STRUCTURED_ANSWER else STAGE_API_CALL
+
+
+def get_response_untraced(model_api: ModelAPI, list_of_message_dicts: list[dict], **kwargs) -> Union[str, dict[str, Union[bool, str]]]:
+
+	# Identical requests sent before are answered from the response cache (if enabled)
+	response_cache = get_response_cache()
+
+	if response_cache is not None:
+		string_key = make_key_of_request(model_api, list_of_message_dicts, kwargs.get("dict_structured_outputs_response_format"))
+		response_content_cached = response_cache.get(string_key)
+
+		if response_content_cached is not None:
+			add_to_current_span(bool_response_cache_hit=True)
+			return response_content_cached
+
+	# every backend serves the OpenAI chat completions API (see backends.py)
+	if get_backend(model_api) is not None:
+		response_content = get_response_openai(model_api, list_of_message_dicts, **kwargs)
+
+	else:
+		print(f"WARNING - Failed to get_response: model_api=${model_api} did not match any known specs! Valid model names: {list(ModelAPI)}")
+		return ""
+
+	if response_cache is not None and response_content:
+		response_cache.set(string_key, response_content)
+
+	return response_content
+
+
+def get_response_openai(
+	model_api: ModelAPI,
+	list_of_message_dicts: list[dict],
+	dict_structured_outputs_response_format: Optional[dict] = None,
+	path_to_streamed_output: Optional[Path] = None
+) -> Union[str, dict[str, Union[bool, str]]]:
+	# Retried, timed out & hedged by the call policy (see call_policy.py)
+	return call_with_policy(
+		get_name_of_backend(model_api),
+		get_stage_of_request(dict_structured_outputs_response_format),
+		lambda float_seconds_remaining: get_response_openai_once(model_api, list_of_message_dicts, dict_structured_outputs_response_format, float_seconds_remaining, path_to_streamed_output),
+		# two streams would write to the same file
+		bool_hedging_allowed=path_to_streamed_output is None
+	)
+
+
+def get_response_openai_once(
+	model_api: ModelAPI,
+	list_of_message_dicts: list[dict],
+	dict_structured_outputs_response_format: Optional[dict] = None,
+	float_seconds_remaining: Optional[float] = None,
+	path_to_streamed_output: Optional[Path] = None
+) -> Union[str, dict[str, Union[bool, str]]]:
+	# Get response from OpenAI API (the client is pooled & shared by all calls to this backend)
+	client = get_client(model_api).with_options(timeout=get_timeout_of_attempt(float_seconds_remaining), max_retries=0)
 
-	print(f"WARNING - Failed to get_response: model_api=${model_api} did not match any known specs! Valid model names: {list(ModelAPI)}")
+	model_name = get_name_of_model(model_api)
 
-	return ""
+	backend = get_backend(model_api)
+	# the request as this backend accepts it (the answer is still checked against the original response format)
+	list_of_message_dicts, dict_response_format_of_backend = backend.adapter.adapt_request(list_of_message_dicts, dict_structured_outputs_response_format)
 
+	with limit_concurrency(backend):
+		return get_response_openai_once_untraced(client, model_name, list_of_message_dicts, dict_structured_outputs_response_format, dict_response_format_of_backend, path_to_streamed_output)
 
-def get_response_openai(model_api: ModelAPI, list_of_message_dicts: list[dict], dict_structured_outputs_response_format: Optional[dict] = None) -> Union[str, dict[str, Union[bool, str]]]:
-	# Get response from OpenAI API
-	client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
 
-	model_name = model_api.value.split(":")[1]
+def get_response_openai_once_untraced(
+	client: OpenAI,
+	model_name: str,
+	list_of_message_dicts: list[dict],
+	dict_structured_outputs_response_format: Optional[dict],
+	dict_response_format_of_backend: Optional[dict],
+	path_to_streamed_output: Optional[Path]
+) -> Union[str, dict[str, Union[bool, str]]]:
 
 	response_content: Union[str, dict] = ""
 
@@ -283,54 +498,360 @@ def get_response_openai(model_api: ModelAPI, list_of_message_dicts: list[dict],
 		chat_completion = client.beta.chat.completions.parse(
 			messages=list_of_message_dicts,
 			model=model_name,
-			response_format=dict_structured_outputs_response_format
+			response_format=dict_response_format_of_backend
 		)
 		# print(chat_completion)
-		response_content = extract_response_structured_output_openai(chat_completion)
+		add_usage_to_current_span(chat_completion.usage)
+		response_content = extract_response_structured_output_openai(chat_completion, dict_structured_outputs_response_format)
 		return response_content
 
+	# the response is appended to a file as it arrives (see streaming.py)
+	if path_to_streamed_output is not None:
+		float_counter_start = time.perf_counter()
+
+		with client.chat.completions.create(
+			messages=list_of_message_dicts,
+			model=model_name,
+			stream=True,
+			stream_options={"include_usage": True}
+		) as stream, StreamedOutput(path_to_streamed_output, float_counter_start) as streamed_output:
+
+			for chunk in stream:
+				add_chunk_to_streamed_output(chunk, streamed_output)
+
+			return streamed_output.close()
+
 	chat_completion = client.chat.completions.create(
 		messages=list_of_message_dicts,
 		model=model_name
 	)
+	add_usage_to_current_span(chat_completion.usage)
 	response_content = extract_response_text_openai(chat_completion)
 
 	return response_content
 
 
+def add_chunk_to_streamed_output(chunk, streamed_output: StreamedOutput):
+
+	# the last chunk only holds the usage (stream_options={"include_usage": True})
+	if chunk.usage is not None:
+		add_usage_to_current_span(chunk.usage)
+
+	if len(chunk.choices) > 0:
+		streamed_output.add(chunk.choices[0].delta.content)
+
+
+def get_timeout_of_attempt(float_seconds_remaining: Optional[float]) -> float:
+	# the timeout of the clients, or less if the deadline of the call is closer
+	float_timeout_seconds = dict_client_settings["float_timeout_seconds"]
+
+	if float_seconds_remaining is None:
+		return float_timeout_seconds
+
+	return max(1.0, min(float_timeout_seconds, float_seconds_remaining))
+
+
 def extract_response_text_openai(chat_completion) -> str:
-	# parse the message
+	# parse the message (raises, so that the call is retried instead of the whole completion being saved as the response)
 	try:
 		string_response_content = chat_completion.choices[0].message.content
 
-	except Exception as e:
-		print("Caught error while grabbing response message content: ", e)
-		string_response_content = str(chat_completion)
+	except (AttributeError, IndexError, TypeError) as err:
+		raise InvalidResponseError(f"Caught error while grabbing response message content: {err!r}") from err
+
+	if not string_response_content or not string_response_content.strip():
+		raise InvalidResponseError(f"Empty response message content (finish_reason={chat_completion.choices[0].finish_reason!r})")
 
 	# print("Response:\n", string_response_content)
 
 	return string_response_content
 
 
-def extract_response_structured_output_openai(chat_completion) -> dict:
-	# parse the message
+def extract_response_structured_output_openai(chat_completion, dict_structured_outputs_response_format: Optional[dict] = None) -> str:
+	# parse the message: the JSON string of the structured output, checked against the required fields of its schema
+	string_structured_output = extract_response_text_openai(chat_completion)
+
+	return verify_structured_output(string_structured_output, dict_structured_outputs_response_format)
+
+
+def verify_structured_output(string_structured_output: str, dict_structured_outputs_response_format: Optional[dict] = None) -> str:
+	# raises InvalidResponseError if the structured output is not JSON or misses a required field of its schema
 	try:
-		dict_structured_output = chat_completion.choices[0].message.content
+		dict_structured_output = json.loads(string_structured_output)
 
-	except Exception as e:
-		print("Caught error while grabbing response message content: ", e)
-		dict_structured_output = dict()
+	except ValueError as err:
+		raise InvalidResponseError(f"Structured output is not valid JSON: {string_structured_output!r}") from err
+
+	list_required_fields = (dict_structured_outputs_response_format or dict()).get("json_schema", dict()).get("schema", dict()).get("required", [])
+
+	if not isinstance(dict_structured_output, dict) or any(string_field not in dict_structured_output for string_field in list_required_fields):
+		raise InvalidResponseError(f"Structured output does not match its schema: {string_structured_output!r}")
 
 	# print("Response:\n", dict_structured_output)
 
+	return string_structured_output
+
+
+async def get_response_async(
+	model_api: ModelAPI,
+	list_of_message_dicts: list[dict],
+	rate_limiter: AdaptiveRateLimiter,
+	client_async: Optional[AsyncOpenAI] = None,
+	**kwargs
+) -> Union[str, dict[str, Union[bool, str]]]:
+
+	with span(get_stage_of_request(kwargs.get("dict_structured_outputs_response_format")), **measure_messages(list_of_message_dicts)) as span_call:
+		response_content = await get_response_async_untraced(model_api, list_of_message_dicts, rate_limiter, client_async, **kwargs)
+		span_call.set(int_response_characters=len(response_content or ""))
+
+	return response_content
+
+
+async def get_response_async_untraced(
+	model_api: ModelAPI,
+	list_of_message_dicts: list[dict],
+	rate_limiter: AdaptiveRateLimiter,
+	client_async: Optional[AsyncOpenAI] = None,
+	**kwargs
+) -> Union[str, dict[str, Union[bool, str]]]:
+
+	# Identical requests sent before are answered from the response cache (if enabled)
+	response_cache = get_response_cache()
+
+	if response_cache is not None:
+		string_key = make_key_of_request(model_api, list_of_message_dicts, kwargs.get("dict_structured_outputs_response_format"))
+		response_content_cached = response_cache.get(string_key)
+
+		if response_content_cached is not None:
+			add_to_current_span(bool_response_cache_hit=True)
+			return response_content_cached
+
+	if get_backend(model_api) is not None:
+		response_content = await get_response_openai_async(model_api, list_of_message_dicts, rate_limiter, client_async, **kwargs)
+
+	else:
+		print(f"WARNING - Failed to get_response_async: model_api=${model_api} did not match any known specs! Valid model names: {list(ModelAPI)}")
+		return ""
+
+	if response_cache is not None and response_content:
+		response_cache.set(string_key, response_content)
+
+	return response_content
+
+
+async def get_response_openai_async(
+	model_api: ModelAPI,
+	list_of_message_dicts: list[dict],
+	rate_limiter: AdaptiveRateLimiter,
+	client_async: Optional[AsyncOpenAI] = None,
+	dict_structured_outputs_response_format: Optional[dict] = None,
+	path_to_streamed_output: Optional[Path] = None
+) -> Union[str, dict[str, Union[bool, str]]]:
+	"""asyncio variant of get_response_openai, throttled by a rate limiter shared between all calls"""
+
+	if client_async is None:
+		client_async = get_client_async(model_api)
+
+	model_name = get_name_of_model(model_api)
+
+	backend = get_backend(model_api)
+	list_of_message_dicts, dict_response_format_of_backend = backend.adapter.adapt_request(list_of_message_dicts, dict_structured_outputs_response_format)
+
+	dict_kwargs_request: dict = dict()
+
+	# the same request that client.beta.chat.completions.parse() sends for a JSON schema
+	if dict_structured_outputs_response_format is not None:
+		dict_kwargs_request["response_format"] = dict_response_format_of_backend
+
+	elif path_to_streamed_output is not None:
+		dict_kwargs_request["stream"] = True
+		dict_kwargs_request["stream_options"] = {"include_usage": True}
+
+	int_number_of_tokens_estimated = estimate_number_of_tokens(list_of_message_dicts)
+
+	async def get_response_once(float_seconds_remaining: Optional[float]) -> str:
+
+		async with limit_concurrency_async(backend), rate_limiter.limit(int_number_of_tokens_estimated) as slot:
+
+			float_counter_start = time.perf_counter()
+
+			try:
+				raw_response = await client_async.with_options(timeout=get_timeout_of_attempt(float_seconds_remaining)).chat.completions.with_raw_response.create(
+					messages=list_of_message_dicts,  # type: ignore
+					model=model_name,
+					**dict_kwargs_request
+				)
+
+			except RateLimitError as err:
+				# the call policy retries it, after the limiter has slowed down
+				slot.update_from_rate_limited_response(err.response.headers)
+				raise err
+
+			if "stream" in dict_kwargs_request:
+				# the slot is held until the stream ends: it is a request in flight
+				async with raw_response.parse() as stream:
+					with StreamedOutput(path_to_streamed_output, float_counter_start) as streamed_output:
+						usage = None
+
+						async for chunk in stream:
+							usage = chunk.usage or usage
+							add_chunk_to_streamed_output(chunk, streamed_output)
+
+						slot.update_from_response(raw_response.headers, usage.total_tokens if usage is not None else None)
+
+						return streamed_output.close()
+
+			chat_completion = raw_response.parse()
+			add_usage_to_current_span(chat_completion.usage)
+			int_number_of_tokens_used = chat_completion.usage.total_tokens if chat_completion.usage is not None else None
+			slot.update_from_response(raw_response.headers, int_number_of_tokens_used)
+
+		if dict_structured_outputs_response_format is not None:
+			return extract_response_structured_output_openai(chat_completion, dict_structured_outputs_response_format)
+
+		return extract_response_text_openai(chat_completion)
+
+	return await call_with_policy_async(
+		get_name_of_backend(model_api),
+		get_stage_of_request(dict_structured_outputs_response_format),
+		get_response_once,
+		bool_hedging_allowed=path_to_streamed_output is None
+	)
+
+
+async def get_structured_answer_async(
+	model_api: ModelAPI,
+	string_response_content: str,
+	rate_limiter: AdaptiveRateLimiter,
+	client_async: Optional[AsyncOpenAI] = None
+) -> dict[str, Union[bool, str]]:
+
+	list_of_message_dicts = make_list_of_message_dicts_for_structured_answer(string_response_content)
+
+	dict_structured_output: dict[str, Union[bool, str]] = await get_response_async(
+		model_api,
+		list_of_message_dicts,
+		rate_limiter,
+		client_async,
+		dict_structured_outputs_response_format=DICT_RESPONSE_FORMAT_STRUCTURED_ANSWER
+	)  # type: ignore
+
 	return dict_structured_output
 
 
+DICT_RESPONSE_FORMAT_STRUCTURED_ANSWER = {
+	"type": "json_schema",
+	"json_schema": {
+		"name": "answer_extraction_response",
+		"strict": True,
+		"schema": {
+			"type": "object",
+			"properties": {
+				"bool_did_detect_visual_bug": {"type": "boolean"},
+				"string_description_of_visual_bug": {"type": "string"}
+			},
+			"required": ["bool_did_detect_visual_bug", "string_description_of_visual_bug"],
+			"additionalProperties": False
+		}
+	}
+}
+
+
+# Answer and response in one call, instead of a second call to extract the answer from the response
+DICT_RESPONSE_FORMAT_RESPONSE_WITH_ANSWER = {
+	"type": "json_schema",
+	"json_schema": {
+		"name": "response_with_answer",
+		"strict": True,
+		"schema": {
+			"type": "object",
+			"properties": {
+				# first, so that the answer is given after (and based on) the full response
+				"string_response_content": {"type": "string", "description": "Your full response to the request above"},
+				"bool_did_detect_visual_bug": {"type": "boolean", "description": "Whether your response indicates that there is a visual bug"},
+				"string_description_of_visual_bug": {"type": "string", "description": "Summarized description of the detected visual bug, or an empty string if there is none"}
+			},
+			"required": ["string_response_content", "bool_did_detect_visual_bug", "string_description_of_visual_bug"],
+			"additionalProperties": False
+		}
+	}
+}
+
+# Off by default: the response & answer extraction are two calls, as in the paper
+bool_single_call_is_enabled = os.getenv("VLM_CANVAS_BUGS_SINGLE_CALL", "0") == "1"
+
+
+def configure_single_call(bool_enabled: bool):
+	global bool_single_call_is_enabled
+	bool_single_call_is_enabled = bool_enabled
+
+
+def get_bool_single_call_is_enabled() -> bool:
+	return bool_single_call_is_enabled
+
+
+def get_response_with_structured_answer(model_api: ModelAPI, list_of_message_dicts: list[dict]) -> tuple[str, str]:
+
+	response_content = get_response(
+		model_api,
+		list_of_message_dicts,
+		dict_structured_outputs_response_format=DICT_RESPONSE_FORMAT_RESPONSE_WITH_ANSWER
+	)
+
+	return split_response_with_structured_answer(response_content)  # type: ignore
+
+
+async def get_response_with_structured_answer_async(
+	model_api: ModelAPI,
+	list_of_message_dicts: list[dict],
+	rate_limiter: AdaptiveRateLimiter,
+	client_async: Optional[AsyncOpenAI] = None
+) -> tuple[str, str]:
+
+	response_content = await get_response_async(
+		model_api,
+		list_of_message_dicts,
+		rate_limiter,
+		client_async,
+		dict_structured_outputs_response_format=DICT_RESPONSE_FORMAT_RESPONSE_WITH_ANSWER
+	)
+
+	return split_response_with_structured_answer(response_content)  # type: ignore
+
+
+def split_response_with_structured_answer(string_response_with_answer: str) -> tuple[str, str]:
+	"""
+	Split a DICT_RESPONSE_FORMAT_RESPONSE_WITH_ANSWER response into the response (.txt)
+	and the JSON string of the answer (.json), the same as get_response & get_structured_answer return
+	"""
+	try:
+		dict_response_with_answer = json.loads(string_response_with_answer)
+		string_response_content = dict_response_with_answer.pop("string_response_content")
+
+	except (TypeError, ValueError, KeyError, AttributeError) as err:
+		raise ValueError(f"Response does not match the schema {DICT_RESPONSE_FORMAT_RESPONSE_WITH_ANSWER['json_schema']['name']}: {string_response_with_answer!r}") from err
+
+	return string_response_content, json.dumps(dict_response_with_answer)
+
+
 def get_structured_answer(model_api: ModelAPI, string_response_content: str) -> dict[str, Union[bool, str]]:
 	"""
 	https://openai.com/index/introducing-structured-outputs-in-the-api/
 	https://platform.openai.com/docs/guides/structured-outputs/introduction?context=ex4
 	"""
+	list_of_message_dicts = make_list_of_message_dicts_for_structured_answer(string_response_content)
+
+	dict_structured_output: dict[str, Union[bool, str]] = get_response(
+		model_api,
+		list_of_message_dicts,
+		dict_structured_outputs_response_format=DICT_RESPONSE_FORMAT_STRUCTURED_ANSWER
+	)  # type: ignore
+
+	return dict_structured_output
+
+
+def make_list_of_message_dicts_for_structured_answer(string_response_content: str) -> list[dict]:
+
 	STRING_PROMPT_EXTRACT_ANSWER = "The following message describes what was observed in a screenshot from an HTML5 Canvas application.\n"
 	STRING_PROMPT_EXTRACT_ANSWER += "Please fill in the provided JSON schema by determining if the above message"
 	STRING_PROMPT_EXTRACT_ANSWER += " indicates whether or not there is a visual bug (`bool_did_detect_visual_bug`),"
@@ -344,35 +865,29 @@ def get_structured_answer(model_api: ModelAPI, string_response_content: str) ->
 		("user", string_response_content),
 	]
 
-	list_of_message_dicts = make_list_of_message_dicts_text_only(list_of_tuples_of_prompts)
-
-	dict_response_format = {
-		"type": "json_schema",
-		"json_schema": {
-			"name": "answer_extraction_response",
-			"strict": True,
-			"schema": {
-				"type": "object",
-				"properties": {
-					"bool_did_detect_visual_bug": {"type": "boolean"},
-					"string_description_of_visual_bug": {"type": "string"}
-				},
-				"required": ["bool_did_detect_visual_bug", "string_description_of_visual_bug"],
-				"additionalProperties": False
-			}
-		}
-	}
+	return make_list_of_message_dicts_text_only(list_of_tuples_of_prompts)
 
-	dict_structured_output: dict[str, Union[bool, str]] = get_response(
-		model_api,
-		list_of_message_dicts,
-		dict_structured_outputs_response_format=dict_response_format
-	)  # type: ignore
 
-	return dict_structured_output
+def save_results(model_api: ModelAPI, prompt_strategy: PromptStrategy, string_name_of_app: str, string_name_of_snapshot: str, string_response_content: str, json_response_results: dict):
 
+	with span(STAGE_SAVE, int_characters=len(string_response_content or "")):
+		save_results_untraced(model_api, prompt_strategy, string_name_of_app, string_name_of_snapshot, string_response_content, json_response_results)
 
-def save_results(model_api: ModelAPI, prompt_strategy: PromptStrategy, string_name_of_app: str, string_name_of_snapshot: str, string_response_content: str, json_response_results: dict):
+
+def save_results_untraced(model_api: ModelAPI, prompt_strategy: PromptStrategy, string_name_of_app: str, string_name_of_snapshot: str, string_response_content: str, json_response_results: dict):
+
+	verify_results_are_not_empty(string_response_content, json_response_results)
+
+	json_response_results = add_pixel_diff_to_results(json_response_results, string_name_of_app, string_name_of_snapshot)
+
+	results_store = get_results_store()
+
+	# one row in the results store instead of two files (if enabled)
+	if results_store is not None:
+		string_response_results = json_response_results if isinstance(json_response_results, str) else json.dumps(json_response_results)
+		results_store.save(model_api.value, prompt_strategy.value, string_name_of_app, string_name_of_snapshot, string_response_content, string_response_results)
+		remove_streamed_output(model_api, prompt_strategy, string_name_of_app, string_name_of_snapshot)
+		return
 
 	path_to_results_out = make_path_to_results_dir_for_model_with_strategy_on_app(model_api, prompt_strategy, string_name_of_app)
 
@@ -396,9 +911,65 @@ def save_results(model_api: ModelAPI, prompt_strategy: PromptStrategy, string_na
 	except Exception as e:
 		print("Caught error while writing response results JSON to file: ", e)
 
+	remove_streamed_output(model_api, prompt_strategy, string_name_of_app, string_name_of_snapshot)
+
+
+def add_pixel_diff_to_results(json_response_results: Union[str, dict], string_name_of_app: str, string_name_of_snapshot: str) -> Union[str, dict]:
+	"""The structured answer with the diff statistics of the snapshot against clean.png (if enabled, see pixel_diff.py)"""
+
+	policy = get_pixel_diff_policy()
+
+	if policy is None:
+		return json_response_results
+
+	try:
+		dict_stats = compute_pixel_diff(string_name_of_app, string_name_of_snapshot, policy).dict_stats
+
+	except Exception as err:
+		print(f"WARNING: Failed to diff snapshot {string_name_of_app}/{string_name_of_snapshot} against clean.png: {err!r}")
+		return json_response_results
+
+	# the answer is saved as a JSON string (see load_results)
+	if isinstance(json_response_results, str):
+		return json.dumps({**json.loads(json_response_results), "dict_pixel_diff": dict_stats})
+
+	return {**json_response_results, "dict_pixel_diff": dict_stats}
+
+
+def make_path_to_streamed_output_of_sample(model_api: ModelAPI, prompt_strategy: PromptStrategy, string_name_of_app: str, string_name_of_snapshot: str) -> Path:
+	path_to_results_out = make_path_to_results_dir_for_model_with_strategy_on_app(model_api, prompt_strategy, string_name_of_app)
+	return make_path_to_streamed_output(path_to_results_out / f"{string_name_of_snapshot}.txt")
+
+
+def remove_streamed_output(model_api: ModelAPI, prompt_strategy: PromptStrategy, string_name_of_app: str, string_name_of_snapshot: str):
+	# the .txt now holds the whole response
+	make_path_to_streamed_output_of_sample(model_api, prompt_strategy, string_name_of_app, string_name_of_snapshot).unlink(missing_ok=True)
+
+
+def verify_results_are_not_empty(string_response_content: str, json_response_results: Union[str, dict]):
+	# a failed call must fail its job, not be saved as if the model had answered nothing
+	if not string_response_content:
+		raise ValueError("Refusing to save an empty response")
+
+	if not json_response_results or (isinstance(json_response_results, str) and not parse_response_results(json_response_results)):
+		raise ValueError(f"Refusing to save an empty answer: {json_response_results!r}")
+
 
 def load_results(model_api: ModelAPI, prompt_strategy: PromptStrategy, string_name_of_app: str, string_name_of_snapshot: str):
 
+	results_store = get_results_store()
+
+	if results_store is not None:
+		tuple_results = results_store.load(model_api.value, prompt_strategy.value, string_name_of_app, string_name_of_snapshot)
+
+		if tuple_results is None:
+			print(f"Caught error while reading results from store: no results for {model_api.value} / {prompt_strategy.value} / {string_name_of_app} / {string_name_of_snapshot}")
+			return "", dict()
+
+		string_response_content, string_response_results = tuple_results
+
+		return string_response_content, parse_response_results(string_response_results)
+
 	path_to_results = make_path_to_results_dir_for_model_with_strategy_on_app(model_api, prompt_strategy, string_name_of_app)
 
 	path_results_text = path_to_results / f"{string_name_of_snapshot}.txt"
@@ -439,7 +1010,7 @@ def make_path_to_results_dir_for_model_with_strategy_on_app(model_api: ModelAPI,
 	path_to_results_dir_model_api_prompt_strategy = make_path_to_results_dir_for_model_with_strategy(model_api, prompt_strategy)
 	path_to_results_dir_model_api_prompt_strategy_app = path_to_results_dir_model_api_prompt_strategy / string_name_of_app
 	# Ensure path exists
-	path_to_results_dir_model_api_prompt_strategy_app.mkdir(parents=False, exist_ok=True)
+	make_results_dir(path_to_results_dir_model_api_prompt_strategy_app)
 
 	return path_to_results_dir_model_api_prompt_strategy_app
 
@@ -448,16 +1019,28 @@ def make_path_to_results_dir_for_model_with_strategy(model_api: ModelAPI, prompt
 	# Base path for results
 	path_to_results_dir = Path("../Data/2-Experiments/results")
 	# Construct paths
-	path_to_results_dir_model_api = path_to_results_dir / model_api.value.replace(":", "-")
+	path_to_results_dir_model_api = path_to_results_dir / make_name_of_model_dir(model_api.value)
 	path_to_results_dir_model_api_prompt_strategy = path_to_results_dir_model_api / prompt_strategy.value
 	# Ensure paths exist
-	path_to_results_dir.mkdir(parents=False, exist_ok=True)
-	path_to_results_dir_model_api.mkdir(parents=False, exist_ok=True)
-	path_to_results_dir_model_api_prompt_strategy.mkdir(parents=False, exist_ok=True)
+	make_results_dir(path_to_results_dir_model_api_prompt_strategy)
 
 	return path_to_results_dir_model_api_prompt_strategy
 
 
+# results folders already created by this process, so saving & loading doesn't call mkdir every time
+set_paths_to_results_dirs_created: set[Path] = set()
+
+
+def make_results_dir(path_to_results_dir: Path):
+
+	if path_to_results_dir in set_paths_to_results_dirs_created:
+		return
+
+	# parents & exist_ok: concurrent workers may create the same folders at the same time
+	path_to_results_dir.mkdir(parents=True, exist_ok=True)
+	set_paths_to_results_dirs_created.add(path_to_results_dir)
+
+
 def verify_response_to_clean_sample_is_correct(model_api: ModelAPI, prompt_strategy: PromptStrategy, string_name_of_app: str):
 
 	try: